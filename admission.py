@@ -0,0 +1,171 @@
+import bisect
+import itertools
+import os
+import threading
+import time
+
+from metrics import Counter, Gauge, Histogram, registry
+
+# Priority classes of requests, the most urgent first: reads, writes of a
+# single resource and bulk writes of many
+READ = 'read'
+WRITE = 'write'
+BULK = 'bulk'
+PRIORITIES = (READ, WRITE, BULK)
+
+shed_requests = registry.register(Counter(
+    'http_requests_shed_total', 'Requests answered with 503 because the database was at capacity.', ('priority',)
+))
+queued_requests = registry.register(Counter(
+    'http_requests_queued_total', 'Requests that waited for a database slot.', ('priority',)
+))
+queue_wait = registry.register(Histogram(
+    'admission_queue_wait_seconds', 'Time a request waited for a database slot.', ('priority',)
+))
+
+
+class Shed(RuntimeError):
+    """Raised when a request that gave up its slot while it waited cannot get one back."""
+
+
+class Waiter:
+    __slots__ = ('priority', 'event', 'admitted')
+
+    def __init__(self, priority: str):
+        self.priority = priority
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class Admission:
+    """
+    Limits the requests that use the database at once to the connections of
+    the pool.
+
+    `acquire` admits a request at once while fewer than `capacity` run and
+    its class is under its limit in `limits`. Otherwise the request waits in
+    a queue of at most `queue_depth` requests for up to `queue_timeout`
+    seconds, and is shed (`acquire` returns False) when the queue is full or
+    the wait runs out. Freed slots go to the waiting reads first, then to
+    single writes and then to bulk writes, and a request arriving at a full
+    queue takes the place of a waiting one of a lower class. Bulk writes
+    never hold more than their limit, which keeps slots free for reads.
+
+    Every admitted request must be released exactly once.
+    """
+
+    def __init__(self, capacity: int, queue_depth: int, queue_timeout: float, limits: dict | None = None):
+        self.capacity = capacity
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.limits = {priority: min((limits or {}).get(priority, capacity), capacity) for priority in PRIORITIES}
+        self.in_flight = 0
+        self.class_in_flight = dict.fromkeys(PRIORITIES, 0)
+        # (rank, arrival, waiter), the next to admit first
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.shed = dict.fromkeys(PRIORITIES, 0)
+        self.queued = dict.fromkeys(PRIORITIES, 0)
+        self.lock = threading.Lock()
+        registry.register(Gauge('admission_in_flight', 'Requests admitted to the database.', lambda: self.in_flight))
+        registry.register(Gauge('admission_queue_depth', 'Requests waiting for a database slot.', lambda: len(self.waiters)))
+
+    def can_run(self, priority: str) -> bool:
+        return self.in_flight < self.capacity and self.class_in_flight[priority] < self.limits[priority]
+
+    def run(self, priority: str) -> None:
+        self.in_flight += 1
+        self.class_in_flight[priority] += 1
+
+    def count_shed(self, priority: str) -> None:
+        self.shed[priority] += 1
+        shed_requests.inc(priority)
+
+    def acquire(self, priority: str) -> bool:
+        """Admits a request of the given class, waiting if needed; False when it is shed."""
+        with self.lock:
+            if self.can_run(priority):
+                self.run(priority)
+                return True
+            rank = PRIORITIES.index(priority)
+            if len(self.waiters) >= self.queue_depth:
+                if not self.waiters or self.waiters[-1][0] <= rank:
+                    self.count_shed(priority)
+                    return False
+                # Shed the last waiter of the lowest class to make room
+                self.waiters.pop()[2].event.set()
+            waiter = Waiter(priority)
+            bisect.insort(self.waiters, (rank, next(self.arrivals), waiter), key=lambda item: item[:2])
+            self.queued[priority] += 1
+            queued_requests.inc(priority)
+        start = time.perf_counter()
+        waiter.event.wait(self.queue_timeout)
+        queue_wait.observe(time.perf_counter() - start, priority)
+        with self.lock:
+            if waiter.admitted:
+                return True
+            self.waiters = [item for item in self.waiters if item[2] is not waiter]
+            self.count_shed(priority)
+            return False
+
+    def release(self, priority: str) -> None:
+        """Frees the slot of an admitted request and hands it on to the waiters."""
+        with self.lock:
+            self.in_flight -= 1
+            self.class_in_flight[priority] -= 1
+            # A bulk write at its limit does not hold up the reads behind it
+            waiting = []
+            for item in self.waiters:
+                waiter = item[2]
+                if self.can_run(waiter.priority):
+                    self.run(waiter.priority)
+                    waiter.admitted = True
+                    waiter.event.set()
+                else:
+                    waiting.append(item)
+            self.waiters = waiting
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'limits': dict(self.limits),
+                'in_flight': self.in_flight,
+                'waiting': len(self.waiters),
+                'queued': dict(self.queued),
+                'shed': dict(self.shed),
+            }
+
+
+def queue_depth(capacity: int) -> int:
+    """Returns the most requests that may wait for a slot: ADMISSION_QUEUE_DEPTH, by default the capacity."""
+    return int(os.environ.get('ADMISSION_QUEUE_DEPTH', str(capacity)))
+
+
+def worker_threads(capacity: int) -> int:
+    """
+    Returns the threads a worker needs to run, queue and shed requests.
+
+    Requests beyond the running and waiting ones need a thread too, to be
+    answered with 503 at once rather than wait for one.
+    """
+    return capacity + queue_depth(capacity) + int(os.environ.get('ADMISSION_SPARE_THREADS', '2'))
+
+
+def init_admission(capacity: int) -> Admission | None:
+    """
+    Builds the admission control of a pool of `capacity` connections from
+    the environment, or returns None.
+
+    ADMISSION_CONTROL=0 turns it off. ADMISSION_QUEUE_DEPTH requests wait for
+    at most ADMISSION_QUEUE_TIMEOUT seconds, and bulk writes hold at most
+    ADMISSION_BULK_LIMIT slots, by default half of them.
+    """
+    if os.environ.get('ADMISSION_CONTROL', '1') == '0':
+        return None
+    return Admission(
+        capacity,
+        queue_depth=queue_depth(capacity),
+        queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '1')),
+        limits={BULK: int(os.environ.get('ADMISSION_BULK_LIMIT', str(max(capacity // 2, 1))))},
+    )
@@ -0,0 +1,153 @@
+"""
+ASGI entry point that serves the routes of main.py on SQLAlchemy's async engine.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+The Flask handlers are reused unchanged, so response bodies and status codes
+are identical to the WSGI app. Each request runs in a greenlet on the event
+loop instead of holding a worker thread: the store talks to the database
+through the sync facade of an async engine (aiomysql in production, aiosqlite
+locally), and every time a driver call would block, the greenlet yields to
+the event loop and other requests run. This is the mechanism SQLAlchemy's
+own asyncio extension is built on.
+
+STORAGE_BACKEND, SQLITE_PATH and EXPLAIN_QUERIES behave as for main.py. The
+mysql backend connects as described in connect_aiomysql.py.
+"""
+import io
+import os
+import sys
+
+from sqlalchemy.util import await_only, greenlet_spawn
+
+import main
+from connect_aiomysql import connect_with_aiomysql
+from connect_sqlite import connect_aiosqlite
+from migrations import migrate
+
+# The async engine, `None` with the in-memory store
+engine = None
+
+
+def init_async_engine():
+    if main.STORAGE_BACKEND == 'sqlite':
+        return connect_aiosqlite(os.environ.get('SQLITE_PATH', ':memory:'))
+    return connect_with_aiomysql()
+
+
+async def startup():
+    global engine
+    # The flusher thread cannot drive the async engine outside the event loop
+    if main.review_queue is not None and main.STORAGE_BACKEND != 'memory':
+        raise RuntimeError('REVIEW_QUEUE_PATH is not supported by the ASGI app, serve it with gunicorn')
+    # Nor can the health checks of a read replica, whose engine would block the loop
+    if os.environ.get('REPLICA_CONNECTION_NAME') or os.environ.get('REPLICA_SQLITE_PATH'):
+        raise RuntimeError('Read replicas are not supported by the ASGI app, serve it with gunicorn')
+    # Long polls of GET /changes would block the event loop too, so they
+    # answer at once. Prune the change log with `flask --app main prune-changes`.
+    main.change_feed.max_waiters = 0
+    if main.STORAGE_BACKEND == 'memory':
+        main.init_db()
+        return
+    engine = init_async_engine()
+    main.init_db(engine.sync_engine)
+    # Queued requests wait on threading events, which would block the event
+    # loop; requests wait for a connection of the async pool instead
+    main.admission = None
+    await greenlet_spawn(migrate, main.db)
+
+
+async def shutdown():
+    if engine is not None:
+        await engine.dispose()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                raise
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def wsgi_environ(scope, body):
+    """Translates an ASGI HTTP scope into a WSGI environ."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def respond(environ, send):
+    """Runs the Flask app inside the request greenlet and sends its response."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = main.app(environ, start_response)
+    try:
+        await_only(send({
+            'type': 'http.response.start',
+            'status': response['status'],
+            'headers': response['headers'],
+        }))
+        # Streamed responses keep querying the database between chunks
+        for chunk in result:
+            if chunk:
+                await_only(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+        await_only(send({'type': 'http.response.body', 'body': b''}))
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    body = await read_body(receive)
+    await greenlet_spawn(respond, wsgi_environ(scope, body), send)
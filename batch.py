@@ -0,0 +1,46 @@
+import json
+import os
+from itertools import islice
+
+# Number of items written per multi-row INSERT and transaction
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '100'))
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+class InvalidBatch(ValueError):
+    """Raised when a batch request body is neither a JSON array nor NDJSON."""
+
+
+def iter_batch_items(request):
+    """
+    Yields the items of a batch request body.
+
+    NDJSON bodies are read line by line so large batches are never held in
+    memory at once. Lines that are not valid JSON are yielded as None and
+    fail validation like any other malformed item.
+    """
+    if request.mimetype == NDJSON_MIMETYPE:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        content = request.get_json(silent=True)
+        if not isinstance(content, list):
+            raise InvalidBatch()
+        yield from content
+
+
+def chunked(items, size=BATCH_CHUNK_SIZE):
+    """Splits an iterable into lists of at most `size` items."""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,637 @@
+"""
+Load test and benchmark harness built on the Postman collection.
+
+Requests are taken from test/assignment3.postman_collection.json and replayed
+as weighted workload mixes against the app, started in-process on a local
+database stand-in (SQLite by default, or the in-memory store), so a run needs
+no network and no Cloud SQL instance:
+
+    python benchmark.py run --mix browse --out before.json
+    python benchmark.py run --mix browse --out after.json
+    python benchmark.py diff before.json after.json
+
+A run seeds the database, then sends a fixed, seeded sequence of requests and
+reports requests per second, p50/p95/p99 latency and database round trips per
+request for every route. `--server asgi` serves the app through asgi.py to
+compare it with the threaded WSGI server, and `--url` targets an app that is
+already running instead; round trips are only counted in-process.
+
+The typeahead mix measures name prefix searches, which should stay within
+20 ms at p99 on a million businesses. One client at a time keeps queueing in
+the in-process server out of the latencies:
+
+    python benchmark.py run --mix typeahead --businesses 1000000 --concurrency 1
+
+`startup` starts the app in a fresh process the way a gunicorn worker does,
+once without and once with the pool pre-warmed, and reports the import
+time of main.py, the time until /healthz and /readyz succeed, and the
+latency of the first requests. `--connect-latency-ms` stands in for the
+TLS handshake and authentication of a Cloud SQL connection:
+
+    python benchmark.py startup --connect-latency-ms 150
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from pagination import encode_cursor
+
+COLLECTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'assignment3.postman_collection.json')
+
+# Response header the in-process server uses to report database round trips
+ROUND_TRIPS_HEADER = 'X-Benchmark-Round-Trips'
+
+# Requests of a mix, as (label, Postman folder and item numbers, weight, variables).
+# The variables fill in the {{placeholders}} of the Postman request and may
+# also override its query string.
+MIXES = {
+    # Read-heavy browsing of businesses and their reviews
+    'browse': [
+        ('GET /businesses/<id>', ('2', '1'), 40, lambda s, r: {'business_id_1': r.choice(s.business_ids)}),
+        ('GET /businesses', ('3', '8'), 20, lambda s, r: {}),
+        ('GET /owners/<id>/businesses', ('6', '5'), 15, lambda s, r: {'owner_id_1': r.choice(s.owner_ids)}),
+        ('GET /reviews/<id>', ('8', '1'), 15, lambda s, r: {'review_id_1': r.choice(s.review_ids)}),
+        ('GET /users/<id>/reviews', ('11', '6'), 10, lambda s, r: {'user_id_1': r.choice(s.user_ids)}),
+    ],
+    # Bursts of new reviews, with some edits and reads of the same reviews
+    'reviews': [
+        ('POST /reviews', ('7', '2'), 70, lambda s, r: {
+            'user_id_1': next(s.new_user_ids), 'business_id_2': r.choice(s.business_ids)
+        }),
+        ('PUT /reviews/<id>', ('9', '5'), 20, lambda s, r: {'review_id_1': r.choice(s.review_ids)}),
+        ('GET /reviews/<id>', ('8', '1'), 10, lambda s, r: {'review_id_1': r.choice(s.review_ids)}),
+    ],
+    # Pages far from the start of the list, by offset and by keyset cursor
+    'paginate': [
+        ('GET /businesses?offset', ('3', '9'), 50, lambda s, r: {
+            'query': {'offset': r.randrange(len(s.business_ids)), 'limit': 3}
+        }),
+        ('GET /businesses?cursor', ('3', '9'), 50, lambda s, r: {
+            'query': {'cursor': s.cursor_after(r.choice(s.business_ids)), 'limit': 3}
+        }),
+    ],
+    # Large pages, where serializing the rows costs more than reading them
+    'pages': [
+        ('GET /businesses?limit=500', ('3', '9'), 50, lambda s, r: {'query': {'cursor': '', 'limit': 500}}),
+        ('GET /businesses?limit=500&fields', ('3', '9'), 50, lambda s, r: {
+            'query': {'cursor': '', 'limit': 500, 'fields': 'id,name,self'}
+        }),
+    ],
+    # Autocomplete of business names as they are typed, and city listings
+    'typeahead': [
+        ('GET /businesses?q', ('3', '8'), 80, lambda s, r: {'query': {'q': s.name_prefix(r), 'limit': 10}}),
+        ('GET /businesses?city', ('3', '8'), 20, lambda s, r: {
+            'query': {'city': r.choice(CITIES), 'cursor': '', 'limit': 10}
+        }),
+    ],
+}
+
+# Seeded businesses get distinct names, made of these words and a number, and
+# one of these cities, so that prefix searches and filters have something to
+# tell apart. Both are derived from the position of the business, not drawn
+# from the random sequence, so the requests of the other mixes stay the same.
+NAME_WORDS = [
+    'Alder', 'Birch', 'Cedar', 'Dune', 'Ember', 'Fern', 'Grove', 'Harbor', 'Iris', 'Juniper', 'Kestrel', 'Lark',
+    'Maple', 'Nettle', 'Oak', 'Pine', 'Quarry', 'Rowan', 'Sage', 'Thistle', 'Umber', 'Vale', 'Willow', 'Yarrow',
+]
+CITIES = ['Austin', 'Bend', 'Corvallis', 'Eugene', 'Portland', 'Salem', 'Seattle', 'Tacoma']
+
+# Businesses sent per batch request while seeding
+SEED_BATCH_SIZE = 1000
+
+
+def business_name(n):
+    words = len(NAME_WORDS)
+    return '{} {} {}'.format(NAME_WORDS[n % words], NAME_WORDS[n // words % words], n)
+
+
+def load_collection(path=COLLECTION):
+    """Returns the Postman requests keyed by (folder number, item number)."""
+    with open(path) as f:
+        collection = json.load(f)
+    requests = {}
+    for folder in collection['item']:
+        for item in folder['item']:
+            request = item['request']
+            url = request['url']['raw'] if isinstance(request['url'], dict) else request['url']
+            script = '\n'.join('\n'.join(e['script']['exec']) for e in item.get('event', []))
+            expected = re.search(r'to\.have\.status\((\d+)\)', script)
+            key = (folder['name'].split('.')[0], item['name'].split('.')[0])
+            requests[key] = {
+                'method': request['method'],
+                'url': url,
+                'body': (request.get('body') or {}).get('raw') or None,
+                'status': int(expected.group(1)) if expected else None,
+            }
+    return requests
+
+
+def fill(template, variables):
+    """Substitutes {{placeholders}}, leaving unknown ones in place."""
+    if template is None:
+        return None
+    return re.sub(r'\{\{(\w+)\}\}', lambda m: str(variables.get(m.group(1), m.group(0))), template)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Client:
+    """Sends requests to the app under test, one connection per request."""
+
+    def __init__(self, base_url):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+
+    def send(self, method, path, body=None):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            start = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            elapsed = time.perf_counter() - start
+            round_trips = response.getheader(ROUND_TRIPS_HEADER)
+            return response.status, data, elapsed, None if round_trips is None else int(round_trips)
+        finally:
+            conn.close()
+
+
+class Dataset:
+    """Ids created while seeding, which the mixes draw from."""
+
+    def __init__(self, business_ids, owner_ids, review_ids, user_ids):
+        self.business_ids = business_ids
+        self.business_count = len(business_ids)
+        self.owner_ids = owner_ids
+        self.review_ids = review_ids
+        self.user_ids = user_ids
+        # Users that have not reviewed anything yet, so new reviews succeed
+        self.new_user_ids = itertools.count(max(user_ids, default=0) + 1)
+
+    @staticmethod
+    def cursor_after(business_id):
+        return encode_cursor({'id': business_id})
+
+    def name_prefix(self, rng):
+        """The first one to six characters of a seeded name, as typed so far."""
+        return business_name(rng.randrange(self.business_count))[:rng.randint(1, 6)]
+
+
+def seed(client, requests, businesses, reviews, rng):
+    """Creates businesses and reviews through the batch endpoints."""
+    business_template = requests[('1', '1')]['body']
+    review_template = requests[('7', '6')]['body']
+    owners = max(businesses // 10, 1)
+    users = max(reviews // 5, 1)
+
+    business_ids, owner_ids = [], set()
+    for start in range(0, businesses, SEED_BATCH_SIZE):
+        batch = []
+        for n in range(start, min(start + SEED_BATCH_SIZE, businesses)):
+            owner_id = rng.randrange(1, owners + 1)
+            owner_ids.add(owner_id)
+            business = json.loads(fill(business_template, {'owner_id_1': owner_id}))
+            business['name'], business['city'] = business_name(n), CITIES[n % len(CITIES)]
+            batch.append(business)
+        status, data, _, _ = client.send('POST', '/businesses/batch', json.dumps(batch))
+        if status != 200:
+            raise RuntimeError('Seeding businesses failed with status {}'.format(status))
+        business_ids.extend(result['id'] for result in json.loads(data)['results'])
+
+    # Distinct (user, business) pairs, since a user reviews a business once
+    pairs = set()
+    while len(pairs) < min(reviews, users * len(business_ids)):
+        pairs.add((rng.randrange(1, users + 1), rng.choice(business_ids)))
+    pairs = sorted(pairs)
+    review_ids, user_ids = [], set()
+    for start in range(0, len(pairs), 100):
+        batch = []
+        for user_id, business_id in pairs[start:start + 100]:
+            user_ids.add(user_id)
+            batch.append(json.loads(fill(review_template, {'user_id_2': user_id, 'business_id_2': business_id})))
+        status, data, _, _ = client.send('POST', '/reviews/batch', json.dumps(batch))
+        if status != 200:
+            raise RuntimeError('Seeding reviews failed with status {}'.format(status))
+        review_ids.extend(result['id'] for result in json.loads(data)['results'] if result['status'] == 201)
+
+    return Dataset(business_ids, sorted(owner_ids), review_ids, sorted(user_ids))
+
+
+def plan(mix, requests, dataset, count, rng):
+    """Draws the sequence of requests of a run, reproducible from the seed."""
+    entries = MIXES[mix]
+    weights = [entry[2] for entry in entries]
+    planned = []
+    for _ in range(count):
+        label, key, _, variables = rng.choices(entries, weights=weights)[0]
+        request = requests[key]
+        # Paths are relative to the app under test
+        values = dict(variables(dataset, rng), app_url='')
+        url = urllib.parse.urlsplit(fill(request['url'], values))
+        query = url.query
+        if 'query' in values:
+            query = urllib.parse.urlencode(values['query'])
+        path = url.path + ('?' + query if query else '')
+        planned.append((label, request['method'], path, fill(request['body'], values), request['status']))
+    return planned
+
+
+def execute(client, planned, concurrency):
+    """Sends the planned requests from `concurrency` threads and returns samples and wall time."""
+    samples = []
+    queue = iter(planned)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            label, method, path, body, expected = item
+            status, _, elapsed, round_trips = client.send(method, path, body)
+            with lock:
+                samples.append((label, status, expected, elapsed, round_trips))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, wall_time):
+    """Aggregates samples per route and for the whole run."""
+    groups = {}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+    groups['total'] = samples
+
+    summary = {}
+    for label, group in sorted(groups.items()):
+        latencies = sorted(sample[3] for sample in group)
+        round_trips = [sample[4] for sample in group if sample[4] is not None]
+        summary[label] = {
+            'requests': len(group),
+            'errors': sum(1 for sample in group if sample[2] is not None and sample[1] != sample[2]),
+            'rps': round(len(group) / wall_time, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'db_round_trips': round(sum(round_trips) / len(round_trips), 2) if round_trips else None,
+        }
+    return summary
+
+
+def start_app(backend, server='wsgi', db_latency=0.0):
+    """Starts the app in a background thread on a local database stand-in and returns its URL."""
+    os.environ['STORAGE_BACKEND'] = backend
+    if backend == 'sqlite' and 'SQLITE_PATH' not in os.environ:
+        # A file, so that every server thread gets its own connection
+        os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='benchmark-'), 'benchmark.db')
+
+    import main
+
+    if server == 'asgi':
+        url = start_asgi_server()
+    else:
+        url = start_wsgi_server()
+    if main.db is not None:
+        install_round_trip_counter(main.app)
+        if db_latency:
+            install_db_latency(main.db, db_latency, server)
+    return url
+
+
+def start_wsgi_server():
+    from werkzeug.serving import make_server
+
+    import main
+    from migrations import migrate
+
+    main.init_db()
+    if main.db is not None:
+        migrate(main.db)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def start_asgi_server():
+    import socket
+
+    import uvicorn
+
+    import asgi
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(asgi.app, log_level='warning', backlog=4096))
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def install_db_latency(db, seconds, server):
+    """
+    Delays every statement by the network round trip to a remote database.
+
+    SQLite answers in microseconds, which hides how many requests a server
+    can keep waiting on Cloud SQL at once.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(db, 'before_cursor_execute')
+    def delay(conn, cursor, statement, parameters, context, executemany):
+        if server == 'asgi':
+            import asyncio
+
+            from sqlalchemy.util import await_only
+            await_only(asyncio.sleep(seconds))
+        else:
+            time.sleep(seconds)
+
+
+def install_connect_latency(db, seconds):
+    """Delays the opening of every connection, as the handshakes with Cloud SQL do."""
+    from sqlalchemy import event
+
+    @event.listens_for(db, 'connect')
+    def delay(dbapi_connection, connection_record):
+        time.sleep(seconds)
+
+
+def install_round_trip_counter(app):
+    """Reports the statements each request sent to the database in a response header."""
+    from flask import g
+
+    @app.after_request
+    def report_round_trips(response):
+        # Counted by the cursor hook of metrics.py
+        response.headers[ROUND_TRIPS_HEADER] = str(g.get('db_round_trips', 0))
+        return response
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_summary(summary, out=sys.stderr):
+    columns = ['requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'db_round_trips']
+    width = max(len(label) for label in summary)
+    print('{:<{}}  '.format('route', width) + '  '.join('{:>14}'.format(c) for c in columns), file=out)
+    for label, stats in summary.items():
+        print('{:<{}}  '.format(label, width) + '  '.join('{:>14}'.format(str(stats[c])) for c in columns), file=out)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    requests = load_collection()
+    base_url = args.url or start_app(args.backend, args.server, args.db_latency_ms / 1000.0)
+    client = Client(base_url)
+
+    dataset = seed(client, requests, args.businesses, args.reviews, rng)
+    if args.warmup:
+        execute(client, plan(args.mix, requests, dataset, args.warmup, rng), args.concurrency)
+    samples, wall_time = execute(client, plan(args.mix, requests, dataset, args.requests, rng), args.concurrency)
+
+    result = {
+        'meta': {
+            'mix': args.mix,
+            'backend': 'external' if args.url else args.backend,
+            'server': 'external' if args.url else args.server,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'businesses': args.businesses,
+            'reviews': args.reviews,
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'db_latency_ms': args.db_latency_ms,
+            'wall_time_s': round(wall_time, 3),
+        },
+        'routes': summarize(samples, wall_time),
+    }
+    print_summary(result['routes'])
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 1 if result['routes']['total']['errors'] else 0
+
+
+def serve(args):
+    """
+    Serves the app on a port like a gunicorn worker boots, for `startup`.
+
+    Prints the import time of main.py as a JSON line once it is known.
+    """
+    os.environ['STORAGE_BACKEND'] = args.backend
+    start = time.perf_counter()
+    import main
+    from migrations import migrate
+    print(json.dumps({'import_s': time.perf_counter() - start}), flush=True)
+
+    from werkzeug.serving import make_server
+
+    main.init_db()
+    if main.db is not None:
+        if args.connect_latency_ms:
+            install_connect_latency(main.db, args.connect_latency_ms / 1000.0)
+        main.start_pool_warmup()
+        migrate(main.db)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    make_server('127.0.0.1', args.port, main.app, threaded=True).serve_forever()
+
+
+def wait_for(client, path, deadline):
+    """Polls `path` until it answers 200 and returns when it did."""
+    while time.perf_counter() < deadline:
+        try:
+            if client.send('GET', path)[0] == 200:
+                return time.perf_counter()
+        except OSError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError('{} did not succeed in time'.format(path))
+
+
+def measure_startup(args, prewarm):
+    """Starts a server process and times it until its first requests are answered."""
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, DB_POOL_PREWARM=str(prewarm))
+    env.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(prefix='benchmark-'), 'benchmark.db'))
+    command = [sys.executable, os.path.abspath(__file__), 'serve', '--backend', args.backend, '--port', str(port),
+               '--connect-latency-ms', str(args.connect_latency_ms)]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        import_s = json.loads(process.stdout.readline())['import_s']
+        client = Client('http://127.0.0.1:{}'.format(port))
+        live = wait_for(client, '/healthz', start + 60)
+        ready = wait_for(client, '/readyz', start + 60)
+        # The first requests arrive together, as traffic does once the
+        # instance is ready
+        samples, _ = execute(client, [('first', 'GET', '/businesses', None, 200)] * args.concurrency, args.concurrency)
+        latencies = sorted(sample[3] for sample in samples)
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'prewarmed_connections': prewarm,
+        'import_ms': round(import_s * 1000, 1),
+        'live_ms': round((live - start) * 1000, 1),
+        'ready_ms': round((ready - start) * 1000, 1),
+        'first_requests_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'first_requests_max_ms': round(latencies[-1] * 1000, 3),
+        'errors': sum(1 for sample in samples if sample[1] != 200),
+    }
+
+
+def startup(args):
+    os.environ['STORAGE_BACKEND'] = args.backend
+    from pool_config import pool_settings
+
+    runs = [measure_startup(args, 0), measure_startup(args, pool_settings()['pool_size'])]
+    result = {
+        'meta': {
+            'backend': args.backend,
+            'concurrency': args.concurrency,
+            'connect_latency_ms': args.connect_latency_ms,
+            'revision': git_revision(),
+            'python': platform.python_version(),
+        },
+        'startup': runs,
+    }
+    columns = ['prewarmed_connections', 'import_ms', 'live_ms', 'ready_ms', 'first_requests_p50_ms', 'first_requests_max_ms']
+    print('  '.join('{:>22}'.format(c) for c in columns), file=sys.stderr)
+    for run_result in runs:
+        print('  '.join('{:>22}'.format(str(run_result[c])) for c in columns), file=sys.stderr)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 1 if any(run_result['errors'] for run_result in runs) else 0
+
+
+def diff(args):
+    """Compares two result files and fails when a route got slower than the threshold."""
+    with open(args.before) as f:
+        before = json.load(f)['routes']
+    with open(args.after) as f:
+        after = json.load(f)['routes']
+
+    regressions = 0
+    print('{:<32} {:>10} {:>10} {:>8}  {:>10} {:>10} {:>8}  {:>6} {:>6}'.format(
+        'route', 'p95 before', 'p95 after', 'change', 'rps before', 'rps after', 'change', 'rt', 'rt'
+    ))
+    for label in sorted(set(before) | set(after)):
+        if label not in before or label not in after:
+            print('{:<32} only in {}'.format(label, args.before if label in before else args.after))
+            continue
+        old, new = before[label], after[label]
+        p95_change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        rps_change = (new['rps'] - old['rps']) / old['rps'] * 100 if old['rps'] else 0.0
+        slower = p95_change > args.threshold
+        more_round_trips = (old['db_round_trips'] is not None and new['db_round_trips'] is not None
+                            and new['db_round_trips'] > old['db_round_trips'])
+        regressions += slower or more_round_trips
+        print('{:<32} {:>10} {:>10} {:>+7.1f}%  {:>10} {:>10} {:>+7.1f}%  {:>6} {:>6}{}'.format(
+            label, old['p95_ms'], new['p95_ms'], p95_change, old['rps'], new['rps'], rps_change,
+            str(old['db_round_trips']), str(new['db_round_trips']), '  REGRESSION' if slower or more_round_trips else ''
+        ))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Seed the database and replay a workload mix.')
+    run_parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    run_parser.add_argument('--backend', choices=['sqlite', 'memory'], default='sqlite',
+                            help='Local database stand-in of the in-process app.')
+    run_parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi',
+                            help='Serve the in-process app with the threaded WSGI server or asgi.py on uvicorn.')
+    run_parser.add_argument('--db-latency-ms', type=float, default=0.0,
+                            help='Simulated network latency added to every database statement.')
+    run_parser.add_argument('--url', help='Benchmark an app that is already running at this URL.')
+    run_parser.add_argument('--requests', type=int, default=2000)
+    run_parser.add_argument('--warmup', type=int, default=200)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--businesses', type=int, default=1000)
+    run_parser.add_argument('--reviews', type=int, default=3000)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--out', help='Write the JSON results to this file instead of stdout.')
+    run_parser.set_defaults(handler=run)
+
+    startup_parser = commands.add_parser('startup', help='Time the start of a server process and its first requests.')
+    startup_parser.add_argument('--backend', choices=['sqlite', 'memory'], default='sqlite')
+    startup_parser.add_argument('--connect-latency-ms', type=float, default=100.0,
+                                help='Simulated time to open a database connection.')
+    startup_parser.add_argument('--concurrency', type=int, default=8,
+                                help='Requests sent at once as soon as the server is ready.')
+    startup_parser.add_argument('--out', help='Write the JSON results to this file instead of stdout.')
+    startup_parser.set_defaults(handler=startup)
+
+    serve_parser = commands.add_parser('serve', help=argparse.SUPPRESS)
+    serve_parser.add_argument('--backend', choices=['sqlite', 'memory'], default='sqlite')
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--connect-latency-ms', type=float, default=0.0)
+    serve_parser.set_defaults(handler=serve)
+
+    diff_parser = commands.add_parser('diff', help='Compare two result files.')
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+    diff_parser.add_argument('--threshold', type=float, default=10.0,
+                             help='Allowed p95 latency increase per route, in percent.')
+    diff_parser.set_defaults(handler=diff)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """A cached resource together with its strong ETag."""
+
+    __slots__ = ('value', 'etag')
+
+    def __init__(self, value: dict, etag: str):
+        self.value = value
+        self.etag = etag
+
+
+def compute_etag(value: dict) -> str:
+    """Returns a strong ETag for the representation of a database row."""
+    raw = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class LocalBackend:
+    """
+    In-process LRU cache with a per-entry time to live.
+
+    Entries can be tagged so that everything depending on another resource
+    (e.g. the reviews of a business) is dropped with a single call.
+
+    Every delete ticks a clock and records the time of the key or tag. A
+    `set` given the `generation` its row was read at is dropped when the key
+    or one of its tags was deleted since. The times of at most `max_entries`
+    keys and tags are kept, older ones count as deleted at the newest time
+    forgotten.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._clock = 0
+        self._deleted_at = OrderedDict()
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        with self._lock:
+            return self._clock
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry, tags=(), generation=None):
+        with self._lock:
+            if generation is not None and any(
+                self._deleted_at.get(name, self._forgotten) > generation for name in (key,) + tags
+            ):
+                return
+            self._remove(key)
+            self._entries[key] = (entry, time.monotonic() + self.ttl, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._tick(key)
+            self._remove(key)
+
+    def delete_tag(self, tag):
+        with self._lock:
+            self._tick(tag)
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def _tick(self, name):
+        self._clock += 1
+        self._deleted_at.pop(name, None)
+        self._deleted_at[name] = self._clock
+        while len(self._deleted_at) > self.max_entries:
+            self._forgotten = self._deleted_at.popitem(last=False)[1]
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    """
+    Cache shared by every worker process through Redis.
+
+    Deletes tick a clock in Redis and record its time under a
+    `deleted:` key, which the conditional `set` script checks as
+    LocalBackend does. Requires the optional `redis` package.
+    """
+
+    CLOCK_KEY = 'cache:clock'
+
+    # KEYS: the entry, the deleted: key of the entry and of each tag, then
+    # the tags. ARGV: value, ttl, generation ('' for none), number of tags.
+    SET_SCRIPT = """
+    local tags = tonumber(ARGV[4])
+    if ARGV[3] ~= '' then
+        for i = 2, tags + 2 do
+            if tonumber(redis.call('get', KEYS[i]) or '0') > tonumber(ARGV[3]) then
+                return 0
+            end
+        end
+    end
+    redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2])
+    for i = tags + 3, #KEYS do
+        redis.call('sadd', KEYS[i], KEYS[1])
+        redis.call('expire', KEYS[i], ARGV[2])
+    end
+    return 1
+    """
+
+    # KEYS: the clock and the deleted: key. ARGV: ttl.
+    TICK_SCRIPT = """
+    local clock = redis.call('incr', KEYS[1])
+    redis.call('set', KEYS[2], clock, 'ex', ARGV[1])
+    return clock
+    """
+
+    def __init__(self, url: str, ttl: float):
+        import redis
+
+        self.ttl = int(ttl)
+        self._client = redis.Redis.from_url(url)
+        self._set = self._client.register_script(self.SET_SCRIPT)
+        self._tick = self._client.register_script(self.TICK_SCRIPT)
+
+    @property
+    def evictions(self):
+        return self._client.info('stats').get('evicted_keys', 0)
+
+    def generation(self):
+        return int(self._client.get(self.CLOCK_KEY) or 0)
+
+    def get(self, key):
+        raw = self._client.get(key)
+        if raw is None:
+            return None
+        value, etag = json.loads(raw)
+        return CacheEntry(value, etag)
+
+    def set(self, key, entry, tags=(), generation=None):
+        deleted = ['deleted:' + name for name in (key,) + tuple(tags)]
+        raw = json.dumps([entry.value, entry.etag], default=str)
+        self._set(
+            keys=[key, *deleted, *tags],
+            args=[raw, self.ttl, '' if generation is None else generation, len(tags)],
+        )
+
+    def delete(self, key):
+        self._tick(keys=[self.CLOCK_KEY, 'deleted:' + key], args=[self.ttl])
+        self._client.delete(key)
+
+    def delete_tag(self, tag):
+        self._tick(keys=[self.CLOCK_KEY, 'deleted:' + tag], args=[self.ttl])
+        keys = self._client.smembers(tag)
+        self._client.delete(tag, *keys)
+
+
+class EntityCache:
+    """
+    Read-through cache of single resources keyed by collection and id.
+
+    Handlers call `get` before querying the database, `set` after a miss,
+    and `invalidate` once a change or delete of the resource committed.
+    A miss takes the `generation` before it reads the row and passes it to
+    `set`, which then skips caching a row that an invalidation since may
+    have made stale.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, collection: str, resource_id: int):
+        if self.backend is None:
+            return None
+        entry = self.backend.get('{}:{}'.format(collection, resource_id))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def generation(self):
+        if self.backend is None:
+            return None
+        return self.backend.generation()
+
+    def set(self, collection: str, resource_id: int, value: dict, depends_on=(), generation=None) -> CacheEntry:
+        entry = CacheEntry(value, compute_etag(value))
+        if self.backend is not None:
+            tags = tuple('{}:{}:dependents'.format(c, i) for c, i in depends_on)
+            self.backend.set('{}:{}'.format(collection, resource_id), entry, tags, generation)
+        return entry
+
+    def invalidate(self, collection: str, resource_id: int, cascade=False):
+        if self.backend is None:
+            return
+        self.backend.delete('{}:{}'.format(collection, resource_id))
+        if cascade:
+            self.backend.delete_tag('{}:{}:dependents'.format(collection, resource_id))
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions if self.backend is not None else 0,
+        }
+
+
+def init_entity_cache(processes: int = 1) -> EntityCache:
+    """
+    Builds the entity cache of one of `processes` server processes from the
+    environment. Entries live CACHE_TTL seconds.
+
+    CACHE_REDIS_URL selects the shared backend. Without it, a lone process
+    keeps its own LRU of CACHE_MAX_ENTRIES entries, and a size of 0 disables
+    caching. Caching stays off when several processes serve requests: each
+    would only see its own invalidations and keep serving rows, and ETags,
+    that a write through another process changed. They give up the cache
+    rather than read-after-write consistency; share one through Redis instead.
+    """
+    ttl = float(os.environ.get('CACHE_TTL', '60'))
+    if os.environ.get('CACHE_REDIS_URL'):
+        return EntityCache(RedisBackend(os.environ['CACHE_REDIS_URL'], ttl))
+    max_entries = int(os.environ.get('CACHE_MAX_ENTRIES', '10000'))
+    if max_entries <= 0 or processes > 1:
+        return EntityCache(None)
+    return EntityCache(LocalBackend(max_entries, ttl))
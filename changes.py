@@ -0,0 +1,131 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+def long_poll_threads() -> int:
+    """Returns how many requests of a process may wait for changes at once, CHANGES_MAX_WAITERS."""
+    return int(os.environ.get('CHANGES_MAX_WAITERS', '4'))
+
+
+def latest_per_resource(changes):
+    """Keeps the newest entry of each resource, in the order of those entries."""
+    latest = {}
+    for change in changes:
+        key = (change['collection'], change['resource_id'])
+        latest.pop(key, None)
+        latest[key] = change
+    return list(latest.values())
+
+
+class ChangeFeed:
+    """
+    Reads the change log of a store for GET /changes.
+
+    On MySQL, transactions can commit out of id order, so an entry may show
+    up after entries with higher ids. A page therefore stops before the
+    first gap in the ids unless the entry after it is older than
+    `gap_seconds`: by then the gap is an id that was never committed.
+
+    `poll` waits up to a timeout for entries after a cursor. Writes in this
+    process wake it up through `notify`, writes of other processes are seen
+    by reading the log every `poll_interval` seconds. At most `max_waiters`
+    requests wait at once, so long polls cannot take every worker thread;
+    the others get their answer right away.
+    """
+
+    def __init__(self, gap_seconds: float, poll_interval: float, max_waiters: int):
+        self.gap_seconds = gap_seconds
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self.condition = threading.Condition()
+        self.version = 0
+        self.stopping = threading.Event()
+
+    def notify(self) -> None:
+        """Wakes up the requests waiting for changes, after a write of this process."""
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def settled(self, changes, after):
+        """Returns the leading entries of `changes` that no uncommitted entry can precede."""
+        now = time.time()
+        expected = after + 1
+        for i, change in enumerate(changes):
+            if change['id'] != expected and now - change['changed_at'] < self.gap_seconds:
+                return changes[:i]
+            expected = change['id'] + 1
+        return changes
+
+    def read(self, store, after: int, limit: int):
+        """Returns up to `limit` settled entries after the cursor `after`, and whether more follow."""
+        changes = store.list_changes(after, limit + 1)
+        settled = self.settled(changes, after)
+        more = len(settled) > limit
+        return settled[:limit], more
+
+    def poll(self, store, after: int, limit: int, timeout: float, pause=contextlib.nullcontext):
+        """
+        Reads entries after `after`, waiting up to `timeout` seconds for the
+        first one when there is none yet.
+
+        Every wait runs inside the context manager `pause`, which lets the
+        request give up resources it does not need while it waits.
+        """
+        changes, more = self.read(store, after, limit)
+        if changes or timeout <= 0:
+            return changes, more
+        with self.condition:
+            if self.waiters >= self.max_waiters:
+                return changes, more
+            self.waiters += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while not changes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with pause():
+                    with self.condition:
+                        version = self.version
+                        self.condition.wait_for(lambda: self.version != version, min(self.poll_interval, remaining))
+                changes, more = self.read(store, after, limit)
+        finally:
+            with self.condition:
+                self.waiters -= 1
+        return changes, more
+
+    def start_pruning(self, store, retention: float, interval: float) -> None:
+        """Drops entries older than `retention` seconds every `interval` seconds from a background thread."""
+        def run():
+            while not self.stopping.wait(interval):
+                try:
+                    pruned = store.prune_changes(time.time() - retention)
+                except Exception:
+                    logger.exception('Pruning the change log failed')
+                    continue
+                if pruned:
+                    logger.info('Pruned %d entries from the change log', pruned)
+
+        threading.Thread(target=run, name='change-log-pruning', daemon=True).start()
+
+
+def init_change_feed() -> ChangeFeed:
+    """
+    Builds the change feed from the environment.
+
+    CHANGES_GAP_SECONDS is how long a gap in the log ids is waited for,
+    CHANGES_POLL_INTERVAL how often waiting requests read the log, and
+    CHANGES_MAX_WAITERS how many of them may wait at once.
+    """
+    return ChangeFeed(
+        gap_seconds=float(os.environ.get('CHANGES_GAP_SECONDS', '2')),
+        poll_interval=float(os.environ.get('CHANGES_POLL_INTERVAL', '0.5')),
+        max_waiters=long_poll_threads(),
+    )
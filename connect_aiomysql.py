@@ -0,0 +1,46 @@
+import os
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from pool_config import pool_settings
+
+
+def connect_with_aiomysql() -> AsyncEngine:
+    """
+    Initializes an asyncio connection pool for a Cloud SQL instance of MySQL.
+
+    The Cloud SQL Python Connector only has an async driver for PostgreSQL,
+    so this connects through the Unix socket that Cloud Run mounts for the
+    instance (INSTANCE_UNIX_SOCKET, e.g. '/cloudsql/project:region:instance'),
+    or over TCP to INSTANCE_HOST (private IP or the Cloud SQL Auth Proxy).
+    """
+    db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
+    db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
+    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
+
+    if os.environ.get("INSTANCE_UNIX_SOCKET"):
+        url = sqlalchemy.engine.URL.create(
+            "mysql+aiomysql",
+            username=db_user,
+            password=db_pass,
+            database=db_name,
+            query={"unix_socket": os.environ["INSTANCE_UNIX_SOCKET"]},
+        )
+    else:
+        url = sqlalchemy.engine.URL.create(
+            "mysql+aiomysql",
+            username=db_user,
+            password=db_pass,
+            host=os.environ["INSTANCE_HOST"],  # e.g. '127.0.0.1'
+            port=int(os.environ.get("DB_PORT", "3306")),
+            database=db_name,
+        )
+
+    pool = create_async_engine(
+        url,
+        # SQLAlchemy opens these connections itself and sets CLIENT.FOUND_ROWS,
+        # so UPDATE reports matched rows as with connect_with_connector.
+        **pool_settings(),
+    )
+    return pool
@@ -14,25 +14,31 @@
 
 # [START cloud_sql_mysql_sqlalchemy_connect_connector]
 import os
+import threading
 
 from google.cloud.sql.connector import Connector, IPTypes
 import pymysql
+from pymysql.constants import CLIENT
 
 import sqlalchemy
 
+from pool_config import pool_settings
 
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+
+def connect_with_connector(instance_connection_name: str | None = None) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of MySQL.
 
-    Uses the Cloud SQL Python Connector package.
+    Uses the Cloud SQL Python Connector package. Connects to
+    INSTANCE_CONNECTION_NAME unless given another instance, such as a read
+    replica.
     """
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
 
-    instance_connection_name = os.environ[
+    instance_connection_name = instance_connection_name or os.environ[
         "INSTANCE_CONNECTION_NAME"
     ]  # e.g. 'project:region:instance'
     db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
@@ -41,15 +47,26 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
 
-    connector = Connector(ip_type)
+    # The Connector starts its own event loop thread and fetches certificates
+    # for the instance, so it is only built by the first connection, which
+    # the background pool warm-up opens off the startup path
+    connector = None
+    connector_lock = threading.Lock()
 
     def getconn() -> pymysql.connections.Connection:
+        nonlocal connector
+        with connector_lock:
+            if connector is None:
+                connector = Connector(ip_type)
         conn: pymysql.connections.Connection = connector.connect(
             instance_connection_name,
             "pymysql",
             user=db_user,
             password=db_pass,
             db=db_name,
+            # Report matched rather than changed rows for UPDATE statements,
+            # as SQLAlchemy does for connections it opens itself
+            client_flag=CLIENT.FOUND_ROWS,
         )
         return conn
 
@@ -58,19 +75,17 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         creator=getconn,
         # [START_EXCLUDE]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
         # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
         # new connection from the pool. After the specified amount of time, an
         # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
         # 'pool_recycle' is the maximum number of seconds a connection can persist.
         # Connections that live longer than the specified amount of time will be
         # re-established
-        pool_recycle=1800,  # 30 minutes
+        # Defaults are 5, 2, 30 seconds and 30 minutes, see pool_config.py.
+        **pool_settings(),
         # [END_EXCLUDE]
     )
     return pool
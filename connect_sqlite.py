@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import sqlalchemy
+from sqlalchemy import event
+
+from pool_config import pool_settings
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+def connect_sqlite(path: str, read_only: bool = False) -> sqlalchemy.engine.base.Engine:
+    """
+    Initializes a connection pool for a local SQLite database.
+
+    Used for offline development and profiling. `path` is a file name, or
+    ':memory:' for a private database that lives as long as the process.
+    A `read_only` pool stands in for a read replica: every write through it
+    fails. File pools are sized by `pool_settings`, like the MySQL ones.
+    """
+    if path == ':memory:':
+        # Every pooled connection to ':memory:' would open its own empty
+        # database, so the pool holds a single connection that is never
+        # recycled. Threads check it out in turn: sharing it at once would
+        # interleave their transactions.
+        pool = sqlalchemy.create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=pool_settings()['pool_timeout'],
+        )
+    elif read_only:
+        pool = sqlalchemy.create_engine(
+            'sqlite:///file:{}?mode=ro&uri=true'.format(path),
+            connect_args={'check_same_thread': False, 'timeout': 30},
+            poolclass=sqlalchemy.pool.QueuePool,
+            **pool_settings(),
+        )
+    else:
+        pool = sqlalchemy.create_engine(
+            'sqlite:///' + path,
+            connect_args={'check_same_thread': False, 'timeout': 30},
+            poolclass=sqlalchemy.pool.QueuePool,
+            **pool_settings(),
+        )
+
+    set_pragmas(pool, path, read_only)
+    return pool
+
+
+def connect_aiosqlite(path: str) -> AsyncEngine:
+    """
+    Initializes an asyncio connection pool for a local SQLite database.
+
+    The aiosqlite counterpart of `connect_sqlite`, for the ASGI app.
+    """
+    # The asyncio extension imports the ORM, which the WSGI app has no use
+    # for, so it is only loaded here
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    if path == ':memory:':
+        # Coroutines take turns on the single connection, as threads do
+        pool = create_async_engine(
+            'sqlite+aiosqlite://',
+            poolclass=sqlalchemy.pool.AsyncAdaptedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=pool_settings()['pool_timeout'],
+        )
+    else:
+        pool = create_async_engine(
+            'sqlite+aiosqlite:///' + path,
+            connect_args={'timeout': 30},
+            poolclass=sqlalchemy.pool.AsyncAdaptedQueuePool,
+            **pool_settings(),
+        )
+    set_pragmas(pool.sync_engine, path)
+    return pool
+
+
+def set_pragmas(pool: sqlalchemy.engine.base.Engine, path: str, read_only: bool = False) -> None:
+    @event.listens_for(pool, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to
+        cursor.execute('PRAGMA foreign_keys = ON')
+        if path != ':memory:' and not read_only:
+            # Readers do not block the writer and vice versa
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
@@ -0,0 +1,49 @@
+import sqlalchemy
+from sqlalchemy import event
+
+
+class FullScanError(RuntimeError):
+    """Raised in EXPLAIN mode when a query reads a whole table."""
+
+
+def find_full_scans(dbapi_conn, dialect, statement, parameters):
+    """Returns the tables that the database plans to read with a full table scan."""
+    cursor = dbapi_conn.cursor()
+    try:
+        if dialect == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            # 'SCAN businesses' reads the table, 'SCAN businesses USING INDEX ...'
+            # walks an index like MySQL's `index` access type. Scans of a
+            # VALUES list ('SCAN 7 CONSTANT ROWS') or of the subquery built
+            # from it ('MATERIALIZE pairs') read the statement's own rows.
+            details = [row[-1] for row in cursor.fetchall()]
+            subqueries = {detail.split()[1] for detail in details if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+            return [detail.split()[1] for detail in details
+                    if detail.startswith('SCAN ') and ' USING ' not in detail and not detail.endswith(' CONSTANT ROWS')
+                    and detail.split()[1] not in subqueries]
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        columns = [column[0] for column in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return [step['table'] for step in plan if step.get('type') == 'ALL']
+
+
+def install_explain_check(db: sqlalchemy.engine.base.Engine) -> None:
+    """
+    Runs EXPLAIN before every query and fails it if it would scan a table.
+
+    Meant for test runs (EXPLAIN_QUERIES=1) so that a query shape without a
+    supporting index is caught before it reaches production data volumes.
+    Connections with the execution option `explain_check=False` are exempt,
+    for the statements that must read whole tables, like migrations.
+    """
+    @event.listens_for(db, 'before_cursor_execute')
+    def check_plan(conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            return
+        if not context.execution_options.get('explain_check', True):
+            return
+        tables = find_full_scans(conn.connection.dbapi_connection, conn.dialect.name, statement, parameters)
+        if tables:
+            raise FullScanError('Full scan of {} in: {}'.format(', '.join(tables), statement))
@@ -0,0 +1,80 @@
+# Production server settings, loaded by `gunicorn main:app` from this directory.
+#
+# Every worker process owns its own connection pool, so the worker and
+# thread counts and the pool size (pool_config.py) are sized together:
+#
+#   WEB_CONCURRENCY   worker processes, defaults to the number of CPUs
+#   GUNICORN_THREADS  threads per worker, defaults to the pool capacity
+#                     (DB_POOL_SIZE + DB_MAX_OVERFLOW) plus the requests
+#                     admission control lets wait for a connection and a
+#                     few spare threads that answer the rest with 503,
+#                     plus the long polls of GET /changes (CHANGES_MAX_WAITERS)
+#
+# Workers refuse to boot when workers x MAX_INSTANCES x pool capacity does
+# not fit within the connection limit of the database.
+import logging
+import multiprocessing
+import os
+
+from admission import worker_threads
+from changes import long_poll_threads
+from pool_config import check_connection_budget, connection_budget, connections_per_process, get_max_connections
+
+logger = logging.getLogger('gunicorn.error')
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+# The in-memory store is private to its process, so it only works with one worker
+if os.environ.get('STORAGE_BACKEND') == 'memory':
+    workers = 1
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', worker_threads(connections_per_process()) + long_poll_threads()))
+
+# Give in-flight requests time to finish on redeploys
+graceful_timeout = 30
+
+
+def on_starting(server):
+    logger.info(
+        'Starting %d workers x %d threads, up to %d database connections in total',
+        server.cfg.workers, server.cfg.threads, connection_budget(server.cfg.workers)
+    )
+
+
+# The engine is created in each worker after the fork: pooled connections and
+# the Cloud SQL connector's background thread cannot be shared across processes
+def post_worker_init(worker):
+    import main
+    from cache import init_entity_cache
+    from migrations import migrate
+
+    # A cache private to each of several workers would serve rows another
+    # worker changed, so it is only kept with one worker or shared in Redis
+    main.entity_cache = init_entity_cache(worker.cfg.workers)
+    main.init_db()
+    main.start_change_pruning()
+    if main.db is None:
+        return
+    # Connections are opened in the background while the schema is checked,
+    # and /readyz reports when they are
+    main.start_pool_warmup()
+    # A no-op once the schema is current, and workers booting at the same time
+    # wait for each other on the migration lock
+    migrate(main.db)
+    max_connections = get_max_connections(main.db)
+    if max_connections is not None:
+        check_connection_budget(worker.cfg.workers, max_connections)
+
+
+def worker_exit(server, worker):
+    import main
+
+    if main.review_queue is not None:
+        main.review_queue.stop()
+    if main.db is not None:
+        main.db.dispose()
+    if main.replica_db is not None:
+        main.replica_db.dispose()
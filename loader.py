@@ -0,0 +1,56 @@
+from cache import CacheEntry, EntityCache, compute_etag
+
+
+class Loader:
+    """
+    Fetches the resources one request references, each at most once.
+
+    `load` takes every id a response needs at once: ids already loaded are
+    skipped, the entity cache answers what it holds and the rest comes from
+    a single call to `fetch`, which returns the rows of the ids that exist.
+    Loaded resources are then read with `get` or `entry`. A loader lives for
+    one request, so it never serves rows another request changed. With
+    `refresh`, every id is fetched and the cache only updated. Without
+    `fill`, fetched rows are not cached, for fetches from a read replica
+    whose rows may lag behind.
+    """
+
+    def __init__(self, cache: EntityCache, collection: str, fetch, refresh: bool = False, fill: bool = True):
+        self.cache = cache
+        self.collection = collection
+        self.fetch = fetch
+        self.refresh = refresh
+        self.fill = fill
+        # CacheEntry by id, None for ids that do not exist
+        self.entries = {}
+
+    def load(self, resource_ids) -> None:
+        misses = []
+        for resource_id in dict.fromkeys(resource_ids):
+            if resource_id in self.entries:
+                continue
+            entry = None if self.refresh else self.cache.get(self.collection, resource_id)
+            if entry is None:
+                misses.append(resource_id)
+            else:
+                self.entries[resource_id] = entry
+        if not misses:
+            return
+        generation = self.cache.generation()
+        for row in self.fetch(misses):
+            if self.fill:
+                self.entries[row['id']] = self.cache.set(self.collection, row['id'], row, generation=generation)
+            else:
+                self.entries[row['id']] = CacheEntry(row, compute_etag(row))
+        for resource_id in misses:
+            self.entries.setdefault(resource_id, None)
+
+    def entry(self, resource_id: int):
+        """The loaded CacheEntry of a resource, or None when it does not exist."""
+        self.load([resource_id])
+        return self.entries[resource_id]
+
+    def get(self, resource_id: int):
+        """A copy of the loaded row of a resource, or None when it does not exist."""
+        entry = self.entry(resource_id)
+        return None if entry is None else dict(entry.value)
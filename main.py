@@ -1,13 +1,39 @@
 from __future__ import annotations
 
+import contextlib
+import functools
 import logging
+import math
 import os
+import time
+import urllib.parse
 
-from flask import Flask, request
+import click
+from flask import Flask, g, request
 
 import sqlalchemy
 
-from connect_connector import connect_with_connector
+from admission import BULK, READ, WRITE, Shed, init_admission
+from batch import BATCH_CHUNK_SIZE, NDJSON_MIMETYPE, InvalidBatch, chunked, iter_batch_items
+from cache import CacheEntry, compute_etag, init_entity_cache
+from changes import init_change_feed, latest_per_resource
+from connect_sqlite import connect_sqlite
+from explain import install_explain_check
+from json_provider import init_json_provider
+from loader import Loader
+from metrics import PROMETHEUS_CONTENT_TYPE, Gauge, install_request_metrics, instrument_engine, registry, render_metrics
+from migrations import migrate, pending_migrations
+from pagination import DEFAULT_PAGE_LIMIT, InvalidCursor, count_cache, decode_cursor, encode_cursor
+from pool_config import PoolWarmup, connections_per_process, prewarm_connections
+from review_queue import CREATED, QueueFull, init_review_queue, normalize_review
+from serializers import (
+    BUSINESS_FIELD_COLUMNS, BUSINESS_FIELDS, REVIEW_EXPANSIONS, REVIEW_FIELD_COLUMNS, REVIEW_FIELDS, InvalidExpand,
+    InvalidFields, Serializer, average_stars, field_columns, parse_expand, parse_fields
+)
+from storage import (
+    BUSINESS_FILTERS, DELETED, STAR_COLUMNS, BusinessNotFound, DuplicateReview, MemoryStore, ReplicaStore, SqlStore, check_review,
+    normalize_stars, rating_milli
+)
 
 BUSINESSES = 'businesses'
 REVIEWS = 'reviews'
@@ -15,65 +41,464 @@ USERS = 'users'
 ERROR_NOT_FOUND_REVIEW = {'Error': 'No review with this review_id exists'}
 ERROR_NOT_FOUND_BUSINESS = {'Error': 'No business with this business_id exists'}
 ERROR_MISSING_ATTRIBUTES = {'Error': 'The request body is missing at least one of the required attributes'}
+ERROR_INVALID_CURSOR = {'Error': 'The pagination cursor is invalid'}
+ERROR_INVALID_BATCH = {'Error': 'The request body must be a JSON array or newline-delimited JSON'}
+ERROR_INVALID_SORT = {'Error': 'The sort order must be id, rating or name'}
+ERROR_INVALID_SEARCH = {'Error': 'Searches by name prefix are sorted by name'}
+ERROR_INVALID_FILTER = {'Error': 'The owner_id filter must be an integer'}
+ERROR_INVALID_FIELDS = {'Error': 'The fields parameter names an unknown attribute'}
+ERROR_INVALID_EXPAND = {'Error': 'The expand parameter names an unknown link'}
+ERROR_INVALID_IDS = {'Error': 'The ids parameter must be a comma-separated list of business ids'}
+ERROR_TOO_MANY_IDS = {'Error': 'The ids parameter lists more businesses than one request may get'}
+ERROR_NOT_FOUND_QUEUED_REVIEW = {'Error': 'No queued review with this id exists'}
+ERROR_INVALID_REVIEW = {'Error': 'The review has an invalid user_id, business_id, stars or review_text'}
+ERROR_QUEUE_FULL = {'Error': 'Too many reviews are waiting to be saved. Please retry later'}
+ERROR_REVIEW_FAILED = {'Error': 'The review could not be saved'}
+ERROR_BUSINESS_FAILED = {'Error': 'Unable to create business'}
+ERROR_CHANGES_EXPIRED = {'Error': 'The changes after this cursor are no longer kept. Please sync again from the start'}
+ERROR_OVERLOADED = {'Error': 'The service is overloaded. Please retry later'}
 ERROR_CONFLICT_REVIEW = {'Error': 'You have already submitted a review for this business. You can update your previous review, or delete it and submit a new review'}
 OWNERS = 'owners'
+BUSINESS_ATTRIBUTES = ['owner_id', 'name', 'street_address', 'city', 'state', 'zip_code']
+REVIEW_ATTRIBUTES = ['user_id', 'business_id', 'stars']
 
 app = Flask(__name__)
+# Per-route latency and database round trips, served at /metrics
+install_request_metrics(app)
+init_json_provider(app)
 
 logger = logging.getLogger()
 
+# Number of rows fetched from the server-side cursor per streamed chunk
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', '500'))
+
+# Most businesses one GET /businesses?ids= may ask for
+MAX_MULTI_GET_IDS = int(os.environ.get('MAX_MULTI_GET_IDS', '100'))
+
+# Read-through cache of single businesses and reviews. gunicorn.conf.py
+# rebuilds it for the number of workers.
+entity_cache = init_entity_cache()
+
+# Write-behind queue of POST /reviews, `None` unless REVIEW_QUEUE_PATH is set
+review_queue = init_review_queue(BATCH_CHUNK_SIZE)
+# Seconds a client is asked to wait before retrying when the queue is full
+REVIEW_QUEUE_RETRY_AFTER = 1
+
+# Change log of all writes, read through GET /changes
+change_feed = init_change_feed()
+# Entries per page of GET /changes by default and at most, and the longest
+# a request may wait for new ones with ?wait=
+CHANGES_PAGE_LIMIT = int(os.environ.get('CHANGES_PAGE_LIMIT', '100'))
+MAX_CHANGES_LIMIT = int(os.environ.get('MAX_CHANGES_LIMIT', '1000'))
+CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', '25'))
+# Seconds entries are kept in the change log, 7 days by default, and
+# seconds between two prunings
+CHANGES_RETENTION = float(os.environ.get('CHANGES_RETENTION', '604800'))
+CHANGES_PRUNE_INTERVAL = float(os.environ.get('CHANGES_PRUNE_INTERVAL', '60'))
+
+# Seconds a client is asked to wait before retrying a shed request
+ADMISSION_RETRY_AFTER = 1
+# Routes that never use the database, which admission control lets through
+ADMISSION_EXEMPT = {'index', 'healthz', 'readyz', 'get_metrics', 'get_cache_stats', 'get_admission_stats', 'get_queued_review'}
+# Routes that write many resources at once, which yield to the other requests
+BULK_ROUTES = {'post_businesses_batch', 'post_reviews_batch'}
+
+# Storage backend: 'mysql' (Cloud SQL), 'sqlite' (SQLITE_PATH) or 'memory'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mysql')
+
+# Clients that wrote read from the primary for this many seconds afterwards,
+# longer than the replica lags behind. The cookie holds the end of the window.
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+REPLICA_PIN_COOKIE = 'read_primary_until'
+# Seconds between two probes of the read replica
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', '5'))
+
 # Sets up connection pool for the app
 def init_connection_pool() -> sqlalchemy.engine.base.Engine:
+    if STORAGE_BACKEND == 'sqlite':
+        return connect_sqlite(os.environ.get('SQLITE_PATH', ':memory:'))
+
     if os.environ.get('INSTANCE_CONNECTION_NAME'):
+        # The Cloud SQL connector takes longer to import than the rest of
+        # the app, so it is only imported when it connects
+        from connect_connector import connect_with_connector
         return connect_with_connector()
         
     raise ValueError(
         'Missing database connection type. Please define INSTANCE_CONNECTION_NAME'
     )
 
-# This global variable is declared with a value of `None`
+# Sets up the connection pool of the read replica, `None` without one
+# REPLICA_CONNECTION_NAME names a Cloud SQL read replica of the instance.
+# Locally REPLICA_SQLITE_PATH opens a SQLite file read-only as a stand-in:
+# SQLITE_PATH itself, or a copy of it that lags behind.
+def init_replica_pool() -> sqlalchemy.engine.base.Engine | None:
+    if STORAGE_BACKEND == 'sqlite':
+        path = os.environ.get('REPLICA_SQLITE_PATH')
+        return connect_sqlite(path, read_only=True) if path else None
+    if os.environ.get('REPLICA_CONNECTION_NAME'):
+        from connect_connector import connect_with_connector
+        return connect_with_connector(os.environ['REPLICA_CONNECTION_NAME'])
+    return None
+
+# These global variables are declared with a value of `None`
+# `db` stays `None` with the in-memory store, `replica_db` and `read_store`
+# without a read replica
 db = None
+store = None
+replica_db = None
+read_store = None
+# Background warm-up of the connection pools, `None` until it is started
+pool_warmup = None
+# Admission control of the database, `None` with the in-memory store or
+# when ADMISSION_CONTROL=0
+admission = None
+
+# Called by the review queue with each review it wrote
+def review_written(review):
+    # The aggregates of a business change with every review written
+    entity_cache.invalidate(BUSINESSES, review['business_id'])
+    change_feed.notify()
 
 # Initiates connection to database
-def init_db():
-    global db
-    db = init_connection_pool()
-
-def create_tables(db: sqlalchemy.engine.base.Engine) -> None:
-    with db.connect() as conn:
-        # Drop existing tables to avoid conflicts
-        conn.execute(sqlalchemy.text('DROP TABLE IF EXISTS reviews;'))
-        conn.execute(sqlalchemy.text('DROP TABLE IF EXISTS businesses;'))
-        
-        # Create businesses table with id as UNSIGNED INTEGER
-        conn.execute(
-            sqlalchemy.text(
-                'CREATE TABLE IF NOT EXISTS businesses ('
-                'id INTEGER UNSIGNED NOT NULL AUTO_INCREMENT, '
-                'owner_id INTEGER NOT NULL, '
-                'name VARCHAR(50) NOT NULL, '
-                'street_address VARCHAR(100) NOT NULL, '
-                'city VARCHAR(50) NOT NULL, '
-                'state VARCHAR(2) NOT NULL, '
-                'zip_code VARCHAR(10) NOT NULL, '  # Changed to VARCHAR for zip codes
-                'PRIMARY KEY (id) );'
-            )
+# asgi.py passes the sync facade of its async engine instead
+def init_db(engine: sqlalchemy.engine.base.Engine | None = None):
+    global db, store, replica_db, read_store, admission
+    if STORAGE_BACKEND == 'memory':
+        store = MemoryStore()
+    else:
+        db = engine if engine is not None else init_connection_pool()
+        store = SqlStore(db)
+        instrument_engine(db)
+        # One request holds at most one connection at a time
+        admission = init_admission(connections_per_process())
+        replica_db = init_replica_pool()
+        if replica_db is not None:
+            instrument_engine(replica_db, 'db_replica_pool')
+            read_store = ReplicaStore(store, SqlStore(replica_db))
+            read_store.start_health_checks(REPLICA_CHECK_INTERVAL)
+            registry.register(Gauge(
+                'db_replica_healthy', 'Whether reads go to the replica (1) or fall back to the primary (0).',
+                lambda: int(read_store.healthy)
+            ))
+        # Test mode: fail every query whose plan contains a full table scan
+        if os.environ.get('EXPLAIN_QUERIES'):
+            for pool in (db, replica_db):
+                if pool is not None:
+                    install_explain_check(pool)
+    if review_queue is not None:
+        review_queue.start(store, on_created=review_written)
+
+# Opens DB_POOL_PREWARM connections of each pool in the background, so that
+# the first requests do not pay for the handshakes. /readyz fails until the
+# primary pool is warm.
+def start_pool_warmup():
+    global pool_warmup
+    if db is None:
+        return
+    pool_warmup = PoolWarmup(db, prewarm_connections(), [replica_db] if replica_db is not None else [])
+    pool_warmup.start()
+    registry.register(Gauge(
+        'db_pool_warmup_seconds', 'Time it took to open the pre-warmed connections.', lambda: pool_warmup.seconds
+    ))
+
+# Drops expired entries of the change log in the background
+def start_change_pruning():
+    change_feed.start_pruning(store, CHANGES_RETENTION, CHANGES_PRUNE_INTERVAL)
+
+# Applies pending schema migrations from the command line
+# Usage: flask --app main migrate
+@app.cli.command('migrate', help='Apply pending schema migrations.')
+@click.option('--dry-run', is_flag=True, help='Only list the pending migrations.')
+def migrate_command(dry_run):
+    init_db()
+    if db is None:
+        click.echo('The {} backend has no schema'.format(STORAGE_BACKEND))
+        return
+    if dry_run:
+        with db.connect() as conn:
+            for version, description, _ in pending_migrations(conn):
+                click.echo('{}: {}'.format(version, description))
+        return
+    click.echo('Schema is at version {}'.format(migrate(db)))
+
+# Recomputes the review aggregates of every business when they have drifted
+# Usage: flask --app main repair-stats
+@app.cli.command('repair-stats', help='Recompute the review aggregates of all businesses.')
+def repair_stats_command():
+    init_db()
+    click.echo('Recomputed the review aggregates of {} businesses'.format(store.repair_business_stats()))
+
+# Drops the entries of the change log older than CHANGES_RETENTION, for
+# deployments that prune from a scheduled job
+# Usage: flask --app main prune-changes
+@app.cli.command('prune-changes', help='Drop expired entries of the change log.')
+def prune_changes_command():
+    init_db()
+    click.echo('Pruned {} entries of the change log'.format(store.prune_changes(time.time() - CHANGES_RETENTION)))
+
+# Type of each sort key a cursor may hold
+CURSOR_KEY_TYPES = {'id': int, 'rating': int, 'name': str}
+
+# Sort keys of each order of GET /businesses, the last one is always the id
+BUSINESS_SORT_KEYS = {'id': ('id',), 'rating': ('rating', 'id'), 'name': ('name', 'id')}
+# Columns the cursors of each order are made of
+BUSINESS_SORT_COLUMNS = {'id': ['id'], 'rating': ['review_count', 'star_sum'], 'name': ['name']}
+
+# Reads the keyset pagination parameters of a listing request.
+# Returns None when the client did not ask for keyset pagination.
+# Listings sorted on several keys take `keys` and get a tuple, or None on
+# the first page.
+def get_keyset_args(paged_by_default=False, keys=('id',)):
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', type=int)
+    if cursor is None and (limit is None or not paged_by_default):
+        return None
+    position = decode_cursor(cursor)
+    if not all(isinstance(position.get(key, CURSOR_KEY_TYPES[key]()), CURSOR_KEY_TYPES[key]) for key in keys):
+        raise InvalidCursor(cursor)
+    if len(keys) == 1:
+        after = position.get(keys[0], 0)
+    elif not position:
+        after = None
+    elif all(key in position for key in keys):
+        after = tuple(position[key] for key in keys)
+    else:
+        raise InvalidCursor(cursor)
+    return after, max(limit, 1) if limit is not None else DEFAULT_PAGE_LIMIT
+
+# Builds a keyset page from rows fetched with LIMIT :limit + 1
+# `positions` holds the cursor of each entry, read from the rows before
+# `fields` may have projected the sort keys away
+def keyset_page(entries, limit, path, positions, query=''):
+    response_body = {'entries': entries[:limit]}
+    if len(entries) > limit:
+        token = encode_cursor(positions[limit - 1])
+        response_body['next'] = request.url_root.strip('/') + '{}?cursor={}&limit={}{}'.format(path, token, limit, query)
+    return response_body
+
+# Reads the filters of a business listing, None when one is invalid
+def get_business_filters():
+    filters = {column: request.args[column] for column in BUSINESS_FILTERS if column in request.args}
+    if 'owner_id' in filters:
+        try:
+            filters['owner_id'] = int(filters['owner_id'])
+        except ValueError:
+            return None
+    return filters
+
+# Serializer of the current request, limited to the `fields` it asked for
+def get_serializer(allowed_fields):
+    return Serializer(request.url_root, parse_fields(request.args.get('fields'), allowed_fields))
+
+# True when the client wrote within the last REPLICA_PIN_SECONDS, so that
+# its reads go to the primary and see its own writes
+def pinned_to_primary():
+    if read_store is None:
+        return False
+    try:
+        return float(request.cookies.get(REPLICA_PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+# Store that serves the reads of the current request: the replica for GET
+# requests of clients that are not pinned to the primary
+def get_read_store():
+    if read_store is None or request.method not in ('GET', 'HEAD') or pinned_to_primary():
+        return store
+    return read_store
+
+# Cached resource for the current request. Pinned clients skip the cache,
+# which another worker may not have invalidated yet, and refresh it with the
+# row of the primary.
+def get_cached(collection, resource_id):
+    if pinned_to_primary():
+        return None
+    return entity_cache.get(collection, resource_id)
+
+# Entry of a row the current request read after a cache miss at
+# `generation`. Only rows of the primary are cached: a row of the lagging
+# replica could be older than a write the cache was already invalidated for,
+# and would outlive the read-your-writes window of the writer.
+def cache_row(reader, collection, resource_id, row, generation, depends_on=()):
+    if reader is not store:
+        return CacheEntry(row, compute_etag(row))
+    return entity_cache.set(collection, resource_id, row, depends_on=depends_on, generation=generation)
+
+# Starts the read-your-writes window of a client after each successful write
+@app.after_request
+def pin_writers_to_primary(response):
+    if read_store is not None and request.method not in ('GET', 'HEAD') and response.status_code < 400:
+        response.set_cookie(
+            REPLICA_PIN_COOKIE, '{:.3f}'.format(time.time() + REPLICA_PIN_SECONDS),
+            max_age=math.ceil(REPLICA_PIN_SECONDS), httponly=True, samesite='Lax'
         )
-        # Create reviews table with business_id as UNSIGNED INTEGER
-        conn.execute(
-            sqlalchemy.text(
-                'CREATE TABLE IF NOT EXISTS reviews ('
-                'id INTEGER UNSIGNED NOT NULL AUTO_INCREMENT, '
-                'user_id INTEGER NOT NULL, '
-                'business_id INTEGER UNSIGNED NOT NULL, '
-                'stars INTEGER NOT NULL CHECK (stars >= 0 AND stars <= 5), '  # Added CHECK constraint
-                'review_text VARCHAR(1000), '
-                'PRIMARY KEY (id), '
-                'FOREIGN KEY (business_id) REFERENCES businesses(id) ON DELETE CASCADE, '
-                'UNIQUE (user_id, business_id) );'
-            )
+    return response
+
+# Priority class of the current request under admission control
+def admission_priority():
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return READ
+    return BULK if request.endpoint in BULK_ROUTES else WRITE
+
+# Waits for a database slot before the handler runs, or sheds the request
+# with 503 right away when the pool is at capacity and the queue is full,
+# instead of letting it wait pool_timeout seconds for a connection
+@app.before_request
+def admit_request():
+    if admission is None or request.url_rule is None or request.endpoint in ADMISSION_EXEMPT:
+        return None
+    priority = admission_priority()
+    if not admission.acquire(priority):
+        return ERROR_OVERLOADED, 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+    g.admission_priority = priority
+    return None
+
+# Streamed responses keep querying the database until the last chunk is
+# sent, so their slot is only released when the response is closed
+@app.after_request
+def release_on_close(response):
+    if response.is_streamed and 'admission_priority' in g:
+        response.call_on_close(functools.partial(admission.release, g.pop('admission_priority')))
+    return response
+
+# Gives up the database slot of the current request while it waits for
+# something else, such as new changes, and takes a slot again afterwards
+@contextlib.contextmanager
+def without_admission_slot():
+    priority = g.pop('admission_priority', None)
+    if priority is None:
+        yield
+        return
+    admission.release(priority)
+    try:
+        yield
+    finally:
+        if not admission.acquire(priority):
+            raise Shed()
+        g.admission_priority = priority
+
+# Releases the slot of every other admitted request once it is handled
+@app.teardown_request
+def release_admission(e):
+    priority = g.pop('admission_priority', None)
+    if priority is not None:
+        admission.release(priority)
+
+# Wakes up the requests waiting on GET /changes after each successful write
+@app.after_request
+def notify_change_feed(response):
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400:
+        change_feed.notify()
+    return response
+
+# Loader of the businesses the current request references, so that each is
+# fetched once however many reviews embed it
+def get_business_loader():
+    if 'business_loader' not in g:
+        reader = get_read_store()
+        g.business_loader = Loader(
+            entity_cache, BUSINESSES, reader.get_businesses, refresh=pinned_to_primary(), fill=reader is store
         )
-        conn.commit()
+    return g.business_loader
+
+# Serializer of review responses, which embeds their businesses when asked
+# for with ?expand=business
+def get_review_serializer():
+    fields = parse_fields(request.args.get('fields'), REVIEW_FIELDS)
+    expand = parse_expand(request.args.get('expand'), REVIEW_EXPANSIONS)
+    return Serializer(request.url_root, fields, get_business_loader() if 'business' in expand else None)
+
+# Query string that next links keep, made of the listed arguments the request has
+def listing_query(names):
+    listing_args = {name: request.args[name] for name in names if name in request.args}
+    return '&' + urllib.parse.urlencode(listing_args) if listing_args else ''
+
+# Returns a representation with its ETag, or a bodyless 304 when the client
+# already holds it
+def conditional_response(etag, body):
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.make_response((body, 200))
+    response.set_etag(etag)
+    return response
+
+# Liveness probe: the process serves requests
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return {'status': 'ok'}, 200
+
+# Readiness probe: the store is set up and its connections are open, so
+# traffic should only be sent once this succeeds
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if store is None:
+        return {'status': 'starting'}, 503
+    if pool_warmup is not None and not pool_warmup.ready.is_set():
+        response_body = {'status': 'warming'}
+        if pool_warmup.error is not None:
+            response_body['error'] = pool_warmup.error
+        return response_body, 503
+    return {'status': 'ready'}, 200
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return entity_cache.stats(), 200
+
+@app.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    if admission is None:
+        return {'enabled': False}, 200
+    return dict(admission.stats(), enabled=True), 200
+
+# Pool, statement and request metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+# True when the client asked for the listing as a newline-delimited JSON stream
+def wants_stream():
+    return request.args.get('stream') in ('1', 'true') or request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+# Streams chunks of rows from the store as NDJSON while they arrive
+def stream_rows(chunks, to_resources):
+    def generate():
+        for rows in chunks:
+            yield ''.join(app.json.dumps(resource) + '\n' for resource in to_resources(rows))
+
+    return app.response_class(generate(), mimetype=NDJSON_MIMETYPE)
+
+# Checks a request body or batch item against the required attributes
+def has_required_attributes(content, required_attributes):
+    return isinstance(content, dict) and all(attr in content for attr in required_attributes)
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    return ERROR_INVALID_CURSOR, 400
+
+@app.errorhandler(InvalidFields)
+def invalid_fields(e):
+    return ERROR_INVALID_FIELDS, 400
+
+@app.errorhandler(InvalidExpand)
+def invalid_expand(e):
+    return ERROR_INVALID_EXPAND, 400
+
+# The pool had no free connection within pool_timeout, e.g. while background
+# threads hold some of them
+@app.errorhandler(sqlalchemy.exc.TimeoutError)
+def pool_timeout(e):
+    logger.warning('Timed out waiting for a database connection: %s', e)
+    return ERROR_OVERLOADED, 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+@app.errorhandler(Shed)
+def shed(e):
+    return ERROR_OVERLOADED, 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+@app.errorhandler(InvalidBatch)
+def invalid_batch(e):
+    return ERROR_INVALID_BATCH, 400
 
 @app.route('/')
 def index():
@@ -84,340 +509,543 @@ def index():
 def post_businesses():
     content = request.get_json()
 
-    required_attributes = ['owner_id', 'name', 'street_address', 'city', 'state', 'zip_code']
-
     # Check if any required attribute is missing
-    if not content or not all(attr in content for attr in required_attributes):
+    if not has_required_attributes(content, BUSINESS_ATTRIBUTES):
         return ERROR_MISSING_ATTRIBUTES, 400
 
     try:
-        with db.connect() as conn:
-            # Insert the new business into the database
-            stmt = sqlalchemy.text(
-                'INSERT INTO businesses (owner_id, name, street_address, city, state, zip_code) '
-                'VALUES (:owner_id, :name, :street_address, :city, :state, :zip_code)'
-            )
-            conn.execute(stmt, parameters={
-                'owner_id': content['owner_id'],
-                'name': content['name'],
-                'street_address': content['street_address'],
-                'city': content['city'],
-                'state': content['state'],
-                'zip_code': content['zip_code']
-            })
-            # Get the last inserted id
-            stmt2 = sqlalchemy.text('SELECT LAST_INSERT_ID()')
-            business_id = conn.execute(stmt2).scalar()
-            conn.commit()
-
-            # Construct the 'self' URL
-            business_url = request.url_root.strip('/') + '/businesses/' + str(business_id)
-
-            response_body = {
-                'id': business_id,
-                'owner_id': content['owner_id'],
-                'name': content['name'],
-                'street_address': content['street_address'],
-                'city': content['city'],
-                'state': content['state'],
-                'zip_code': content['zip_code'],
-                'self': business_url
-            }
-            return response_body, 201
+        # Insert the new business into the database
+        business_id = store.create_business(content)
+
+        # Construct the 'self' URL
+        business_url = request.url_root.strip('/') + '/businesses/' + str(business_id)
+
+        response_body = {
+            'id': business_id,
+            'owner_id': content['owner_id'],
+            'name': content['name'],
+            'street_address': content['street_address'],
+            'city': content['city'],
+            'state': content['state'],
+            'zip_code': content['zip_code'],
+            'self': business_url
+        }
+        return response_body, 201
     except Exception as e:
         logger.exception(e)
-        return {'Error': 'Unable to create business'}, 500
+        return ERROR_BUSINESS_FAILED, 500
+
+# Writes a chunk of batch items with `write`, a store method that takes a
+# list of them, and returns its outcome for each item. A chunk that fails as
+# a whole, e.g. on a value the database rejects, is written again item by
+# item, and the items that fail alone get None.
+def write_batch_chunk(write, items):
+    try:
+        return write(items)
+    except Exception:
+        logger.exception('Writing a batch chunk of %d items failed, writing them one by one', len(items))
+    outcomes = []
+    for item in items:
+        try:
+            outcomes.extend(write([item]))
+        except Exception as e:
+            logger.exception(e)
+            outcomes.append(None)
+    return outcomes
+
+# Create many businesses at once from a JSON array or NDJSON stream
+# Every chunk of items is written with one multi-row INSERT and one commit.
+# Batches are not atomic: the response holds the status of every item, and
+# the items created before one failed stay created.
+@app.route('/' + BUSINESSES + '/batch', methods=['POST'])
+def post_businesses_batch():
+    business_url = request.url_root.strip('/') + '/businesses/'
+    results = []
+    for chunk in chunked(iter_batch_items(request)):
+        valid = []
+        for content in chunk:
+            if has_required_attributes(content, BUSINESS_ATTRIBUTES):
+                valid.append((len(results), content))
+                results.append(None)
+            else:
+                results.append(dict(ERROR_MISSING_ATTRIBUTES, status=400))
+        if not valid:
+            continue
+
+        business_ids = write_batch_chunk(store.create_businesses, [content for _, content in valid])
+        for business_id, (index, content) in zip(business_ids, valid):
+            if business_id is None:
+                results[index] = dict(ERROR_BUSINESS_FAILED, status=500)
+                continue
+            business = {attr: content[attr] for attr in BUSINESS_ATTRIBUTES}
+            business['id'] = business_id
+            business['self'] = business_url + str(business_id)
+            business['status'] = 201
+            results[index] = business
+
+    return {'results': results}, 200
 
 # Get all businesses with optional pagination
+# Clients page by offset and get offset links, unless they send a `cursor`
+# (an empty one starts at the beginning): then pages are keyset pages whose
+# `next` links carry an opaque cursor. In id order, with `sort=rating` from the best to the worst average rating, or
+# with `sort=name` by name. `city`, `state`, `zip_code` and `owner_id` filter
+# the businesses, and `q` searches the beginnings of their names (typeahead).
 @app.route('/' + BUSINESSES, methods=['GET'])
 def get_businesses():
+    if 'ids' in request.args:
+        return get_businesses_by_ids()
+    prefix = request.args.get('q', '')
+    sort = request.args.get('sort', 'name' if prefix else 'id')
+    if sort not in BUSINESS_SORT_KEYS:
+        return ERROR_INVALID_SORT, 400
+    if prefix and sort != 'name':
+        return ERROR_INVALID_SEARCH, 400
+    filters = get_business_filters()
+    if filters is None:
+        return ERROR_INVALID_FILTER, 400
+    keyset = get_keyset_args(keys=BUSINESS_SORT_KEYS[sort])
+    serializer = get_serializer(BUSINESS_FIELDS)
+    # Only the requested fields are read, plus what the cursors are made of
+    columns = field_columns(serializer.fields, BUSINESS_FIELD_COLUMNS, BUSINESS_SORT_COLUMNS[sort])
     offset = request.args.get('offset', default=0, type=int)
-    limit = request.args.get('limit', default=3, type=int)
+    limit = request.args.get('limit', default=DEFAULT_PAGE_LIMIT, type=int)
+    reader = get_read_store()
+    if sort == 'name':
+        list_businesses = functools.partial(reader.search_businesses, prefix)
+    elif sort == 'rating':
+        list_businesses = reader.list_businesses_by_rating
+    else:
+        list_businesses = reader.list_businesses
 
-    with db.connect() as conn:
-        # Fetch total number of businesses
-        total_stmt = sqlalchemy.text('SELECT COUNT(*) FROM businesses')
-        total = conn.execute(total_stmt).scalar()
+    if keyset is not None:
+        # Seek past the last entry of the previous page so every page costs the same
+        after, limit = keyset
+        rows = list_businesses(limit + 1, after=after, filters=filters, columns=columns)
+    else:
+        # Fetch one extra row to find out whether there is a next page
+        rows = list_businesses(limit + 1, offset=offset, filters=filters, columns=columns)
 
-        # Fetch businesses with offset and limit
-        stmt = sqlalchemy.text(
-            'SELECT id, owner_id, name, street_address, city, state, zip_code '
-            'FROM businesses ORDER BY id LIMIT :limit OFFSET :offset'
-        )
-        rows = conn.execute(stmt, parameters={'limit': limit, 'offset': offset})
+    # Cursors of the entries, read before the star sums are replaced
+    if sort == 'rating':
+        positions = [{'rating': rating_milli(row['review_count'], row['star_sum']), 'id': row['id']} for row in rows]
+    elif sort == 'name':
+        positions = [{'name': row['name'], 'id': row['id']} for row in rows]
+    else:
+        positions = [{'id': row['id']} for row in rows]
 
-        businesses = []
-        for row in rows:
-            business = row._asdict()
-            business['self'] = request.url_root.strip('/') + '/businesses/' + str(business['id'])
-            businesses.append(business)
+    businesses = serializer.businesses(rows)
 
-        response_body = {'entries': businesses}
+    # The exact total is only computed on request and cached for a short
+    # while. Name searches serve typeahead, which has no use for it.
+    total = None
+    if request.args.get('count') in ('1', 'true') and not prefix:
+        key = (BUSINESSES,) + tuple(sorted(filters.items()))
+        total = count_cache.get(key, lambda: reader.count_businesses(filters))
 
-        # Calculate next offset
-        next_offset = offset + limit
-        if next_offset < total:
-            next_url = request.url_root.strip('/') + '/businesses?offset={}&limit={}'.format(next_offset, limit)
+    # Next links keep the order, the search and the filters
+    query = listing_query(['sort', 'q', 'fields'] + BUSINESS_FILTERS)
+    if keyset is not None:
+        response_body = keyset_page(businesses, limit, '/' + BUSINESSES, positions, query)
+    else:
+        response_body = {'entries': businesses[:limit]}
+        if len(businesses) > limit:
+            next_url = request.url_root.strip('/') + '/businesses?offset={}&limit={}{}'.format(offset + limit, limit, query)
             response_body['next'] = next_url
+    if total is not None:
+        response_body['total'] = total
+
+    return response_body, 200
+
+# Get several businesses by id in one request, GET /businesses?ids=1,2,3
+# Entries follow the order of the ids, and ids of businesses that do not
+# exist are listed under `missing`
+def get_businesses_by_ids():
+    try:
+        business_ids = list(dict.fromkeys(int(value) for value in request.args['ids'].split(',')))
+    except ValueError:
+        return ERROR_INVALID_IDS, 400
+    if len(business_ids) > MAX_MULTI_GET_IDS:
+        return ERROR_TOO_MANY_IDS, 400
+    serializer = get_serializer(BUSINESS_FIELDS)
+
+    loader = get_business_loader()
+    loader.load(business_ids)
+    rows = [loader.get(business_id) for business_id in business_ids]
 
-        return response_body, 200
+    response_body = {'entries': serializer.businesses([row for row in rows if row is not None])}
+    missing = [business_id for business_id, row in zip(business_ids, rows) if row is None]
+    if missing:
+        response_body['missing'] = missing
+    return response_body, 200
 
 # Get a business
 @app.route('/' + BUSINESSES + '/<int:business_id>', methods=['GET'])
 def get_business(business_id):
-    with db.connect() as conn:
-        stmt = sqlalchemy.text(
-            'SELECT id, owner_id, name, street_address, city, state, zip_code '
-            'FROM businesses WHERE id = :business_id'
-        )
-        row = conn.execute(stmt, parameters={'business_id': business_id}).one_or_none()
-        if row is None:
+    serializer = get_serializer(BUSINESS_FIELDS)
+    entry = get_cached(BUSINESSES, business_id)
+    if entry is None:
+        generation = entity_cache.generation()
+        reader = get_read_store()
+        business = reader.get_business(business_id)
+        if business is None:
             return ERROR_NOT_FOUND_BUSINESS, 404
-        else:
-            business = row._asdict()
-            business['self'] = request.url
-            return business, 200
+        entry = cache_row(reader, BUSINESSES, business_id, business, generation)
+
+    return conditional_response(serializer.etag(entry.etag), serializer.business(dict(entry.value)))
+
+# Get the review aggregates of a business
+@app.route('/' + BUSINESSES + '/<int:business_id>/stats', methods=['GET'])
+def get_business_stats(business_id):
+    stats = get_read_store().get_business_stats(business_id)
+    if stats is None:
+        return ERROR_NOT_FOUND_BUSINESS, 404
+
+    response_body = stats
+    response_body['average_stars'] = average_stars(stats['review_count'], stats.pop('star_sum'))
+    response_body['stars'] = {str(n): response_body.pop(column) for n, column in enumerate(STAR_COLUMNS)}
+    response_body['business'] = request.url_root.strip('/') + '/businesses/' + str(business_id)
+    response_body['self'] = request.url
+    return response_body, 200
 
 # Edit a business
 @app.route('/' + BUSINESSES + '/<int:business_id>', methods=['PUT'])
 def put_business(business_id):
     content = request.get_json()
 
-    required_attributes = ['owner_id', 'name', 'street_address', 'city', 'state', 'zip_code']
-
     # Check if any required attribute is missing
-    if not content or not all(attr in content for attr in required_attributes):
+    if not has_required_attributes(content, BUSINESS_ATTRIBUTES):
         return ERROR_MISSING_ATTRIBUTES, 400
 
-    with db.connect() as conn:
-        # Check if the business exists
-        stmt_check = sqlalchemy.text('SELECT id FROM businesses WHERE id = :business_id')
-        row = conn.execute(stmt_check, parameters={'business_id': business_id}).one_or_none()
+    if not store.update_business(business_id, content):
+        return ERROR_NOT_FOUND_BUSINESS, 404
+    entity_cache.invalidate(BUSINESSES, business_id)
 
-        if row is None:
-            return ERROR_NOT_FOUND_BUSINESS, 404
-        else:
-            # Update the business
-            stmt = sqlalchemy.text(
-                'UPDATE businesses SET '
-                'owner_id = :owner_id, '
-                'name = :name, '
-                'street_address = :street_address, '
-                'city = :city, '
-                'state = :state, '
-                'zip_code = :zip_code '
-                'WHERE id = :business_id'
-            )
-            conn.execute(stmt, parameters={
-                'owner_id': content['owner_id'],
-                'name': content['name'],
-                'street_address': content['street_address'],
-                'city': content['city'],
-                'state': content['state'],
-                'zip_code': content['zip_code'],
-                'business_id': business_id
-            })
-            conn.commit()
-
-            # Construct the 'self' URL
-            business_url = request.url_root.strip('/') + '/businesses/' + str(business_id)
-
-            response_body = {
-                'id': business_id,
-                'owner_id': content['owner_id'],
-                'name': content['name'],
-                'street_address': content['street_address'],
-                'city': content['city'],
-                'state': content['state'],
-                'zip_code': content['zip_code'],
-                'self': business_url
-            }
-            return response_body, 200
+    # Construct the 'self' URL
+    business_url = request.url_root.strip('/') + '/businesses/' + str(business_id)
+
+    response_body = {
+        'id': business_id,
+        'owner_id': content['owner_id'],
+        'name': content['name'],
+        'street_address': content['street_address'],
+        'city': content['city'],
+        'state': content['state'],
+        'zip_code': content['zip_code'],
+        'self': business_url
+    }
+    return response_body, 200
 
 # Delete a business
 @app.route('/' + BUSINESSES + '/<int:business_id>', methods=['DELETE'])
 def delete_business(business_id):
-    with db.connect() as conn:
-        # Optionally delete related reviews here if implemented
-        stmt = sqlalchemy.text('DELETE FROM businesses WHERE id = :business_id')
-        result = conn.execute(stmt, parameters={'business_id': business_id})
-        conn.commit()
-
-        if result.rowcount == 1:
-            return '', 204
-        else:
-            return ERROR_NOT_FOUND_BUSINESS, 404
+    deleted = store.delete_business(business_id)
+    # Cached reviews of the business were removed by the cascade as well
+    entity_cache.invalidate(BUSINESSES, business_id, cascade=True)
+
+    if deleted:
+        return '', 204
+    else:
+        return ERROR_NOT_FOUND_BUSINESS, 404
 
 # List all businesses for an owner
+# Sending `limit` or `cursor` returns a keyset page instead of the full list,
+# and the full list can be streamed as NDJSON
 @app.route('/' + OWNERS + '/<int:owner_id>/businesses', methods=['GET'])
 def get_owner_businesses(owner_id):
-    with db.connect() as conn:
-        stmt = sqlalchemy.text(
-            'SELECT id, owner_id, name, street_address, city, state, zip_code '
-            'FROM businesses WHERE owner_id = :owner_id'
-        )
-        rows = conn.execute(stmt, parameters={'owner_id': owner_id})
+    keyset = get_keyset_args(paged_by_default=True)
+    serializer = get_serializer(BUSINESS_FIELDS)
+    columns = field_columns(serializer.fields, BUSINESS_FIELD_COLUMNS)
+    reader = get_read_store()
+
+    if keyset is not None:
+        after, limit = keyset
+        rows = reader.list_owner_businesses(owner_id, after=after, limit=limit + 1, columns=columns)
+        positions = [{'id': row['id']} for row in rows]
+    elif wants_stream():
+        return stream_rows(reader.stream_owner_businesses(owner_id, STREAM_CHUNK_ROWS, columns=columns), serializer.businesses)
+    else:
+        rows = reader.list_owner_businesses(owner_id, columns=columns)
 
-        businesses = []
-        for row in rows:
-            business = row._asdict()
-            business['self'] = request.url_root.strip('/') + '/businesses/' + str(business['id'])
-            businesses.append(business)
+    businesses = serializer.businesses(rows)
 
-        return businesses, 200
+    if keyset is not None:
+        return keyset_page(businesses, keyset[1], '/{}/{}/{}'.format(OWNERS, owner_id, BUSINESSES), positions, listing_query(['fields'])), 200
+    return businesses, 200
 
 # Create a review
 @app.route('/' + REVIEWS, methods=['POST'])
 def post_reviews():
     content = request.get_json()
 
-    required_attributes = ['user_id', 'business_id', 'stars']
-
     # Check if any required attribute is missing
-    if not content or not all(attr in content for attr in required_attributes):
+    if not has_required_attributes(content, REVIEW_ATTRIBUTES):
         return ERROR_MISSING_ATTRIBUTES, 400
 
-    # Check if the business exists
-    with db.connect() as conn:
-        stmt = sqlalchemy.text('SELECT id FROM businesses WHERE id = :business_id')
-        business = conn.execute(stmt, parameters={'business_id': content['business_id']}).one_or_none()
-        if business is None:
-            return ERROR_NOT_FOUND_BUSINESS, 404
+    # Stars are stored as whole numbers, the aggregates count them as such
+    try:
+        review = normalize_review(content)
+    except (TypeError, ValueError):
+        return ERROR_INVALID_REVIEW, 400
 
-        # Check if a review by this user for this business already exists
-        stmt = sqlalchemy.text('SELECT id FROM reviews WHERE user_id = :user_id AND business_id = :business_id')
-        existing_review = conn.execute(stmt, parameters={'user_id': content['user_id'], 'business_id': content['business_id']}).one_or_none()
-        if existing_review is not None:
-            return ERROR_CONFLICT_REVIEW, 409
+    if review_queue is not None:
+        return queue_review(review)
 
-        # Insert the new review into the database
-        stmt = sqlalchemy.text(
-            'INSERT INTO reviews (user_id, business_id, stars, review_text) '
-            'VALUES (:user_id, :business_id, :stars, :review_text)'
-        )
-        conn.execute(stmt, parameters={
-            'user_id': content['user_id'],
-            'business_id': content['business_id'],
-            'stars': content['stars'],
-            'review_text': content.get('review_text', None)
-        })
-        # Get the last inserted id
-        stmt2 = sqlalchemy.text('SELECT LAST_INSERT_ID()')
-        review_id = conn.execute(stmt2).scalar()
-        conn.commit()
+    # Insert the new review into the database
+    try:
+        review_id = store.create_review(review)
+    except BusinessNotFound:
+        return ERROR_NOT_FOUND_BUSINESS, 404
+    except DuplicateReview:
+        return ERROR_CONFLICT_REVIEW, 409
+    # The aggregates of the business changed with the review
+    entity_cache.invalidate(BUSINESSES, review['business_id'])
 
-        # Construct the 'self' URL
-        review_url = request.url_root.strip('/') + '/reviews/' + str(review_id)
-        business_url = request.url_root.strip('/') + '/businesses/' + str(content['business_id'])
+    # Construct the 'self' URL
+    review_url = request.url_root.strip('/') + '/reviews/' + str(review_id)
+    business_url = request.url_root.strip('/') + '/businesses/' + str(review['business_id'])
 
-        response_body = {
-            'id': review_id,
-            'user_id': content['user_id'],
-            'business': business_url,
-            'stars': content['stars'],
-            'review_text': content.get('review_text', None),
-            'self': review_url
-        }
-        return response_body, 201
+    response_body = {
+        'id': review_id,
+        'user_id': review['user_id'],
+        'business': business_url,
+        'stars': review['stars'],
+        'review_text': review['review_text'],
+        'self': review_url
+    }
+    return response_body, 201
+
+# Queues a normalized review for the flusher and answers 202 with the URL of
+# its status, without waiting for a database connection
+def queue_review(review):
+    try:
+        ticket = review_queue.enqueue(review)
+    except QueueFull:
+        return ERROR_QUEUE_FULL, 503, {'Retry-After': str(REVIEW_QUEUE_RETRY_AFTER)}
+
+    status_url = request.url_root.strip('/') + '/reviews/queued/' + str(ticket)
+    return {'id': ticket, 'state': 'pending', 'self': status_url}, 202, {'Location': status_url}
+
+# Errors of queued reviews the flusher rejected, by the status they got
+QUEUED_REVIEW_ERRORS = {404: ERROR_NOT_FOUND_BUSINESS, 409: ERROR_CONFLICT_REVIEW, 500: ERROR_REVIEW_FAILED}
+
+# Status of a queued review: pending, created with a link to the review, or
+# rejected with the status and error a synchronous POST would have returned
+@app.route('/' + REVIEWS + '/queued/<int:ticket>', methods=['GET'])
+def get_queued_review(ticket):
+    outcome = review_queue.status(ticket) if review_queue is not None else None
+    if outcome is None:
+        return ERROR_NOT_FOUND_QUEUED_REVIEW, 404
+
+    response_body = {'id': ticket, 'self': request.url_root.strip('/') + '/reviews/queued/' + str(ticket)}
+    if outcome['status'] is None:
+        response_body['state'] = 'pending'
+    elif outcome['status'] == CREATED:
+        response_body['state'] = 'created'
+        response_body['review'] = request.url_root.strip('/') + '/reviews/' + str(outcome['review_id'])
+    else:
+        response_body['state'] = 'rejected'
+        response_body['status'] = outcome['status']
+        response_body.update(QUEUED_REVIEW_ERRORS[outcome['status']])
+    return response_body, 200
+
+# Create many reviews at once from a JSON array or NDJSON stream
+# Unknown businesses and duplicate reviews are found with one query each per
+# chunk. Like batches of businesses, batches of reviews are not atomic.
+@app.route('/' + REVIEWS + '/batch', methods=['POST'])
+def post_reviews_batch():
+    serializer = Serializer(request.url_root)
+    results = []
+    for chunk in chunked(iter_batch_items(request)):
+        valid = []
+        for content in chunk:
+            if not has_required_attributes(content, REVIEW_ATTRIBUTES):
+                results.append(dict(ERROR_MISSING_ATTRIBUTES, status=400))
+                continue
+            # Values the reviews table would reject fail alone rather than
+            # with their whole chunk
+            try:
+                review = normalize_review(content)
+            except (TypeError, ValueError):
+                results.append(dict(ERROR_INVALID_REVIEW, status=400))
+                continue
+            valid.append((len(results), review))
+            results.append(None)
+        if not valid:
+            continue
+
+        outcomes = write_batch_chunk(store.create_reviews, [review for _, review in valid])
+        for outcome, (index, review) in zip(outcomes, valid):
+            if outcome is None:
+                results[index] = dict(ERROR_REVIEW_FAILED, status=500)
+            elif isinstance(outcome, BusinessNotFound):
+                results[index] = dict(ERROR_NOT_FOUND_BUSINESS, status=404)
+            elif isinstance(outcome, DuplicateReview):
+                results[index] = dict(ERROR_CONFLICT_REVIEW, status=409)
+            else:
+                entity_cache.invalidate(BUSINESSES, review['business_id'])
+                results[index] = {
+                    'id': outcome,
+                    'user_id': review['user_id'],
+                    'business': serializer.business_url + str(review['business_id']),
+                    'stars': review['stars'],
+                    'review_text': review['review_text'],
+                    'self': serializer.review_url + str(outcome),
+                    'status': 201
+                }
 
-# Get a review
+    return {'results': results}, 200
+
+# Get a review, with its business embedded for ?expand=business
 @app.route('/' + REVIEWS + '/<int:review_id>', methods=['GET'])
 def get_review(review_id):
-    with db.connect() as conn:
-        stmt = sqlalchemy.text(
-            'SELECT r.id, r.user_id, r.business_id, r.stars, r.review_text '
-            'FROM reviews r WHERE r.id = :review_id'
-        )
-        row = conn.execute(stmt, parameters={'review_id': review_id}).one_or_none()
-        if row is None:
+    serializer = get_review_serializer()
+    entry = get_cached(REVIEWS, review_id)
+    if entry is None:
+        generation = entity_cache.generation()
+        reader = get_read_store()
+        review = reader.get_review(review_id)
+        if review is None:
             return ERROR_NOT_FOUND_REVIEW, 404
-        else:
-            review = row._asdict()
-            review['self'] = request.url
-            review['business'] = request.url_root.strip('/') + '/businesses/' + str(review['business_id'])
-            # Remove 'business_id' from response as per the example
-            del review['business_id']
-            return review, 200
+        # The review is dropped from the cache together with its business
+        entry = cache_row(reader, REVIEWS, review_id, review, generation, depends_on=[(BUSINESSES, review['business_id'])])
+
+    return conditional_response(serializer.review_etag(entry), serializer.review(dict(entry.value)))
 
 # Edit a review
 @app.route('/' + REVIEWS + '/<int:review_id>', methods=['PUT'])
 def put_review(review_id):
+    serializer = get_review_serializer()
     content = request.get_json()
 
-    required_attributes = ['stars']
-
     # Check if required attribute is missing
-    if not content or not all(attr in content for attr in required_attributes):
+    if not has_required_attributes(content, ['stars']):
         return ERROR_MISSING_ATTRIBUTES, 400
 
-    with db.connect() as conn:
-        # Check if the review exists
-        stmt = sqlalchemy.text('SELECT * FROM reviews WHERE id = :review_id')
-        row = conn.execute(stmt, parameters={'review_id': review_id}).one_or_none()
+    review_text = content.get('review_text', None)
+    if review_text is not None:
+        review_text = str(review_text)
+    try:
+        stars = normalize_stars(content['stars'])
+        check_review(stars, review_text)
+    except (TypeError, ValueError):
+        return ERROR_INVALID_REVIEW, 400
 
-        if row is None:
-            return ERROR_NOT_FOUND_REVIEW, 404
-        else:
-            # Update the review
-            stmt = sqlalchemy.text(
-                'UPDATE reviews SET '
-                'stars = :stars, '
-                'review_text = COALESCE(:review_text, review_text) '
-                'WHERE id = :review_id'
-            )
-            conn.execute(stmt, parameters={
-                'stars': content['stars'],
-                'review_text': content.get('review_text', None),
-                'review_id': review_id
-            })
-            conn.commit()
-
-            # Retrieve the updated review
-            stmt = sqlalchemy.text(
-                'SELECT r.id, r.user_id, r.business_id, r.stars, r.review_text '
-                'FROM reviews r WHERE r.id = :review_id'
-            )
-            row = conn.execute(stmt, parameters={'review_id': review_id}).one()
-            review = row._asdict()
-            review['self'] = request.url
-            review['business'] = request.url_root.strip('/') + '/businesses/' + str(review['business_id'])
-            del review['business_id']
-            return review, 200
+    # The store returns the row as written, so the response matches what a
+    # later GET reads
+    review = store.update_review(review_id, stars, review_text)
+    if review is None:
+        return ERROR_NOT_FOUND_REVIEW, 404
+    entity_cache.invalidate(REVIEWS, review_id)
+    entity_cache.invalidate(BUSINESSES, review['business_id'])
+
+    return serializer.review(review), 200
 
 # Delete a review
 @app.route('/' + REVIEWS + '/<int:review_id>', methods=['DELETE'])
 def delete_review(review_id):
-    with db.connect() as conn:
-        stmt = sqlalchemy.text('DELETE FROM reviews WHERE id = :review_id')
-        result = conn.execute(stmt, parameters={'review_id': review_id})
-        conn.commit()
-
-        if result.rowcount == 1:
-            return '', 204
-        else:
-            return ERROR_NOT_FOUND_REVIEW, 404
+    review = store.delete_review(review_id)
+    entity_cache.invalidate(REVIEWS, review_id)
+
+    if review is not None:
+        entity_cache.invalidate(BUSINESSES, review['business_id'])
+        return '', 204
+    else:
+        return ERROR_NOT_FOUND_REVIEW, 404
 
 # List all reviews for a user
+# Sending `limit` or `cursor` returns a keyset page instead of the full list,
+# and the full list can be streamed as NDJSON. With ?expand=business each
+# review embeds its business, all of them fetched with one query; a stream
+# joins them into its own query, as it holds its connection until it ends.
 @app.route('/users/<int:user_id>/reviews', methods=['GET'])
 def get_user_reviews(user_id):
-    with db.connect() as conn:
-        stmt = sqlalchemy.text(
-            'SELECT r.id, r.user_id, r.business_id, r.stars, r.review_text '
-            'FROM reviews r WHERE r.user_id = :user_id'
-        )
-        rows = conn.execute(stmt, parameters={'user_id': user_id})
+    keyset = get_keyset_args(paged_by_default=True)
+    serializer = get_review_serializer()
+    columns = field_columns(serializer.fields, REVIEW_FIELD_COLUMNS)
+    reader = get_read_store()
+
+    if keyset is not None:
+        after, limit = keyset
+        rows = reader.list_user_reviews(user_id, after=after, limit=limit + 1, columns=columns)
+        positions = [{'id': row['id']} for row in rows]
+    elif wants_stream():
+        with_businesses = serializer.business_loader is not None and (columns is None or 'business_id' in columns)
+        chunks = reader.stream_user_reviews(user_id, STREAM_CHUNK_ROWS, columns=columns, with_businesses=with_businesses)
+        return stream_rows(chunks, serializer.reviews)
+    else:
+        rows = reader.list_user_reviews(user_id, columns=columns)
+
+    reviews = serializer.reviews(rows)
+
+    if keyset is not None:
+        return keyset_page(reviews, keyset[1], '/{}/{}/{}'.format(USERS, user_id, REVIEWS), positions, listing_query(['fields', 'expand'])), 200
+    return reviews, 200
+
+# Resources behind change log entries, read from the database rather than the
+# cache, which may not have seen the change yet. Nor are they cached: the
+# feed reads reviews without tagging them with their businesses, so their
+# entries would outlive cascading deletes. Updates and creates carry the
+# current resource, or None when it was deleted since.
+def change_entries(changes, reader):
+    serializer = Serializer(request.url_root)
+    loaders = {
+        BUSINESSES: Loader(entity_cache, BUSINESSES, reader.get_businesses, refresh=True, fill=False),
+        REVIEWS: Loader(entity_cache, REVIEWS, reader.get_reviews, refresh=True, fill=False),
+    }
+    for collection, loader in loaders.items():
+        loader.load([change['resource_id'] for change in changes
+                     if change['collection'] == collection and change['operation'] != DELETED])
+    urls = {BUSINESSES: serializer.business_url, REVIEWS: serializer.review_url}
+    to_resource = {BUSINESSES: serializer.business, REVIEWS: serializer.review}
+    entries = []
+    for change in changes:
+        collection = change['collection']
+        entry = {
+            'collection': collection,
+            'id': change['resource_id'],
+            'operation': change['operation'],
+            'self': urls[collection] + str(change['resource_id']),
+        }
+        if change['operation'] != DELETED:
+            row = loaders[collection].get(change['resource_id'])
+            entry['resource'] = None if row is None else to_resource[collection](row)
+        entries.append(entry)
+    return entries
 
-        reviews = []
-        for row in rows:
-            review = row._asdict()
-            review['self'] = request.url_root.strip('/') + '/reviews/' + str(review['id'])
-            review['business'] = request.url_root.strip('/') + '/businesses/' + str(review['business_id'])
-            del review['business_id']
-            reviews.append(review)
+# Get the changes after a cursor, GET /changes?since=<cursor>&limit=&wait=
+# Without `since`, returns the current cursor: clients take it before
+# reading the whole collections, then sync from it. Entries hold the latest
+# change of each resource within the page, and `cursor` is where the next
+# sync starts. With `wait`, the request waits up to that many seconds for
+# the first change. A cursor older than the retained log gets a 410, after
+# which the client reads everything again.
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    reader = get_read_store()
+    if 'since' not in request.args:
+        return {'changes': [], 'cursor': encode_cursor({'id': reader.latest_change()})}, 200
+    since = request.args['since']
+    after = decode_cursor(since).get('id', 0)
+    if not isinstance(after, int):
+        raise InvalidCursor(since)
+    limit = min(max(request.args.get('limit', CHANGES_PAGE_LIMIT, type=int), 1), MAX_CHANGES_LIMIT)
+    wait = min(max(request.args.get('wait', 0.0, type=float), 0.0), CHANGES_MAX_WAIT)
 
-        return reviews, 200
+    changes, more = change_feed.poll(reader, after, limit, wait, pause=without_admission_slot)
+    # Read after the entries, so that a pruning in between is noticed
+    if after < reader.change_horizon():
+        return ERROR_CHANGES_EXPIRED, 410
+    cursor = encode_cursor({'id': changes[-1]['id'] if changes else after})
+    response_body = {'changes': change_entries(latest_per_resource(changes), reader), 'cursor': cursor}
+    if more:
+        response_body['next'] = request.url_root.strip('/') + '/changes?since={}&limit={}'.format(cursor, limit)
+    return response_body, 200
 
 if __name__ == '__main__':
     init_db()
-    create_tables(db)
+    start_change_pruning()
+    start_pool_warmup()
+    if db is not None:
+        migrate(db)
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,239 @@
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+
+import sqlalchemy
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger()
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# Statements slower than this many milliseconds are logged, 0 turns the log off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+
+# Statement label: the verb and the first table, e.g. 'SELECT businesses'
+STATEMENT_PATTERN = re.compile(r'^\s*(\w+)\b.*?\b(?:FROM|INTO|UPDATE)\s+`?(\w+)', re.IGNORECASE | re.DOTALL)
+MAX_STATEMENT_LABELS = 1000
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, escape(str(value))) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, per combination of label values.
+
+    An observation is one bisect and a few additions under a lock.
+    """
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # One count per bucket, plus +Inf, the sum and the total count
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labelnames, labels, 'le="{}"'.format(bound)), cumulative
+                ))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labelnames, labels), values[-2]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labelnames, labels), values[-1]))
+        return lines
+
+
+class Counter:
+    """Counts events per combination of label values."""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            series = dict(self._series)
+        for labels, value in sorted(series.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Gauge:
+    """A value read from a callback at scrape time."""
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self):
+        value = self.callback()
+        if value is None:
+            return []
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, value)]
+
+
+class Registry:
+    """
+    Metrics keyed by name, rendered in the order they were first registered.
+
+    Registering a name again replaces the metric, so that re-initializing a
+    pool, the admission control or the review queue moves its gauges to the
+    new object instead of exporting the series twice.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time spent in the request handler.', ('method', 'route', 'status')
+))
+request_round_trips = registry.register(Histogram(
+    'http_request_db_round_trips', 'Database statements sent per request.', ('route',), ROUND_TRIP_BUCKETS
+))
+statement_latency = registry.register(Histogram(
+    'db_statement_duration_seconds', 'Time from sending a statement to its cursor being ready.', ('statement',)
+))
+checkout_wait = registry.register(Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection, including connecting.'
+))
+
+_statement_labels = {}
+
+
+def statement_label(statement: str) -> str:
+    label = _statement_labels.get(statement)
+    if label is None:
+        match = STATEMENT_PATTERN.match(statement)
+        label = '{} {}'.format(match.group(1).upper(), match.group(2)) if match else statement.split(None, 1)[0].upper()
+        # Multi-row INSERTs differ in length, so bound the cache
+        if len(_statement_labels) < MAX_STATEMENT_LABELS:
+            _statement_labels[statement] = label
+    return label
+
+
+def pool_stat(db, name):
+    """Reads a QueuePool counter; other pool classes have none."""
+    pool = db.pool
+    if not isinstance(pool, sqlalchemy.pool.QueuePool):
+        return None
+    return getattr(pool, name)()
+
+
+def instrument_engine(db: sqlalchemy.engine.base.Engine, pool_name: str = 'db_pool') -> None:
+    """
+    Records pool checkouts and statement latencies of an engine.
+
+    The pool gauges are named after `pool_name`, which tells the pools of
+    several engines apart.
+    """
+    registry.register(Gauge(pool_name + '_size', 'Permanent connections of the pool.', lambda: pool_stat(db, 'size')))
+    registry.register(Gauge(pool_name + '_in_use', 'Connections checked out of the pool.', lambda: pool_stat(db, 'checkedout')))
+    registry.register(Gauge(pool_name + '_overflow', 'Connections open beyond the pool size.', lambda: pool_stat(db, 'overflow')))
+
+    # SQLAlchemy has no event for the start of a checkout, so time the call
+    # every Connection makes to get its DBAPI connection. The attribute
+    # outlives the pool, which is replaced when the engine is disposed.
+    raw_connection = db.raw_connection
+
+    def timed_raw_connection():
+        start = time.perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            checkout_wait.observe(time.perf_counter() - start)
+
+    db.raw_connection = timed_raw_connection
+
+    @event.listens_for(db, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+        if has_request_context():
+            g.db_round_trips = g.get('db_round_trips', 0) + 1
+
+    @event.listens_for(db, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        statement_latency.observe(elapsed, statement_label(statement))
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000,
+                           request.path if has_request_context() else '-', statement)
+
+
+def install_request_metrics(app: Flask) -> None:
+    """Records the latency and database round trips of every request."""
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def end_request(response):
+        start = g.get('metrics_start')
+        if start is not None:
+            # Unmatched URLs share one label to keep the series bounded
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            request_latency.observe(time.perf_counter() - start, request.method, route, response.status_code)
+            request_round_trips.observe(g.get('db_round_trips', 0), route)
+        return response
+
+
+def render_metrics() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    return registry.render()
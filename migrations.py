@@ -0,0 +1,251 @@
+import logging
+
+import sqlalchemy
+
+logger = logging.getLogger()
+
+# MySQL error codes raised when a column or an index with the same name already exists
+MYSQL_ER_DUP_FIELDNAME = 1060
+MYSQL_ER_DUP_KEYNAME = 1061
+
+# Name of the advisory lock that keeps concurrent workers from migrating
+# twice, and how many seconds a worker waits for it
+MIGRATION_LOCK = 'schema_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+# Recomputes the review aggregates of every business from its reviews
+REPAIR_REVIEW_AGGREGATES = (
+    'UPDATE businesses SET '
+    'review_count = (SELECT COUNT(*) FROM reviews WHERE reviews.business_id = businesses.id), '
+    'star_sum = (SELECT COALESCE(SUM(stars), 0) FROM reviews WHERE reviews.business_id = businesses.id), '
+    + ', '.join(
+        'stars_{0} = (SELECT COUNT(*) FROM reviews WHERE reviews.business_id = businesses.id AND stars = {0})'.format(n)
+        for n in range(6)
+    )
+)
+
+# Ordered schema changes. Applied steps are recorded in `schema_migrations`
+# and never run again, so existing steps must not be edited: append new ones.
+# Steps only ever add to the schema, they never drop tables or columns.
+# A step is a list of portable statements, or a dict of such lists keyed by
+# SQLAlchemy dialect name when MySQL and SQLite need different DDL.
+MIGRATIONS = [
+    (1, 'create businesses and reviews', {
+        'mysql': [
+            'CREATE TABLE IF NOT EXISTS businesses ('
+            'id INTEGER UNSIGNED NOT NULL AUTO_INCREMENT, '
+            'owner_id INTEGER NOT NULL, '
+            'name VARCHAR(50) NOT NULL, '
+            'street_address VARCHAR(100) NOT NULL, '
+            'city VARCHAR(50) NOT NULL, '
+            'state VARCHAR(2) NOT NULL, '
+            'zip_code VARCHAR(10) NOT NULL, '
+            'PRIMARY KEY (id) )',
+            # InnoDB creates an index on reviews.business_id for the foreign key,
+            # which serves cascading deletes of a business
+            'CREATE TABLE IF NOT EXISTS reviews ('
+            'id INTEGER UNSIGNED NOT NULL AUTO_INCREMENT, '
+            'user_id INTEGER NOT NULL, '
+            'business_id INTEGER UNSIGNED NOT NULL, '
+            'stars INTEGER NOT NULL CHECK (stars >= 0 AND stars <= 5), '
+            'review_text VARCHAR(1000), '
+            'PRIMARY KEY (id), '
+            'FOREIGN KEY (business_id) REFERENCES businesses(id) ON DELETE CASCADE, '
+            'UNIQUE (user_id, business_id) )',
+        ],
+        # SQLite does not enforce VARCHAR lengths, so CHECK constraints stand
+        # in for MySQL's strict mode
+        'sqlite': [
+            'CREATE TABLE IF NOT EXISTS businesses ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'owner_id INTEGER NOT NULL, '
+            'name VARCHAR(50) NOT NULL CHECK (length(name) <= 50), '
+            'street_address VARCHAR(100) NOT NULL CHECK (length(street_address) <= 100), '
+            'city VARCHAR(50) NOT NULL CHECK (length(city) <= 50), '
+            'state VARCHAR(2) NOT NULL CHECK (length(state) <= 2), '
+            'zip_code VARCHAR(10) NOT NULL CHECK (length(zip_code) <= 10) )',
+            'CREATE TABLE IF NOT EXISTS reviews ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'user_id INTEGER NOT NULL, '
+            'business_id INTEGER NOT NULL REFERENCES businesses(id) ON DELETE CASCADE, '
+            'stars INTEGER NOT NULL CHECK (stars >= 0 AND stars <= 5), '
+            'review_text VARCHAR(1000) CHECK (length(review_text) <= 1000), '
+            'UNIQUE (user_id, business_id) )',
+        ],
+    }),
+    # get_owner_businesses: WHERE owner_id = :owner_id ORDER BY id
+    (2, 'index businesses by owner', [
+        'CREATE INDEX businesses_owner_id ON businesses (owner_id, id)',
+    ]),
+    # get_user_reviews: WHERE user_id = :user_id ORDER BY id
+    (3, 'index reviews by user', [
+        'CREATE INDEX reviews_user_id ON reviews (user_id, id)',
+    ]),
+    # Cascading deletes of a business. MySQL already has the foreign key index.
+    (4, 'index reviews by business', {
+        'mysql': [],
+        'sqlite': ['CREATE INDEX reviews_business_id ON reviews (business_id)'],
+    }),
+    # Review count, star sum and star histogram of each business, maintained
+    # by the review writes. rating_milli is the average rating times 1000,
+    # indexed for GET /businesses?sort=rating.
+    (5, 'review aggregates on businesses', {
+        'mysql': [
+            'ALTER TABLE businesses '
+            'ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0, '
+            'ADD COLUMN star_sum INTEGER NOT NULL DEFAULT 0, '
+            + ''.join('ADD COLUMN stars_{} INTEGER NOT NULL DEFAULT 0, '.format(n) for n in range(6)) +
+            'ADD COLUMN rating_milli INTEGER AS '
+            '(IF(review_count = 0, 0, star_sum * 1000 DIV review_count)) STORED',
+            'CREATE INDEX businesses_rating ON businesses (rating_milli, id)',
+            REPAIR_REVIEW_AGGREGATES,
+        ],
+        'sqlite': [
+            'ALTER TABLE businesses ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0',
+            'ALTER TABLE businesses ADD COLUMN star_sum INTEGER NOT NULL DEFAULT 0',
+        ] + [
+            'ALTER TABLE businesses ADD COLUMN stars_{} INTEGER NOT NULL DEFAULT 0'.format(n) for n in range(6)
+        ] + [
+            'ALTER TABLE businesses ADD COLUMN rating_milli INTEGER GENERATED ALWAYS AS '
+            '(CASE WHEN review_count = 0 THEN 0 ELSE star_sum * 1000 / review_count END) VIRTUAL',
+            'CREATE INDEX businesses_rating ON businesses (rating_milli, id)',
+            REPAIR_REVIEW_AGGREGATES,
+        ],
+    }),
+    # GET /businesses?city=&state=&zip_code=: WHERE column = :value ORDER BY id,
+    # and ?q=: names in a prefix range ORDER BY name, id, ignoring case. On
+    # SQLite that takes an index with the NOCASE collation.
+    (6, 'index businesses by location and name', {
+        'mysql': [
+            'CREATE INDEX businesses_city ON businesses (city, id)',
+            'CREATE INDEX businesses_state ON businesses (state, id)',
+            'CREATE INDEX businesses_zip_code ON businesses (zip_code, id)',
+            'CREATE INDEX businesses_name ON businesses (name, id)',
+        ],
+        'sqlite': [
+            'CREATE INDEX businesses_city ON businesses (city, id)',
+            'CREATE INDEX businesses_state ON businesses (state, id)',
+            'CREATE INDEX businesses_zip_code ON businesses (zip_code, id)',
+            'CREATE INDEX businesses_name ON businesses (name COLLATE NOCASE, id)',
+        ],
+    }),
+    # GET /changes: WHERE id > :after ORDER BY id, and pruning by age. The
+    # horizon is the newest pruned id, older cursors can no longer sync.
+    # SQLite's AUTOINCREMENT never reuses the ids of pruned entries.
+    (7, 'create the change log', {
+        'mysql': [
+            'CREATE TABLE IF NOT EXISTS changes ('
+            'id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT, '
+            'collection VARCHAR(20) NOT NULL, '
+            'resource_id INTEGER UNSIGNED NOT NULL, '
+            'operation VARCHAR(10) NOT NULL, '
+            'changed_at DOUBLE NOT NULL, '
+            'PRIMARY KEY (id), '
+            'INDEX changes_changed_at (changed_at) )',
+            'CREATE TABLE IF NOT EXISTS changes_horizon ('
+            'id INTEGER NOT NULL, '
+            'horizon BIGINT UNSIGNED NOT NULL, '
+            'PRIMARY KEY (id) )',
+            'INSERT IGNORE INTO changes_horizon (id, horizon) VALUES (1, 0)',
+        ],
+        'sqlite': [
+            'CREATE TABLE IF NOT EXISTS changes ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'collection VARCHAR(20) NOT NULL, '
+            'resource_id INTEGER NOT NULL, '
+            'operation VARCHAR(10) NOT NULL, '
+            'changed_at REAL NOT NULL )',
+            'CREATE INDEX changes_changed_at ON changes (changed_at)',
+            'CREATE TABLE IF NOT EXISTS changes_horizon ('
+            'id INTEGER PRIMARY KEY, '
+            'horizon INTEGER NOT NULL )',
+            'INSERT OR IGNORE INTO changes_horizon (id, horizon) VALUES (1, 0)',
+        ],
+    }),
+]
+
+
+class MigrationLockError(RuntimeError):
+    """Raised when another process holds the migration lock for too long."""
+
+
+def migration_statements(statements, dialect):
+    """Returns the statements of a migration step for a database dialect."""
+    if isinstance(statements, dict):
+        return statements[dialect]
+    return statements
+
+
+def is_already_applied(e, dialect) -> bool:
+    """True when a CREATE INDEX or ADD COLUMN failed because the index or column already exists."""
+    if dialect == 'sqlite':
+        return 'already exists' in str(e.orig) or 'duplicate column name' in str(e.orig)
+    return e.orig.args[0] in (MYSQL_ER_DUP_FIELDNAME, MYSQL_ER_DUP_KEYNAME)
+
+
+def get_schema_version(conn) -> int:
+    """Returns the highest applied migration, creating the bookkeeping table if needed."""
+    conn.execute(sqlalchemy.text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER NOT NULL, '
+        'description VARCHAR(100) NOT NULL, '
+        'applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        'PRIMARY KEY (version) )'
+    ))
+    version = conn.execute(sqlalchemy.text('SELECT MAX(version) FROM schema_migrations')).scalar()
+    conn.commit()
+    return version or 0
+
+
+def pending_migrations(conn):
+    """Returns the migrations that have not been applied yet, in order."""
+    version = get_schema_version(conn)
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def migrate(db: sqlalchemy.engine.base.Engine) -> int:
+    """
+    Applies every pending migration and returns the resulting schema version.
+
+    Safe to call on every start: MySQL workers racing each other wait on an
+    advisory lock, SQLite workers may run the idempotent steps twice, and a
+    step interrupted after its DDL ran is recorded on the next attempt
+    instead of failing.
+
+    Migrations read whole tables, so they run exempt from the EXPLAIN check.
+    Raises MigrationLockError when the advisory lock cannot be taken.
+    """
+    dialect = db.dialect.name
+    with db.connect() as conn:
+        conn.execution_options(explain_check=False)
+        if dialect == 'mysql':
+            locked = conn.execute(
+                sqlalchemy.text('SELECT GET_LOCK(:name, :timeout)'),
+                parameters={'name': MIGRATION_LOCK, 'timeout': MIGRATION_LOCK_TIMEOUT}
+            ).scalar()
+            # 0 when the wait timed out, NULL on an error such as a killed thread
+            if locked != 1:
+                raise MigrationLockError('Could not take the migration lock {!r}'.format(MIGRATION_LOCK))
+        try:
+            for version, description, statements in pending_migrations(conn):
+                logger.info('Applying schema migration %d: %s', version, description)
+                for statement in migration_statements(statements, dialect):
+                    try:
+                        conn.execute(sqlalchemy.text(statement))
+                    except sqlalchemy.exc.OperationalError as e:
+                        if not is_already_applied(e, dialect):
+                            raise
+                try:
+                    conn.execute(
+                        sqlalchemy.text('INSERT INTO schema_migrations (version, description) VALUES (:version, :description)'),
+                        parameters={'version': version, 'description': description}
+                    )
+                    conn.commit()
+                except sqlalchemy.exc.IntegrityError:
+                    # SQLite has no advisory lock: another process applied the
+                    # same idempotent step at the same time and recorded it first
+                    conn.rollback()
+            return get_schema_version(conn)
+        finally:
+            if dialect == 'mysql':
+                conn.execute(sqlalchemy.text('SELECT RELEASE_LOCK(:name)'), parameters={'name': MIGRATION_LOCK})
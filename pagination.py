@@ -0,0 +1,74 @@
+import base64
+import json
+import os
+import threading
+import time
+
+# Number of entries returned per page when the client does not send a limit
+DEFAULT_PAGE_LIMIT = 3
+
+# Totals kept by the count cache before expired ones are dropped
+MAX_CACHED_COUNTS = 1000
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def encode_cursor(position: dict) -> str:
+    """
+    Encodes the sort key of the last row on a page as an opaque token.
+
+    The token is URL safe so it can be placed in `next` links as is.
+    """
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> dict:
+    """
+    Decodes a token produced by `encode_cursor`.
+
+    An empty token is the start of the listing.
+    """
+    if not token:
+        return {}
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        position = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(token) from e
+    if not isinstance(position, dict):
+        raise InvalidCursor(token)
+    return position
+
+
+class CountCache:
+    """
+    Caches the result of expensive COUNT(*) queries for a few seconds.
+
+    Totals are only returned to clients that ask for them, so a slightly
+    stale value is an acceptable price for not scanning the table per page.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+        value = loader()
+        with self._lock:
+            # Filtered counts have open-ended keys
+            if len(self._values) >= MAX_CACHED_COUNTS:
+                self._values = {k: v for k, v in self._values.items() if v[1] > now}
+            self._values[key] = (value, now + self.ttl)
+        return value
+
+
+count_cache = CountCache(float(os.environ.get('COUNT_CACHE_TTL', '30')))
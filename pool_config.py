@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+
+
+logger = logging.getLogger()
+
+
+class ConnectionBudgetExceeded(RuntimeError):
+    """Raised at startup when all workers together could open more connections than the database allows."""
+
+
+def shares_one_connection() -> bool:
+    """True when the process keeps its database on a single connection, SQLite's ':memory:' database."""
+    return os.environ.get('STORAGE_BACKEND', 'mysql') == 'sqlite' and os.environ.get('SQLITE_PATH', ':memory:') == ':memory:'
+
+
+def pool_settings() -> dict:
+    """
+    Returns the connection pool parameters of one process, from the environment.
+
+    DB_POOL_SIZE is the number of permanent connections, DB_MAX_OVERFLOW the
+    extra ones opened under load. A request waits up to DB_POOL_TIMEOUT
+    seconds for a free connection, and connections are re-established after
+    DB_POOL_RECYCLE seconds. The pool of an in-memory SQLite database holds
+    its one connection.
+    """
+    if shares_one_connection():
+        return {
+            'pool_size': 1,
+            'max_overflow': 0,
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+            'pool_recycle': -1,
+        }
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '2')),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+    }
+
+
+def prewarm_connections() -> int:
+    """
+    Returns how many connections to open before the process reports ready.
+
+    DB_POOL_PREWARM defaults to the pool size. The pool keeps at most that
+    many connections open, so larger values are capped to it.
+    """
+    pool_size = pool_settings()['pool_size']
+    return min(int(os.environ.get('DB_POOL_PREWARM', str(pool_size))), pool_size)
+
+
+def prewarm_pool(db: sqlalchemy.engine.base.Engine, count: int) -> None:
+    """
+    Opens `count` connections of the pool at once and returns them to it.
+
+    The connections are opened in parallel so that their handshakes overlap.
+    Raises the first error met, after closing the connections that opened.
+    """
+    if count <= 0:
+        return
+    with ThreadPoolExecutor(max_workers=count, thread_name_prefix='pool-prewarm') as executor:
+        futures = [executor.submit(db.connect) for _ in range(count)]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    for future in futures:
+        if future.exception() is None:
+            future.result().close()
+    if errors:
+        raise errors[0]
+
+
+class PoolWarmup:
+    """
+    Pre-warms connection pools from a background thread.
+
+    The primary pool is retried every `retry_interval` seconds until it
+    opens its connections. `replicas` are warmed once afterwards, and a
+    failure there is only logged, as reads fall back to the primary. `ready`
+    is set when both are done.
+    """
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, count: int, replicas=(), retry_interval: float = 1.0):
+        self.db = db
+        self.count = count
+        self.replicas = replicas
+        self.retry_interval = retry_interval
+        self.ready = threading.Event()
+        # Seconds the warm-up took, and the last error of the primary pool
+        self.seconds = None
+        self.error = None
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, name='pool-warmup', daemon=True).start()
+
+    def run(self):
+        start = time.perf_counter()
+        while True:
+            try:
+                prewarm_pool(self.db, self.count)
+                break
+            except Exception as e:
+                self.error = str(e)
+                logger.warning('Pre-warming the connection pool failed, retrying: %s', e)
+                time.sleep(self.retry_interval)
+        self.error = None
+        for replica in self.replicas:
+            try:
+                prewarm_pool(replica, self.count)
+            except Exception as e:
+                logger.warning('Pre-warming the replica connection pool failed: %s', e)
+        self.seconds = time.perf_counter() - start
+        logger.info('Opened %d connections per pool in %.3f s', self.count, self.seconds)
+        self.ready.set()
+
+
+def connections_per_process() -> int:
+    """Returns the most connections one process can hold at once."""
+    settings = pool_settings()
+    return settings['pool_size'] + settings['max_overflow']
+
+
+def connection_budget(processes: int) -> int:
+    """
+    Returns the most connections the whole service can hold at once.
+
+    MAX_INSTANCES is the number of Cloud Run instances that may run side by side.
+    """
+    return processes * int(os.environ.get('MAX_INSTANCES', '1')) * connections_per_process()
+
+
+def check_connection_budget(processes: int, max_connections: int) -> int:
+    """
+    Fails unless the service fits within the connection limit of the database.
+
+    DB_RESERVED_CONNECTIONS are kept free for administration and migrations.
+    Returns the budget.
+    """
+    budget = connection_budget(processes)
+    available = max_connections - int(os.environ.get('DB_RESERVED_CONNECTIONS', '5'))
+    if budget > available:
+        raise ConnectionBudgetExceeded(
+            '{} processes x {} instances x {} connections = {} connections, but the database '
+            'allows {} ({} reserved). Lower DB_POOL_SIZE, DB_MAX_OVERFLOW, the worker count '
+            'or MAX_INSTANCES.'.format(
+                processes, os.environ.get('MAX_INSTANCES', '1'), connections_per_process(), budget,
+                max_connections, max_connections - available
+            )
+        )
+    return budget
+
+
+def get_max_connections(db: sqlalchemy.engine.base.Engine) -> int | None:
+    """Returns the connection limit of the database: DB_MAX_CONNECTIONS, or the server's own on MySQL."""
+    if os.environ.get('DB_MAX_CONNECTIONS'):
+        return int(os.environ['DB_MAX_CONNECTIONS'])
+    if db.dialect.name != 'mysql':
+        return None
+    with db.connect() as conn:
+        return conn.execute(sqlalchemy.text('SELECT @@max_connections')).scalar()
@@ -0,0 +1,279 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import Gauge, Histogram, registry
+from storage import BusinessNotFound, DuplicateReview, check_review, normalize_stars
+
+logger = logging.getLogger()
+
+# Outcome of a queued review, as the HTTP status the review would have got
+# from a synchronous POST /reviews
+CREATED = 201
+FAILED = 500
+
+JOURNAL_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS queued_reviews ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'review TEXT NOT NULL, '
+    'enqueued_at REAL NOT NULL, '
+    'attempts INTEGER NOT NULL DEFAULT 0, '
+    'claimed_until REAL NOT NULL DEFAULT 0, '
+    'status INTEGER, '
+    'review_id INTEGER, '
+    'resolved_at REAL )',
+    # Reviews waiting for a flush, oldest first
+    'CREATE INDEX IF NOT EXISTS queued_reviews_pending ON queued_reviews (id) WHERE status IS NULL',
+    # Resolved reviews, for dropping them once they are past the retention
+    'CREATE INDEX IF NOT EXISTS queued_reviews_resolved ON queued_reviews (resolved_at) WHERE status IS NOT NULL',
+]
+
+flush_latency = registry.register(Histogram(
+    'review_queue_flush_duration_seconds', 'Time spent writing one group of queued reviews to the database.'
+))
+queue_lag = registry.register(Histogram(
+    'review_queue_lag_seconds', 'Time from queueing a review to writing it to the database.'
+))
+
+
+class QueueFull(RuntimeError):
+    """Raised when the queue already holds its maximum number of pending reviews."""
+
+
+def normalize_review(content: dict) -> dict:
+    """
+    Returns the columns of a review to write or queue.
+
+    Raises ValueError or TypeError for values the reviews table would
+    reject, so that a write only ever fails a review for a missing business
+    or a duplicate.
+    """
+    review = {
+        'user_id': int(content['user_id']),
+        'business_id': int(content['business_id']),
+        'stars': normalize_stars(content['stars']),
+        'review_text': content.get('review_text', None),
+    }
+    if review['review_text'] is not None:
+        review['review_text'] = str(review['review_text'])
+    check_review(review['stars'], review['review_text'])
+    return review
+
+
+class ReviewQueue:
+    """
+    Write-behind queue of review submissions, journaled in a local SQLite file.
+
+    `enqueue` commits a review to the journal and returns its ticket at
+    once, without a database connection. A flusher thread in every process
+    claims the oldest pending reviews, writes them with one `create_reviews`
+    call per group and records each outcome (201, 404 or 409) in the
+    journal, where `status` reads it.
+
+    A claim is a lease: reviews claimed by a process that dies before
+    recording their outcome are claimed again once the lease runs out, so
+    nothing committed to the journal is lost. A replayed review may already
+    have been written by the process that died; it then resolves to the
+    matching review instead of a conflict. Reviews that keep failing for
+    other reasons resolve to 500 after `max_attempts` claims.
+    """
+
+    def __init__(self, path: str, max_depth: int, batch_size: int, interval: float, lease: float, retention: float,
+                 max_attempts: int = 5):
+        self.path = path
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.conn = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.next_cleanup = 0.0
+
+    def open(self):
+        # Autocommit, with explicit transactions around writes. Every commit
+        # is synced to disk before a POST is answered with 202.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = FULL')
+        for statement in JOURNAL_SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def start(self, store, on_created=None) -> None:
+        """Opens the journal and starts flushing it into `store`, calling `on_created` with each written review."""
+        self.store = store
+        self.on_created = on_created
+        self.conn = self.open()
+        registry.register(Gauge('review_queue_depth', 'Reviews waiting in the queue.', self.depth))
+        registry.register(Gauge(
+            'review_queue_oldest_pending_seconds', 'Age of the oldest review waiting in the queue.', self.oldest_age
+        ))
+        self.thread = threading.Thread(target=self.run, name='review-queue-flusher', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stops the flusher after its current group; pending reviews stay in the journal."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so flushers in other
+        # processes wait for it instead of failing to upgrade a read
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM queued_reviews WHERE status IS NULL').fetchone()[0]
+
+    def oldest_age(self) -> float:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT enqueued_at FROM queued_reviews WHERE status IS NULL ORDER BY id LIMIT 1'
+            ).fetchone()
+        return 0.0 if row is None else max(time.time() - row[0], 0.0)
+
+    def enqueue(self, review: dict) -> int:
+        """Journals a normalized review and returns its ticket, or raises QueueFull."""
+        with self.transaction() as conn:
+            depth = conn.execute('SELECT COUNT(*) FROM queued_reviews WHERE status IS NULL').fetchone()[0]
+            if depth >= self.max_depth:
+                raise QueueFull()
+            cursor = conn.execute(
+                'INSERT INTO queued_reviews (review, enqueued_at) VALUES (?, ?)', (json.dumps(review), time.time())
+            )
+        return cursor.lastrowid
+
+    def status(self, ticket: int):
+        """Returns the status (None while pending) and review id of a ticket, or None when it does not exist."""
+        with self.lock:
+            row = self.conn.execute('SELECT status, review_id FROM queued_reviews WHERE id = ?', (ticket,)).fetchone()
+        return None if row is None else {'status': row[0], 'review_id': row[1]}
+
+    def claim(self):
+        """Leases the oldest pending reviews that no live flusher holds."""
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, review, enqueued_at, attempts FROM queued_reviews '
+                'WHERE status IS NULL AND claimed_until <= ? ORDER BY id LIMIT ?',
+                (now, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    'UPDATE queued_reviews SET claimed_until = ?, attempts = attempts + 1 WHERE id IN ({})'.format(
+                        ', '.join('?' * len(rows))
+                    ),
+                    [now + self.lease] + [row[0] for row in rows]
+                )
+        return [(ticket, json.loads(review), enqueued_at, attempts + 1) for ticket, review, enqueued_at, attempts in rows]
+
+    def resolve(self, outcomes) -> None:
+        """Records the (ticket, status, review_id) outcomes of flushed reviews."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                'UPDATE queued_reviews SET status = ?, review_id = ?, resolved_at = ? WHERE id = ?',
+                [(status, review_id, now, ticket) for ticket, status, review_id in outcomes]
+            )
+
+    def outcome(self, review, result, attempts):
+        """Translates a create_reviews result into a (status, review_id) pair."""
+        if isinstance(result, BusinessNotFound):
+            return 404, None
+        if isinstance(result, DuplicateReview):
+            if attempts > 1:
+                # An earlier attempt may have written the review before its
+                # process died
+                existing = self.store.find_review(review['user_id'], review['business_id'])
+                if existing is not None and all(existing[column] == review[column] for column in ('stars', 'review_text')):
+                    return CREATED, existing['id']
+            return 409, None
+        return CREATED, result
+
+    def flush(self) -> int:
+        """Writes one group of pending reviews and returns its size."""
+        items = self.claim()
+        if not items:
+            return 0
+        start = time.perf_counter()
+        try:
+            results = self.store.create_reviews([review for _, review, _, _ in items])
+        except Exception:
+            logger.exception('Writing %d queued reviews failed, retrying in %d seconds', len(items), self.lease)
+            self.resolve([(ticket, FAILED, None) for ticket, _, _, attempts in items if attempts >= self.max_attempts])
+            return 0
+        outcomes = []
+        for (ticket, review, _, attempts), result in zip(items, results):
+            status, review_id = self.outcome(review, result, attempts)
+            outcomes.append((ticket, status, review_id))
+            if status == CREATED and self.on_created is not None:
+                self.on_created(review)
+        self.resolve(outcomes)
+        flush_latency.observe(time.perf_counter() - start)
+        now = time.time()
+        for _, _, enqueued_at, _ in items:
+            queue_lag.observe(now - enqueued_at)
+        return len(items)
+
+    def cleanup(self) -> None:
+        """Drops resolved tickets older than the retention, at most once a minute."""
+        now = time.time()
+        if now < self.next_cleanup:
+            return
+        self.next_cleanup = now + 60
+        with self.lock:
+            self.conn.execute('DELETE FROM queued_reviews WHERE status IS NOT NULL AND resolved_at < ?', (now - self.retention,))
+
+    def run(self):
+        # Full groups are written back to back; otherwise wait `interval` so
+        # that a burst is written in a few large transactions
+        while not self.stopping.is_set():
+            try:
+                flushed = self.flush()
+                self.cleanup()
+            except Exception:
+                logger.exception('The review queue flusher failed')
+                flushed = 0
+            if flushed < self.batch_size:
+                self.stopping.wait(self.interval)
+
+
+def init_review_queue(batch_size: int):
+    """
+    Builds the review queue from the environment, or returns None.
+
+    REVIEW_QUEUE_PATH names the journal file and turns the queue on. Every
+    worker process on the host shares it. REVIEW_QUEUE_MAX_DEPTH caps the
+    pending reviews, REVIEW_QUEUE_INTERVAL is the pause in seconds between
+    flushes that are not full, REVIEW_QUEUE_LEASE how long a flusher holds
+    the reviews it claimed, and REVIEW_QUEUE_RETENTION how long the outcome
+    of a ticket is kept.
+    """
+    path = os.environ.get('REVIEW_QUEUE_PATH')
+    if not path:
+        return None
+    return ReviewQueue(
+        path,
+        max_depth=int(os.environ.get('REVIEW_QUEUE_MAX_DEPTH', '10000')),
+        batch_size=batch_size,
+        interval=float(os.environ.get('REVIEW_QUEUE_INTERVAL', '0.05')),
+        lease=float(os.environ.get('REVIEW_QUEUE_LEASE', '30')),
+        retention=float(os.environ.get('REVIEW_QUEUE_RETENTION', '86400')),
+    )
@@ -0,0 +1,134 @@
+from storage import BUSINESS_COLUMNS, REVIEW_COLUMNS
+
+# Attributes of the business and review resources, as `fields` may name them
+BUSINESS_FIELDS = BUSINESS_COLUMNS + ['review_count', 'average_stars', 'self']
+REVIEW_FIELDS = ['id', 'user_id', 'business', 'stars', 'review_text', 'self']
+
+# Columns an attribute is computed from, when it is not a column itself
+BUSINESS_FIELD_COLUMNS = {'average_stars': ['review_count', 'star_sum'], 'self': ['id']}
+REVIEW_FIELD_COLUMNS = {'business': ['business_id'], 'self': ['id']}
+# Links of a review that `expand` may replace with the resource they point to
+REVIEW_EXPANSIONS = ['business']
+
+
+def average_stars(review_count, star_sum):
+    """The average rating to two decimals, None without reviews."""
+    return round(star_sum / review_count, 2) if review_count else None
+
+
+class InvalidFields(ValueError):
+    """Raised when `fields` names an attribute the resource does not have."""
+
+
+class InvalidExpand(ValueError):
+    """Raised when `expand` names a link the resource does not have."""
+
+
+def parse_list(value):
+    return frozenset(item.strip() for item in value.split(',') if item.strip())
+
+
+def parse_fields(value, allowed):
+    """Returns the attributes listed in a `fields` parameter, or None when it is absent."""
+    if value is None:
+        return None
+    fields = parse_list(value)
+    if not fields or not fields <= set(allowed):
+        raise InvalidFields(value)
+    return fields
+
+
+def parse_expand(value, allowed):
+    """Returns the links listed in an `expand` parameter, empty when it is absent."""
+    if value is None:
+        return frozenset()
+    expand = parse_list(value)
+    if not expand or not expand <= set(allowed):
+        raise InvalidExpand(value)
+    return expand
+
+
+def field_columns(fields, field_columns, required=()):
+    """Returns the columns to read for a projection, always with the id and `required`, or None for all."""
+    if fields is None:
+        return None
+    columns = ['id']
+    for field in fields:
+        for column in field_columns.get(field, [field]):
+            if column not in columns:
+                columns.append(column)
+    return columns + [column for column in required if column not in columns]
+
+
+class Serializer:
+    """
+    Turns the rows of one request into business and review resources.
+
+    Link prefixes are built once per request rather than once per row, and
+    with `fields` only those attributes are returned. Rows are changed in
+    place, so callers pass a copy of anything they keep, such as a cached
+    row.
+
+    Given a `business_loader`, reviews embed their whole business
+    instead of linking to it. `reviews` loads the businesses of the whole
+    list at once, so each is fetched a single time. Rows that already have
+    a `business`, joined by the store, embed that one instead.
+    """
+
+    def __init__(self, url_root: str, fields=None, business_loader=None):
+        root = url_root.strip('/')
+        self.business_url = root + '/businesses/'
+        self.review_url = root + '/reviews/'
+        self.fields = fields
+        self.business_loader = business_loader
+
+    def project(self, resource):
+        if self.fields is None:
+            return resource
+        return {field: resource[field] for field in self.fields if field in resource}
+
+    def etag(self, etag):
+        """The ETag of a cached row in the representation this serializer returns."""
+        return etag if self.fields is None else etag + '-' + '-'.join(sorted(self.fields))
+
+    def review_etag(self, entry):
+        """The ETag of a cached review, which covers the business it embeds."""
+        etag = self.etag(entry.etag)
+        if self.business_loader is not None:
+            business = self.business_loader.entry(entry.value['business_id'])
+            etag += '-' + (business.etag if business is not None else 'none')
+        return etag
+
+    def business(self, row):
+        return self.project(self.whole_business(row))
+
+    def whole_business(self, row):
+        # The star sum is replaced with the average rating
+        if 'star_sum' in row:
+            row['average_stars'] = average_stars(row['review_count'], row.pop('star_sum'))
+        row['self'] = self.business_url + str(row['id'])
+        return row
+
+    def review(self, row):
+        row['self'] = self.review_url + str(row['id'])
+        # Reviews link to their business instead of showing its id
+        if 'business_id' in row:
+            business_id = row.pop('business_id')
+            if 'business' in row:
+                # Joined by the store, as streamed reviews are
+                business = row['business']
+                row['business'] = None if business is None else self.whole_business(business)
+            elif self.business_loader is None:
+                row['business'] = self.business_url + str(business_id)
+            else:
+                business = self.business_loader.get(business_id)
+                row['business'] = None if business is None else self.whole_business(business)
+        return self.project(row)
+
+    def businesses(self, rows):
+        return [self.business(row) for row in rows]
+
+    def reviews(self, rows):
+        if self.business_loader is not None:
+            self.business_loader.load([row['business_id'] for row in rows if 'business_id' in row and 'business' not in row])
+        return [self.review(row) for row in rows]
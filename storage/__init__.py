@@ -0,0 +1,14 @@
+from storage.base import (
+    BUSINESS_COLUMNS, BUSINESS_FILTERS, CHANGE_COLUMNS, CHANGE_OPERATIONS, DELETED, REVIEW_COLUMNS, STAR_COLUMNS,
+    BusinessNotFound, DuplicateReview, StorageError, Store, check_review, normalize_stars,
+    rating_milli
+)
+from storage.memory import MemoryStore
+from storage.replica import ReplicaStore
+from storage.sql import SqlStore
+
+__all__ = [
+    'BUSINESS_COLUMNS', 'BUSINESS_FILTERS', 'CHANGE_COLUMNS', 'CHANGE_OPERATIONS', 'DELETED', 'REVIEW_COLUMNS',
+    'STAR_COLUMNS', 'BusinessNotFound', 'DuplicateReview', 'MemoryStore', 'ReplicaStore', 'SqlStore', 'StorageError', 'Store',
+    'check_review', 'normalize_stars', 'rating_milli',
+]
@@ -0,0 +1,208 @@
+class StorageError(Exception):
+    """Base class of the errors a store raises for rejected writes."""
+
+
+class BusinessNotFound(StorageError):
+    """A review referenced a business that does not exist."""
+
+
+class DuplicateReview(StorageError):
+    """The user already reviewed this business."""
+
+
+BUSINESS_COLUMNS = ['id', 'owner_id', 'name', 'street_address', 'city', 'state', 'zip_code']
+# Review aggregates returned with every business
+BUSINESS_STATS_COLUMNS = ['review_count', 'star_sum']
+# Star histogram, the number of reviews with 0 to 5 stars
+STAR_COLUMNS = ['stars_{}'.format(n) for n in range(6)]
+# Columns GET /businesses filters on by equality, each with an index on (column, id)
+BUSINESS_FILTERS = ['owner_id', 'city', 'state', 'zip_code']
+REVIEW_COLUMNS = ['id', 'user_id', 'business_id', 'stars', 'review_text']
+# Entries of the change log. `collection` is 'businesses' or 'reviews',
+# `operation` one of CHANGE_OPERATIONS and `changed_at` a Unix timestamp.
+CHANGE_COLUMNS = ['id', 'collection', 'resource_id', 'operation', 'changed_at']
+CREATED, UPDATED, DELETED = CHANGE_OPERATIONS = ('create', 'update', 'delete')
+# Length of the review_text VARCHAR column
+REVIEW_TEXT_LENGTH = 1000
+
+
+def normalize_stars(stars) -> int:
+    """
+    Returns the stars of a review as the whole number from 0 to 5 it is
+    stored as.
+
+    Raises ValueError for fractions, which MySQL would round and SQLite keep
+    as they are, and for numbers out of range, TypeError for non-numbers.
+    """
+    if isinstance(stars, bool) or isinstance(stars, float) and not stars.is_integer():
+        raise ValueError('Stars must be a whole number')
+    value = int(stars)
+    if not 0 <= value <= 5:
+        raise ValueError('Check constraint on stars is violated')
+    return value
+
+
+def check_review(stars, review_text):
+    """Raises ValueError or TypeError for the stars or review_text that the reviews table rejects."""
+    normalize_stars(stars)
+    if review_text is not None and len(str(review_text)) > REVIEW_TEXT_LENGTH:
+        raise ValueError('Data too long for column review_text')
+
+
+def rating_milli(review_count: int, star_sum: int) -> int:
+    """The average rating times 1000, rounded down, as the rating_milli column stores it."""
+    return star_sum * 1000 // review_count if review_count else 0
+
+
+class Store:
+    """
+    Data access for businesses and reviews.
+
+    Rows are plain dicts keyed by column name. Every method runs in its own
+    transaction, so a store can be shared by all request threads. Listings
+    are ordered by id, and `after` / `limit` implement keyset pagination.
+    Business listings take `filters`, a dict of BUSINESS_FILTERS values that
+    every returned business matches. Listings also take `columns`, which
+    narrows the columns read to those the response needs; None reads all,
+    and a store may return more.
+
+    Businesses carry review aggregates (BUSINESS_STATS_COLUMNS and
+    STAR_COLUMNS) that every review write updates in its own transaction.
+
+    Every write also appends to a change log, in the same transaction, an
+    entry per resource it created, updated or deleted: a review write
+    updates its business, and deleting a business deletes its reviews.
+    Entry ids increase in the order the entries are written.
+    """
+
+    def ping(self) -> None:
+        """Raises when the database cannot be reached."""
+
+    def create_business(self, business: dict) -> int:
+        """Inserts a business and returns its id."""
+        raise NotImplementedError
+
+    def create_businesses(self, businesses: list) -> list:
+        """Inserts businesses in one transaction and returns their ids in order."""
+        raise NotImplementedError
+
+    def get_business(self, business_id: int):
+        """Returns the business, or None when it does not exist."""
+        raise NotImplementedError
+
+    def get_businesses(self, business_ids: list, columns=None) -> list:
+        """Returns the businesses of `business_ids` that exist, in any order."""
+        raise NotImplementedError
+
+    def update_business(self, business_id: int, business: dict) -> bool:
+        """Replaces the attributes of a business, returns False when it does not exist."""
+        raise NotImplementedError
+
+    def delete_business(self, business_id: int) -> bool:
+        """Deletes a business and its reviews, returns False when it does not exist."""
+        raise NotImplementedError
+
+    def list_businesses(self, limit: int, after: int = 0, offset: int = 0, filters=None, columns=None) -> list:
+        """Returns up to `limit` businesses with an id above `after`, skipping `offset`."""
+        raise NotImplementedError
+
+    def list_businesses_by_rating(self, limit: int, after=None, offset: int = 0, filters=None, columns=None) -> list:
+        """
+        Returns up to `limit` businesses from the best to the worst average
+        rating, ties broken by descending id. `after` is the (rating_milli, id)
+        of the last business of the previous page.
+        """
+        raise NotImplementedError
+
+    def search_businesses(self, prefix: str, limit: int, after=None, offset: int = 0, filters=None, columns=None) -> list:
+        """
+        Returns up to `limit` businesses whose name starts with `prefix`,
+        ignoring case, ordered by name and then id. `after` is the (name, id)
+        of the last business of the previous page.
+        """
+        raise NotImplementedError
+
+    def count_businesses(self, filters=None) -> int:
+        raise NotImplementedError
+
+    def get_business_stats(self, business_id: int):
+        """Returns the review count, star sum and STAR_COLUMNS of a business, or None when it does not exist."""
+        raise NotImplementedError
+
+    def repair_business_stats(self, chunk_size: int = 500) -> int:
+        """Recomputes the review aggregates of all businesses from their reviews and returns how many there are."""
+        raise NotImplementedError
+
+    def list_owner_businesses(self, owner_id: int, after: int = 0, limit=None, columns=None) -> list:
+        raise NotImplementedError
+
+    def stream_owner_businesses(self, owner_id: int, chunk_size: int, columns=None):
+        """Yields all businesses of an owner in lists of at most `chunk_size` rows."""
+        raise NotImplementedError
+
+    def create_review(self, review: dict) -> int:
+        """
+        Inserts a review and returns its id.
+
+        Raises BusinessNotFound or DuplicateReview when a constraint rejects it.
+        """
+        raise NotImplementedError
+
+    def create_reviews(self, reviews: list) -> list:
+        """
+        Inserts reviews and returns, in order, each new id or the StorageError
+        that rejected the review.
+        """
+        raise NotImplementedError
+
+    def get_review(self, review_id: int):
+        """Returns the review, or None when it does not exist."""
+        raise NotImplementedError
+
+    def get_reviews(self, review_ids: list, columns=None) -> list:
+        """Returns the reviews of `review_ids` that exist, in any order."""
+        raise NotImplementedError
+
+    def find_review(self, user_id: int, business_id: int):
+        """Returns the review of a user for a business, or None when there is none."""
+        raise NotImplementedError
+
+    def update_review(self, review_id: int, stars, review_text):
+        """
+        Sets the stars and, unless it is None, the text of a review.
+
+        Returns the review as stored, or None when it does not exist.
+        """
+        raise NotImplementedError
+
+    def delete_review(self, review_id: int):
+        """Deletes a review and returns it, or None when it does not exist."""
+        raise NotImplementedError
+
+    def list_user_reviews(self, user_id: int, after: int = 0, limit=None, columns=None) -> list:
+        raise NotImplementedError
+
+    def stream_user_reviews(self, user_id: int, chunk_size: int, columns=None, with_businesses: bool = False):
+        """
+        Yields all reviews of a user in lists of at most `chunk_size` rows.
+
+        With `with_businesses`, each review also has a `business` key holding
+        its business, read by the same query, or None when it does not exist.
+        """
+        raise NotImplementedError
+
+    def list_changes(self, after: int, limit: int) -> list:
+        """Returns up to `limit` change log entries with an id above `after`, in order."""
+        raise NotImplementedError
+
+    def latest_change(self) -> int:
+        """Returns the id of the newest change log entry, 0 when there is none."""
+        raise NotImplementedError
+
+    def change_horizon(self) -> int:
+        """Returns the id of the newest entry pruned from the change log, 0 when none was."""
+        raise NotImplementedError
+
+    def prune_changes(self, before: float) -> int:
+        """Drops the change log entries written before the timestamp `before` and returns how many there were."""
+        raise NotImplementedError
@@ -0,0 +1,370 @@
+import bisect
+import itertools
+import threading
+import time
+
+from storage.base import (
+    BUSINESS_FILTERS, BUSINESS_STATS_COLUMNS, CREATED, DELETED, STAR_COLUMNS, UPDATED, BusinessNotFound, DuplicateReview, Store,
+    check_review, rating_milli
+)
+
+# Lengths of the VARCHAR columns, enforced like MySQL's strict mode does
+BUSINESS_LENGTHS = {'name': 50, 'street_address': 100, 'city': 50, 'state': 2, 'zip_code': 10}
+
+
+def business_row(business_id, business):
+    """Coerces a business to the column types of the SQL schema."""
+    row = {'id': business_id, 'owner_id': int(business['owner_id'])}
+    for column, length in BUSINESS_LENGTHS.items():
+        if business[column] is None:
+            raise ValueError('Column {} cannot be null'.format(column))
+        value = str(business[column])
+        if len(value) > length:
+            raise ValueError('Data too long for column {}'.format(column))
+        row[column] = value
+    return row
+
+
+def remove_id(ids, item_id):
+    index = bisect.bisect_left(ids, item_id)
+    if index < len(ids) and ids[index] == item_id:
+        del ids[index]
+
+
+def ids_after(ids, after, limit=None):
+    start = bisect.bisect_right(ids, after)
+    return ids[start:] if limit is None else ids[start:start + limit]
+
+
+def name_key(name):
+    """Sort key of a name, ignoring case like SQLite's NOCASE collation."""
+    return name.lower()
+
+
+class MemoryStore(Store):
+    """
+    Keeps businesses and reviews in Python dicts, for profiling the handlers
+    without any database.
+
+    Rows are indexed by id, businesses by every filter column and by name,
+    and reviews by user and by business. The constraints of the SQL schema
+    are checked by hand so that every route answers exactly as it does
+    against MySQL.
+
+    Listings return whole rows, whatever `columns` they are asked for.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.businesses = {}
+        self.reviews = {}
+        # Sorted id lists for ordered and keyset listings
+        self.business_ids = []
+        # {column: {value: sorted ids}} for each of BUSINESS_FILTERS
+        self.filter_ids = {column: {} for column in BUSINESS_FILTERS}
+        # (name_key(name), id) pairs in order, for prefix searches
+        self.name_index = []
+        self.user_review_ids = {}
+        # Review ids by business for cascading deletes
+        self.business_review_ids = {}
+        # Review id by (user_id, business_id), the UNIQUE constraint
+        self.review_keys = {}
+        # Review aggregates by business, and (rating_milli, id) pairs in order
+        self.stats = {}
+        self.rating_index = []
+        self.next_business_id = 1
+        self.next_review_id = 1
+        # Change log entries in id order, their ids, and the newest pruned id
+        self.changes = []
+        self.change_ids = []
+        self.next_change_id = 1
+        self.horizon = 0
+
+    def record_change(self, collection, operation, resource_id):
+        self.changes.append({
+            'id': self.next_change_id,
+            'collection': collection,
+            'resource_id': resource_id,
+            'operation': operation,
+            'changed_at': time.time(),
+        })
+        self.change_ids.append(self.next_change_id)
+        self.next_change_id += 1
+
+    def create_business(self, business):
+        with self.lock:
+            row = business_row(self.next_business_id, business)
+            self.next_business_id += 1
+            self.businesses[row['id']] = row
+            self.business_ids.append(row['id'])
+            self.stats[row['id']] = dict.fromkeys(BUSINESS_STATS_COLUMNS + STAR_COLUMNS, 0)
+            bisect.insort(self.rating_index, (0, row['id']))
+            bisect.insort(self.name_index, (name_key(row['name']), row['id']))
+            for column, ids in self.filter_ids.items():
+                ids.setdefault(row[column], []).append(row['id'])
+            self.record_change('businesses', CREATED, row['id'])
+            return row['id']
+
+    def create_businesses(self, businesses):
+        with self.lock:
+            # Validate every row first so the batch is all or nothing
+            for business in businesses:
+                business_row(0, business)
+            return [self.create_business(business) for business in businesses]
+
+    def business(self, business_id):
+        """Returns a copy of a business row with its aggregates."""
+        stats = self.stats[business_id]
+        return dict(self.businesses[business_id], review_count=stats['review_count'], star_sum=stats['star_sum'])
+
+    def change_stats(self, business_id, stars, sign):
+        """Adds a review with `stars` to the aggregates of its business (sign 1) or removes it (sign -1)."""
+        stats = self.stats.get(business_id)
+        if stats is None:
+            # The business is being deleted
+            return
+        remove_id(self.rating_index, (rating_milli(stats['review_count'], stats['star_sum']), business_id))
+        stats['review_count'] += sign
+        stats['star_sum'] += sign * stars
+        stats[STAR_COLUMNS[stars]] += sign
+        bisect.insort(self.rating_index, (rating_milli(stats['review_count'], stats['star_sum']), business_id))
+
+    def matching(self, business_ids, filters, offset, limit):
+        """Returns up to `limit` businesses of `business_ids` that match `filters`, skipping `offset`."""
+        rows = []
+        for business_id in business_ids:
+            row = self.businesses[business_id]
+            if filters and any(row[column] != value for column, value in filters.items()):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            rows.append(self.business(business_id))
+            if len(rows) == limit:
+                break
+        return rows
+
+    def get_business(self, business_id):
+        with self.lock:
+            return self.business(business_id) if business_id in self.businesses else None
+
+    def get_businesses(self, business_ids, columns=None):
+        with self.lock:
+            return [self.business(i) for i in business_ids if i in self.businesses]
+
+    def update_business(self, business_id, business):
+        with self.lock:
+            old = self.businesses.get(business_id)
+            if old is None:
+                return False
+            row = business_row(business_id, business)
+            for column, ids in self.filter_ids.items():
+                if row[column] != old[column]:
+                    remove_id(ids[old[column]], business_id)
+                    bisect.insort(ids.setdefault(row[column], []), business_id)
+            if row['name'] != old['name']:
+                remove_id(self.name_index, (name_key(old['name']), business_id))
+                bisect.insort(self.name_index, (name_key(row['name']), business_id))
+            self.businesses[business_id] = row
+            self.record_change('businesses', UPDATED, business_id)
+            return True
+
+    def delete_business(self, business_id):
+        with self.lock:
+            row = self.businesses.pop(business_id, None)
+            if row is None:
+                return False
+            remove_id(self.business_ids, business_id)
+            remove_id(self.name_index, (name_key(row['name']), business_id))
+            for column, ids in self.filter_ids.items():
+                remove_id(ids[row[column]], business_id)
+            stats = self.stats.pop(business_id)
+            remove_id(self.rating_index, (rating_milli(stats['review_count'], stats['star_sum']), business_id))
+            for review_id in sorted(self.business_review_ids.pop(business_id, ())):
+                self.delete_review(review_id)
+            self.record_change('businesses', DELETED, business_id)
+            return True
+
+    def list_businesses(self, limit, after=0, offset=0, filters=None, columns=None):
+        with self.lock:
+            if not filters:
+                start = bisect.bisect_right(self.business_ids, after) + offset
+                return [self.business(i) for i in self.business_ids[start:start + limit]]
+            # Walk the ids of the most selective filter, like an index on (column, id)
+            ids = min((self.filter_ids[column].get(value, []) for column, value in filters.items()), key=len)
+            return self.matching(ids[bisect.bisect_right(ids, after):], filters, offset, limit)
+
+    def list_businesses_by_rating(self, limit, after=None, offset=0, filters=None, columns=None):
+        with self.lock:
+            end = len(self.rating_index) if after is None else bisect.bisect_left(self.rating_index, tuple(after))
+            if not filters:
+                end = max(end - offset, 0)
+                return [self.business(i) for _, i in reversed(self.rating_index[max(end - limit, 0):end])]
+            ids = (business_id for _, business_id in reversed(self.rating_index[:end]))
+            return self.matching(ids, filters, offset, limit)
+
+    def search_businesses(self, prefix, limit, after=None, offset=0, filters=None, columns=None):
+        with self.lock:
+            key = name_key(prefix)
+            if after is None:
+                start = bisect.bisect_left(self.name_index, (key,))
+            else:
+                start = bisect.bisect_right(self.name_index, (name_key(after[0]), after[1]))
+            entries = (self.name_index[i] for i in range(start, len(self.name_index)))
+            ids = (business_id for _, business_id in itertools.takewhile(lambda entry: entry[0].startswith(key), entries))
+            return self.matching(ids, filters, offset, limit)
+
+    def get_business_stats(self, business_id):
+        with self.lock:
+            stats = self.stats.get(business_id)
+            return None if stats is None else dict(stats)
+
+    def repair_business_stats(self, chunk_size=500):
+        with self.lock:
+            self.rating_index = []
+            for business_id in self.business_ids:
+                self.stats[business_id] = dict.fromkeys(BUSINESS_STATS_COLUMNS + STAR_COLUMNS, 0)
+                self.rating_index.append((0, business_id))
+            self.rating_index.sort()
+            for review in self.reviews.values():
+                self.change_stats(review['business_id'], review['stars'], 1)
+            return len(self.business_ids)
+
+    def count_businesses(self, filters=None):
+        with self.lock:
+            if not filters:
+                return len(self.businesses)
+            return len(self.matching(self.business_ids, filters, 0, None))
+
+    def list_owner_businesses(self, owner_id, after=0, limit=None, columns=None):
+        with self.lock:
+            ids = ids_after(self.filter_ids['owner_id'].get(owner_id, []), after, limit)
+            return [self.business(i) for i in ids]
+
+    def stream_owner_businesses(self, owner_id, chunk_size, columns=None):
+        rows = self.list_owner_businesses(owner_id)
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def create_review(self, review):
+        with self.lock:
+            user_id = int(review['user_id'])
+            business_id = int(review['business_id'])
+            review_text = review.get('review_text', None)
+            if business_id not in self.businesses:
+                raise BusinessNotFound()
+            if (user_id, business_id) in self.review_keys:
+                raise DuplicateReview()
+            check_review(review['stars'], review_text)
+            row = {
+                'id': self.next_review_id,
+                'user_id': user_id,
+                'business_id': business_id,
+                'stars': int(review['stars']),
+                'review_text': None if review_text is None else str(review_text)
+            }
+            self.next_review_id += 1
+            self.reviews[row['id']] = row
+            self.review_keys[(user_id, business_id)] = row['id']
+            self.user_review_ids.setdefault(user_id, []).append(row['id'])
+            self.business_review_ids.setdefault(business_id, set()).add(row['id'])
+            self.change_stats(business_id, row['stars'], 1)
+            self.record_change('reviews', CREATED, row['id'])
+            self.record_change('businesses', UPDATED, business_id)
+            return row['id']
+
+    def create_reviews(self, reviews):
+        outcomes = []
+        with self.lock:
+            for review in reviews:
+                check_review(review['stars'], review.get('review_text', None))
+            for review in reviews:
+                try:
+                    outcomes.append(self.create_review(review))
+                except (BusinessNotFound, DuplicateReview) as e:
+                    outcomes.append(e)
+        return outcomes
+
+    def get_review(self, review_id):
+        with self.lock:
+            row = self.reviews.get(review_id)
+            return None if row is None else dict(row)
+
+    def get_reviews(self, review_ids, columns=None):
+        with self.lock:
+            return [dict(self.reviews[i]) for i in review_ids if i in self.reviews]
+
+    def find_review(self, user_id, business_id):
+        with self.lock:
+            review_id = self.review_keys.get((user_id, business_id))
+            return None if review_id is None else dict(self.reviews[review_id])
+
+    def update_review(self, review_id, stars, review_text):
+        with self.lock:
+            row = self.reviews.get(review_id)
+            if row is None:
+                return None
+            check_review(stars, review_text)
+            self.change_stats(row['business_id'], row['stars'], -1)
+            self.change_stats(row['business_id'], int(stars), 1)
+            self.record_change('reviews', UPDATED, review_id)
+            if int(stars) != row['stars']:
+                self.record_change('businesses', UPDATED, row['business_id'])
+            row['stars'] = int(stars)
+            if review_text is not None:
+                row['review_text'] = str(review_text)
+            return dict(row)
+
+    def delete_review(self, review_id):
+        with self.lock:
+            row = self.reviews.pop(review_id, None)
+            if row is None:
+                return None
+            self.change_stats(row['business_id'], row['stars'], -1)
+            del self.review_keys[(row['user_id'], row['business_id'])]
+            remove_id(self.user_review_ids[row['user_id']], review_id)
+            review_ids = self.business_review_ids.get(row['business_id'])
+            if review_ids is not None:
+                review_ids.discard(review_id)
+            self.record_change('reviews', DELETED, review_id)
+            # Unless the business itself is being deleted
+            if row['business_id'] in self.stats:
+                self.record_change('businesses', UPDATED, row['business_id'])
+            return row
+
+    def list_user_reviews(self, user_id, after=0, limit=None, columns=None):
+        with self.lock:
+            ids = ids_after(self.user_review_ids.get(user_id, []), after, limit)
+            return [dict(self.reviews[i]) for i in ids]
+
+    def stream_user_reviews(self, user_id, chunk_size, columns=None, with_businesses=False):
+        with self.lock:
+            rows = [dict(self.reviews[i]) for i in self.user_review_ids.get(user_id, [])]
+            if with_businesses:
+                for row in rows:
+                    business_id = row['business_id']
+                    row['business'] = self.business(business_id) if business_id in self.businesses else None
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def list_changes(self, after, limit):
+        with self.lock:
+            start = bisect.bisect_right(self.change_ids, after)
+            return [dict(change) for change in self.changes[start:start + limit]]
+
+    def latest_change(self):
+        with self.lock:
+            return self.next_change_id - 1
+
+    def change_horizon(self):
+        with self.lock:
+            return self.horizon
+
+    def prune_changes(self, before):
+        with self.lock:
+            count = bisect.bisect_left([change['changed_at'] for change in self.changes], before)
+            if count:
+                self.horizon = self.change_ids[count - 1]
+                del self.changes[:count]
+                del self.change_ids[:count]
+            return count
@@ -0,0 +1,132 @@
+import itertools
+import logging
+import threading
+
+import sqlalchemy
+
+from storage.base import Store
+
+logger = logging.getLogger()
+
+# Errors that mean the replica cannot be reached, as opposed to a bad query
+REPLICA_ERRORS = (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)
+
+
+class ReplicaStore(Store):
+    """
+    Serves reads from a read replica, and from the primary while the replica
+    is unhealthy.
+
+    A read that fails to reach the replica marks it unhealthy and is retried
+    on the primary. So does a probe (`check`) that fails, and the next probe
+    that succeeds marks the replica healthy again, so requests never wait
+    for an unreachable replica twice in a row. Streams fall back when the
+    replica fails before their first chunk.
+
+    Only reads are supported: writes must go to the primary store.
+    """
+
+    def __init__(self, primary: Store, replica: Store):
+        self.primary = primary
+        self.replica = replica
+        self.healthy = True
+        self.stopping = threading.Event()
+
+    def mark_unhealthy(self, e):
+        if self.healthy:
+            logger.warning('Read replica unhealthy, reading from the primary: %s', e)
+        self.healthy = False
+
+    def check(self) -> bool:
+        """Probes the replica and records whether it answers."""
+        try:
+            self.replica.ping()
+        except REPLICA_ERRORS as e:
+            self.mark_unhealthy(e)
+            return False
+        if not self.healthy:
+            logger.info('Read replica healthy again')
+        self.healthy = True
+        return True
+
+    def start_health_checks(self, interval: float) -> None:
+        """Probes the replica every `interval` seconds from a background thread."""
+        def run():
+            while not self.stopping.wait(interval):
+                self.check()
+
+        threading.Thread(target=run, name='replica-health-check', daemon=True).start()
+
+    def read(self, name, *args, **kwargs):
+        if self.healthy:
+            try:
+                return getattr(self.replica, name)(*args, **kwargs)
+            except REPLICA_ERRORS as e:
+                self.mark_unhealthy(e)
+        return getattr(self.primary, name)(*args, **kwargs)
+
+    def stream(self, name, *args, **kwargs):
+        if self.healthy:
+            chunks = getattr(self.replica, name)(*args, **kwargs)
+            try:
+                # The replica is only connected to when the stream starts
+                first = next(chunks, None)
+            except REPLICA_ERRORS as e:
+                self.mark_unhealthy(e)
+            else:
+                return chunks if first is None else itertools.chain([first], chunks)
+        return getattr(self.primary, name)(*args, **kwargs)
+
+    def ping(self):
+        self.replica.ping()
+
+    def get_business(self, business_id):
+        return self.read('get_business', business_id)
+
+    def get_businesses(self, business_ids, columns=None):
+        return self.read('get_businesses', business_ids, columns=columns)
+
+    def list_businesses(self, limit, after=0, offset=0, filters=None, columns=None):
+        return self.read('list_businesses', limit, after=after, offset=offset, filters=filters, columns=columns)
+
+    def list_businesses_by_rating(self, limit, after=None, offset=0, filters=None, columns=None):
+        return self.read('list_businesses_by_rating', limit, after=after, offset=offset, filters=filters, columns=columns)
+
+    def search_businesses(self, prefix, limit, after=None, offset=0, filters=None, columns=None):
+        return self.read('search_businesses', prefix, limit, after=after, offset=offset, filters=filters, columns=columns)
+
+    def count_businesses(self, filters=None):
+        return self.read('count_businesses', filters)
+
+    def get_business_stats(self, business_id):
+        return self.read('get_business_stats', business_id)
+
+    def list_owner_businesses(self, owner_id, after=0, limit=None, columns=None):
+        return self.read('list_owner_businesses', owner_id, after=after, limit=limit, columns=columns)
+
+    def stream_owner_businesses(self, owner_id, chunk_size, columns=None):
+        return self.stream('stream_owner_businesses', owner_id, chunk_size, columns=columns)
+
+    def get_review(self, review_id):
+        return self.read('get_review', review_id)
+
+    def get_reviews(self, review_ids, columns=None):
+        return self.read('get_reviews', review_ids, columns=columns)
+
+    def find_review(self, user_id, business_id):
+        return self.read('find_review', user_id, business_id)
+
+    def list_user_reviews(self, user_id, after=0, limit=None, columns=None):
+        return self.read('list_user_reviews', user_id, after=after, limit=limit, columns=columns)
+
+    def stream_user_reviews(self, user_id, chunk_size, columns=None, with_businesses=False):
+        return self.stream('stream_user_reviews', user_id, chunk_size, columns=columns, with_businesses=with_businesses)
+
+    def list_changes(self, after, limit):
+        return self.read('list_changes', after, limit)
+
+    def latest_change(self):
+        return self.read('latest_change')
+
+    def change_horizon(self):
+        return self.read('change_horizon')
@@ -0,0 +1,614 @@
+import time
+
+import sqlalchemy
+
+from migrations import REPAIR_REVIEW_AGGREGATES
+from storage.base import (
+    BUSINESS_COLUMNS, BUSINESS_FILTERS, BUSINESS_STATS_COLUMNS, CHANGE_COLUMNS, CREATED, DELETED, REVIEW_COLUMNS, STAR_COLUMNS,
+    UPDATED, BusinessNotFound, DuplicateReview, Store
+)
+
+# MySQL error codes of UNIQUE and FOREIGN KEY constraint violations
+MYSQL_ER_DUP_ENTRY = 1062
+MYSQL_ER_NO_REFERENCED_ROW = 1452
+
+BUSINESS_ATTRIBUTES = BUSINESS_COLUMNS[1:]
+SELECT_BUSINESSES = 'SELECT {} FROM businesses '.format(', '.join(BUSINESS_COLUMNS + BUSINESS_STATS_COLUMNS))
+SELECT_REVIEWS = 'SELECT {} FROM reviews '.format(', '.join(REVIEW_COLUMNS))
+SELECT_CHANGES = 'SELECT {} FROM changes '.format(', '.join(CHANGE_COLUMNS))
+# Columns listings can be narrowed to
+BUSINESS_SELECTABLE = frozenset(BUSINESS_COLUMNS + BUSINESS_STATS_COLUMNS)
+REVIEW_SELECTABLE = frozenset(REVIEW_COLUMNS)
+
+# Escape character of LIKE patterns, one that MySQL does not treat specially
+# inside string literals
+LIKE_ESCAPE = '!'
+
+# SQLite's NOCASE collation folds ASCII letters only
+NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def multi_row_values(columns, count):
+    """Returns the VALUES list of a multi-row INSERT with numbered parameters."""
+    return ', '.join(
+        '(' + ', '.join(':{}_{}'.format(column, i) for column in columns) + ')'
+        for i in range(count)
+    )
+
+
+def select(table, columns):
+    return 'SELECT {} FROM {} '.format(', '.join(columns), table)
+
+
+def as_dicts(result):
+    """Returns the rows of a result as dicts, about twice as fast as Row._asdict() per row."""
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result]
+
+
+def like_prefix(prefix):
+    """Returns a LIKE pattern that matches the strings starting with `prefix`."""
+    for char in (LIKE_ESCAPE, '%', '_'):
+        prefix = prefix.replace(char, LIKE_ESCAPE + char)
+    return prefix + '%'
+
+
+def nocase_prefix_range(prefix):
+    """Returns the bounds, under the NOCASE collation, of the strings starting with `prefix`."""
+    low = prefix.translate(NOCASE)
+    return low, low[:-1] + chr(ord(low[-1]) + 1)
+
+
+def filter_conditions(filters, parameters):
+    """Returns the WHERE conditions of business filters, adding their values to `parameters`."""
+    conditions = []
+    for column in BUSINESS_FILTERS:
+        if filters and column in filters:
+            conditions.append('{0} = :{0}'.format(column))
+            parameters[column] = filters[column]
+    return conditions
+
+
+def where(conditions):
+    return 'WHERE {} '.format(' AND '.join(conditions)) if conditions else ''
+
+
+def stats_deltas(deltas, business_id, stars, sign):
+    """Adds a review with `stars` (sign 1) or removes it (sign -1) from the aggregate changes of its business."""
+    changes = deltas.setdefault(int(business_id), {})
+    for column, delta in (('review_count', sign), ('star_sum', sign * int(stars)), (STAR_COLUMNS[int(stars)], sign)):
+        changes[column] = changes.get(column, 0) + delta
+    return deltas
+
+
+def multi_row_parameters(columns, rows):
+    parameters = {}
+    for i, row in enumerate(rows):
+        for column in columns:
+            parameters['{}_{}'.format(column, i)] = row.get(column)
+    return parameters
+
+
+class SqlStore(Store):
+    """
+    Stores businesses and reviews through a SQLAlchemy engine.
+
+    Runs against Cloud SQL for MySQL in production and against SQLite
+    locally. Both schemas come from migrations.py and enforce the same
+    constraints, the few dialect differences are handled here.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.base.Engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    def connect(self):
+        return self.engine.connect()
+
+    def ping(self):
+        with self.connect() as conn:
+            conn.execute(sqlalchemy.text('SELECT 1'))
+
+    @staticmethod
+    def select_businesses(columns):
+        if columns is None:
+            return SELECT_BUSINESSES
+        if not BUSINESS_SELECTABLE.issuperset(columns):
+            raise ValueError('Unknown business columns: {}'.format(', '.join(sorted(set(columns) - BUSINESS_SELECTABLE))))
+        return select('businesses', columns)
+
+    @staticmethod
+    def select_reviews(columns):
+        if columns is None:
+            return SELECT_REVIEWS
+        if not REVIEW_SELECTABLE.issuperset(columns):
+            raise ValueError('Unknown review columns: {}'.format(', '.join(sorted(set(columns) - REVIEW_SELECTABLE))))
+        return select('reviews', columns)
+
+    def first_insert_id(self, result, count):
+        # A multi-row INSERT allocates consecutive ids. MySQL reports the
+        # first of them and SQLite the last one.
+        if self.dialect == 'sqlite':
+            return result.lastrowid - count + 1
+        return result.lastrowid
+
+    def review_error(self, e):
+        """Translates a constraint violation of a review INSERT."""
+        if self.dialect == 'sqlite':
+            message = str(e.orig)
+            if message.startswith('UNIQUE'):
+                return DuplicateReview()
+            if message.startswith('FOREIGN KEY'):
+                return BusinessNotFound()
+        else:
+            code = e.orig.args[0]
+            if code == MYSQL_ER_DUP_ENTRY:
+                return DuplicateReview()
+            if code == MYSQL_ER_NO_REFERENCED_ROW:
+                return BusinessNotFound()
+        return None
+
+    def update_stats(self, conn, deltas):
+        """
+        Applies aggregate changes, {business_id: {column: delta}}, to any
+        number of businesses with a single UPDATE.
+        """
+        columns = sorted({column for changes in deltas.values() for column in changes})
+        business_ids = list(deltas)
+        parameters = {'id_{}'.format(i): business_id for i, business_id in enumerate(business_ids)}
+        assignments = []
+        for column in columns:
+            cases = []
+            for i, business_id in enumerate(business_ids):
+                parameters['{}_{}'.format(column, i)] = deltas[business_id].get(column, 0)
+                cases.append('WHEN :id_{0} THEN :{1}_{0}'.format(i, column))
+            assignments.append('{0} = {0} + CASE id {1} ELSE 0 END'.format(column, ' '.join(cases)))
+        stmt = sqlalchemy.text('UPDATE businesses SET {} WHERE id IN ({})'.format(
+            ', '.join(assignments), ', '.join(':id_{}'.format(i) for i in range(len(business_ids)))
+        ))
+        conn.execute(stmt, parameters=parameters)
+
+    def record_changes(self, conn, collection, operation, resource_ids):
+        """Appends an entry per resource to the change log, in the transaction of the write."""
+        if not resource_ids:
+            return
+        rows = [{'collection': collection, 'resource_id': resource_id, 'operation': operation, 'changed_at': time.time()}
+                for resource_id in resource_ids]
+        stmt = sqlalchemy.text('INSERT INTO changes ({}) VALUES {}'.format(
+            ', '.join(CHANGE_COLUMNS[1:]), multi_row_values(CHANGE_COLUMNS[1:], len(rows))
+        ))
+        conn.execute(stmt, parameters=multi_row_parameters(CHANGE_COLUMNS[1:], rows))
+
+    def lock_review(self, conn, review_id):
+        """Reads a review that is about to change, so no other writer changes it first."""
+        sql = SELECT_REVIEWS + 'WHERE id = :review_id'
+        if self.dialect == 'mysql':
+            sql += ' FOR UPDATE'
+        else:
+            # SQLite has no row locks: a write takes the database write lock
+            # before the read, instead of failing to upgrade a read lock later
+            conn.execute(sqlalchemy.text('UPDATE reviews SET id = id WHERE id = :review_id'), parameters={'review_id': review_id})
+        row = conn.execute(sqlalchemy.text(sql), parameters={'review_id': review_id}).one_or_none()
+        return None if row is None else row._asdict()
+
+    def create_business(self, business):
+        stmt = sqlalchemy.text(
+            'INSERT INTO businesses (owner_id, name, street_address, city, state, zip_code) '
+            'VALUES (:owner_id, :name, :street_address, :city, :state, :zip_code)'
+        )
+        with self.connect() as conn:
+            result = conn.execute(stmt, parameters={attr: business[attr] for attr in BUSINESS_ATTRIBUTES})
+            self.record_changes(conn, 'businesses', CREATED, [result.lastrowid])
+            conn.commit()
+        # The driver reports the generated id without another round trip
+        return result.lastrowid
+
+    def create_businesses(self, businesses):
+        stmt = sqlalchemy.text('INSERT INTO businesses ({}) VALUES {}'.format(
+            ', '.join(BUSINESS_ATTRIBUTES), multi_row_values(BUSINESS_ATTRIBUTES, len(businesses))
+        ))
+        with self.connect() as conn:
+            result = conn.execute(stmt, parameters=multi_row_parameters(BUSINESS_ATTRIBUTES, businesses))
+            first_id = self.first_insert_id(result, len(businesses))
+            business_ids = [first_id + i for i in range(len(businesses))]
+            self.record_changes(conn, 'businesses', CREATED, business_ids)
+            conn.commit()
+        return business_ids
+
+    def get_business(self, business_id):
+        stmt = sqlalchemy.text(SELECT_BUSINESSES + 'WHERE id = :business_id')
+        with self.connect() as conn:
+            row = conn.execute(stmt, parameters={'business_id': business_id}).one_or_none()
+        return None if row is None else row._asdict()
+
+    def get_businesses(self, business_ids, columns=None):
+        stmt = sqlalchemy.text(self.select_businesses(columns) + 'WHERE id IN :business_ids').bindparams(
+            sqlalchemy.bindparam('business_ids', expanding=True)
+        )
+        with self.connect() as conn:
+            return as_dicts(conn.execute(stmt, parameters={'business_ids': list(business_ids)}))
+
+    def update_business(self, business_id, business):
+        # The matched row count tells whether the business exists
+        stmt = sqlalchemy.text(
+            'UPDATE businesses SET '
+            'owner_id = :owner_id, '
+            'name = :name, '
+            'street_address = :street_address, '
+            'city = :city, '
+            'state = :state, '
+            'zip_code = :zip_code '
+            'WHERE id = :business_id'
+        )
+        parameters = {attr: business[attr] for attr in BUSINESS_ATTRIBUTES}
+        parameters['business_id'] = business_id
+        with self.connect() as conn:
+            result = conn.execute(stmt, parameters=parameters)
+            if result.rowcount == 0:
+                return False
+            self.record_changes(conn, 'businesses', UPDATED, [business_id])
+            conn.commit()
+        return True
+
+    def delete_business(self, business_id):
+        # Reviews of the business are removed by ON DELETE CASCADE, so their
+        # deletions are logged first, straight from the reviews index
+        stmt = sqlalchemy.text('DELETE FROM businesses WHERE id = :business_id')
+        with self.connect() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO changes ({}) SELECT 'reviews', id, :operation, :changed_at FROM reviews "
+                    "WHERE business_id = :business_id".format(', '.join(CHANGE_COLUMNS[1:]))
+                ),
+                parameters={'operation': DELETED, 'changed_at': time.time(), 'business_id': business_id}
+            )
+            result = conn.execute(stmt, parameters={'business_id': business_id})
+            if result.rowcount == 0:
+                return False
+            self.record_changes(conn, 'businesses', DELETED, [business_id])
+            conn.commit()
+        return True
+
+    def list_businesses(self, limit, after=0, offset=0, filters=None, columns=None):
+        # A filter walks its (column, id) index from `after`
+        parameters = {'after': after, 'limit': limit, 'offset': offset}
+        conditions = ['id > :after'] + filter_conditions(filters, parameters)
+        stmt = sqlalchemy.text(self.select_businesses(columns) + where(conditions) + 'ORDER BY id LIMIT :limit OFFSET :offset')
+        with self.connect() as conn:
+            return as_dicts(conn.execute(stmt, parameters=parameters))
+
+    def list_businesses_by_rating(self, limit, after=None, offset=0, filters=None, columns=None):
+        # Walks the (rating_milli, id) index backwards
+        parameters = {'limit': limit, 'offset': offset}
+        conditions = filter_conditions(filters, parameters)
+        if after is not None:
+            conditions.append('rating_milli <= :rating AND (rating_milli < :rating OR id < :after)')
+            parameters['rating'], parameters['after'] = after
+        sql = self.select_businesses(columns) + where(conditions) + 'ORDER BY rating_milli DESC, id DESC LIMIT :limit OFFSET :offset'
+        with self.connect() as conn:
+            return as_dicts(conn.execute(sqlalchemy.text(sql), parameters=parameters))
+
+    def search_businesses(self, prefix, limit, after=None, offset=0, filters=None, columns=None):
+        # A prefix is a range scan of the (name, id) index, from the prefix
+        # or the cursor to the end of the prefix
+        parameters = {'limit': limit, 'offset': offset}
+        conditions = filter_conditions(filters, parameters)
+        if self.dialect == 'sqlite':
+            # The index has the NOCASE collation, which comparisons and the
+            # sort spell out to use it. SQLite narrows a range by a single
+            # lower bound, so the prefix and the cursor are merged into one.
+            name = 'name COLLATE NOCASE'
+            low, high = nocase_prefix_range(prefix) if prefix else ('', None)
+            if after is not None:
+                low = max(low, after[0].translate(NOCASE))
+            if low:
+                conditions.append(name + ' >= :low')
+                parameters['low'] = low
+            if high is not None:
+                conditions.append(name + ' < :high')
+                parameters['high'] = high
+            if after is not None:
+                conditions.append('({} > :after_name OR id > :after)'.format(name))
+                parameters['after_name'], parameters['after'] = after
+        else:
+            # The default collation ignores case, and the range optimizer
+            # combines the pattern with the cursor
+            name = 'name'
+            if prefix:
+                conditions.append("name LIKE :pattern ESCAPE '{}'".format(LIKE_ESCAPE))
+                parameters['pattern'] = like_prefix(prefix)
+            if after is not None:
+                conditions.append('name >= :after_name AND (name > :after_name OR id > :after)')
+                parameters['after_name'], parameters['after'] = after
+        sql = self.select_businesses(columns) + where(conditions) + 'ORDER BY {}, id LIMIT :limit OFFSET :offset'.format(name)
+        with self.connect() as conn:
+            return as_dicts(conn.execute(sqlalchemy.text(sql), parameters=parameters))
+
+    def get_business_stats(self, business_id):
+        stmt = sqlalchemy.text('SELECT {} FROM businesses WHERE id = :business_id'.format(
+            ', '.join(BUSINESS_STATS_COLUMNS + STAR_COLUMNS)
+        ))
+        with self.connect() as conn:
+            row = conn.execute(stmt, parameters={'business_id': business_id}).one_or_none()
+        return None if row is None else row._asdict()
+
+    def repair_business_stats(self, chunk_size=500):
+        # One id range per transaction keeps the row locks short
+        repaired = 0
+        after = 0
+        with self.connect() as conn:
+            while True:
+                ids = conn.execute(
+                    sqlalchemy.text('SELECT id FROM businesses WHERE id > :after ORDER BY id LIMIT :limit'),
+                    parameters={'after': after, 'limit': chunk_size}
+                ).scalars().all()
+                if not ids:
+                    return repaired
+                conn.execute(
+                    sqlalchemy.text(REPAIR_REVIEW_AGGREGATES + ' WHERE id >= :first AND id <= :last'),
+                    parameters={'first': ids[0], 'last': ids[-1]}
+                )
+                conn.commit()
+                repaired += len(ids)
+                after = ids[-1]
+
+    def count_businesses(self, filters=None):
+        parameters = {}
+        conditions = filter_conditions(filters, parameters)
+        stmt = sqlalchemy.text('SELECT COUNT(*) FROM businesses ' + where(conditions))
+        with self.connect() as conn:
+            return conn.execute(stmt, parameters=parameters).scalar()
+
+    def list_owner_businesses(self, owner_id, after=0, limit=None, columns=None):
+        sql = self.select_businesses(columns) + 'WHERE owner_id = :owner_id AND id > :after ORDER BY id'
+        parameters = {'owner_id': owner_id, 'after': after}
+        if limit is not None:
+            sql += ' LIMIT :limit'
+            parameters['limit'] = limit
+        with self.connect() as conn:
+            return as_dicts(conn.execute(sqlalchemy.text(sql), parameters=parameters))
+
+    def stream_owner_businesses(self, owner_id, chunk_size, columns=None):
+        stmt = sqlalchemy.text(self.select_businesses(columns) + 'WHERE owner_id = :owner_id ORDER BY id')
+        return self.stream(stmt, {'owner_id': owner_id}, chunk_size)
+
+    def stream(self, stmt, parameters, chunk_size):
+        # The server-side cursor keeps memory flat no matter how many rows there are
+        with self.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(stmt, parameters=parameters)
+            keys = list(result.keys())
+            for rows in result.partitions(chunk_size):
+                yield [dict(zip(keys, row)) for row in rows]
+
+    def create_review(self, review):
+        # The foreign key rejects unknown businesses and the UNIQUE (user_id, business_id)
+        # constraint rejects a second review by the same user
+        stmt = sqlalchemy.text(
+            'INSERT INTO reviews (user_id, business_id, stars, review_text) '
+            'VALUES (:user_id, :business_id, :stars, :review_text)'
+        )
+        with self.connect() as conn:
+            try:
+                result = conn.execute(stmt, parameters={
+                    'user_id': review['user_id'],
+                    'business_id': review['business_id'],
+                    'stars': review['stars'],
+                    'review_text': review.get('review_text', None)
+                })
+            except sqlalchemy.exc.IntegrityError as e:
+                error = self.review_error(e)
+                if error is None:
+                    raise
+                raise error from e
+            self.update_stats(conn, stats_deltas({}, review['business_id'], review['stars'], 1))
+            self.record_changes(conn, 'reviews', CREATED, [result.lastrowid])
+            self.record_changes(conn, 'businesses', UPDATED, [review['business_id']])
+            conn.commit()
+        return result.lastrowid
+
+    def create_reviews(self, reviews):
+        # Unknown businesses and duplicate reviews are found with one query each
+        keys = [(int(review['user_id']), int(review['business_id'])) for review in reviews]
+        outcomes = [None] * len(reviews)
+        with self.connect() as conn:
+            stmt = sqlalchemy.text('SELECT id FROM businesses WHERE id IN :business_ids').bindparams(
+                sqlalchemy.bindparam('business_ids', expanding=True)
+            )
+            business_ids = list({key[1] for key in keys})
+            existing = set(conn.execute(stmt, parameters={'business_ids': business_ids}).scalars())
+
+            # (user_id, business_id) pairs already reviewed, or earlier in this batch
+            seen = set()
+            pairs = [{'user_id': key[0], 'business_id': key[1]} for key in keys if key[1] in existing]
+            if pairs:
+                if self.dialect == 'sqlite':
+                    # SQLite scans the table for a row value IN list, but
+                    # probes the UNIQUE index once per pair of a join
+                    sql = ('SELECT reviews.user_id, reviews.business_id FROM (VALUES {}) AS pairs JOIN reviews '
+                           'ON reviews.user_id = pairs.column1 AND reviews.business_id = pairs.column2')
+                else:
+                    sql = 'SELECT user_id, business_id FROM reviews WHERE (user_id, business_id) IN ({})'
+                stmt = sqlalchemy.text(sql.format(multi_row_values(['user_id', 'business_id'], len(pairs))))
+                rows = conn.execute(stmt, parameters=multi_row_parameters(['user_id', 'business_id'], pairs))
+                seen.update(tuple(row) for row in rows)
+
+            inserts = []
+            for i, key in enumerate(keys):
+                if key[1] not in existing:
+                    outcomes[i] = BusinessNotFound()
+                elif key in seen:
+                    outcomes[i] = DuplicateReview()
+                else:
+                    seen.add(key)
+                    inserts.append(i)
+            if not inserts:
+                return outcomes
+
+            columns = ['user_id', 'business_id', 'stars', 'review_text']
+            stmt = sqlalchemy.text('INSERT INTO reviews ({}) VALUES {}'.format(
+                ', '.join(columns), multi_row_values(columns, len(inserts))
+            ))
+            try:
+                result = conn.execute(stmt, parameters=multi_row_parameters(columns, [reviews[i] for i in inserts]))
+            except sqlalchemy.exc.IntegrityError:
+                conn.rollback()
+                result = None
+            else:
+                # The aggregates of all businesses in the chunk change with one UPDATE
+                deltas = {}
+                for i in inserts:
+                    stats_deltas(deltas, reviews[i]['business_id'], reviews[i]['stars'], 1)
+                self.update_stats(conn, deltas)
+                first_id = self.first_insert_id(result, len(inserts))
+                self.record_changes(conn, 'reviews', CREATED, [first_id + n for n in range(len(inserts))])
+                self.record_changes(conn, 'businesses', UPDATED, list(deltas))
+                conn.commit()
+
+        if result is None:
+            # A concurrent request created a conflicting review or deleted a
+            # business since the checks above, so retry row by row
+            for i in inserts:
+                try:
+                    outcomes[i] = self.create_review(reviews[i])
+                except (BusinessNotFound, DuplicateReview) as e:
+                    outcomes[i] = e
+            return outcomes
+
+        for n, i in enumerate(inserts):
+            outcomes[i] = first_id + n
+        return outcomes
+
+    def get_review(self, review_id):
+        stmt = sqlalchemy.text(SELECT_REVIEWS + 'WHERE id = :review_id')
+        with self.connect() as conn:
+            row = conn.execute(stmt, parameters={'review_id': review_id}).one_or_none()
+        return None if row is None else row._asdict()
+
+    def get_reviews(self, review_ids, columns=None):
+        stmt = sqlalchemy.text(self.select_reviews(columns) + 'WHERE id IN :review_ids').bindparams(
+            sqlalchemy.bindparam('review_ids', expanding=True)
+        )
+        with self.connect() as conn:
+            return as_dicts(conn.execute(stmt, parameters={'review_ids': list(review_ids)}))
+
+    def find_review(self, user_id, business_id):
+        # Served by the UNIQUE (user_id, business_id) index
+        stmt = sqlalchemy.text(SELECT_REVIEWS + 'WHERE user_id = :user_id AND business_id = :business_id')
+        with self.connect() as conn:
+            row = conn.execute(stmt, parameters={'user_id': user_id, 'business_id': business_id}).one_or_none()
+        return None if row is None else row._asdict()
+
+    def update_review(self, review_id, stars, review_text):
+        # The old stars are read under a lock so the aggregates move by the right amount
+        with self.connect() as conn:
+            review = self.lock_review(conn, review_id)
+            if review is None:
+                return None
+            stmt = sqlalchemy.text(
+                'UPDATE reviews SET '
+                'stars = :stars, '
+                'review_text = COALESCE(:review_text, review_text) '
+                'WHERE id = :review_id'
+            )
+            conn.execute(stmt, parameters={
+                'stars': stars,
+                'review_text': review_text,
+                'review_id': review_id
+            })
+            self.record_changes(conn, 'reviews', UPDATED, [review_id])
+            if int(stars) != review['stars']:
+                deltas = stats_deltas({}, review['business_id'], review['stars'], -1)
+                self.update_stats(conn, stats_deltas(deltas, review['business_id'], stars, 1))
+                self.record_changes(conn, 'businesses', UPDATED, [review['business_id']])
+            conn.commit()
+        # The row as stored, with the column types a read returns
+        review['stars'] = int(stars)
+        if review_text is not None:
+            review['review_text'] = str(review_text)
+        return review
+
+    def delete_review(self, review_id):
+        with self.connect() as conn:
+            review = self.lock_review(conn, review_id)
+            if review is None:
+                return None
+            conn.execute(sqlalchemy.text('DELETE FROM reviews WHERE id = :review_id'), parameters={'review_id': review_id})
+            self.update_stats(conn, stats_deltas({}, review['business_id'], review['stars'], -1))
+            self.record_changes(conn, 'reviews', DELETED, [review_id])
+            self.record_changes(conn, 'businesses', UPDATED, [review['business_id']])
+            conn.commit()
+        return review
+
+    def list_user_reviews(self, user_id, after=0, limit=None, columns=None):
+        sql = self.select_reviews(columns) + 'WHERE user_id = :user_id AND id > :after ORDER BY id'
+        parameters = {'user_id': user_id, 'after': after}
+        if limit is not None:
+            sql += ' LIMIT :limit'
+            parameters['limit'] = limit
+        with self.connect() as conn:
+            return as_dicts(conn.execute(sqlalchemy.text(sql), parameters=parameters))
+
+    def stream_user_reviews(self, user_id, chunk_size, columns=None, with_businesses=False):
+        if with_businesses:
+            return self.stream_user_reviews_with_businesses(user_id, chunk_size, columns)
+        stmt = sqlalchemy.text(self.select_reviews(columns) + 'WHERE user_id = :user_id ORDER BY id')
+        return self.stream(stmt, {'user_id': user_id}, chunk_size)
+
+    def stream_user_reviews_with_businesses(self, user_id, chunk_size, columns):
+        # A stream holds its connection until it ends, so the businesses are
+        # joined into its query rather than fetched on a second connection
+        review_columns = REVIEW_COLUMNS if columns is None else list(columns)
+        if not REVIEW_SELECTABLE.issuperset(review_columns):
+            raise ValueError('Unknown review columns: {}'.format(', '.join(sorted(set(review_columns) - REVIEW_SELECTABLE))))
+        business_columns = BUSINESS_COLUMNS + BUSINESS_STATS_COLUMNS
+        stmt = sqlalchemy.text(
+            'SELECT {}, {} FROM reviews LEFT JOIN businesses ON businesses.id = reviews.business_id '
+            'WHERE reviews.user_id = :user_id ORDER BY reviews.id'.format(
+                ', '.join('reviews.' + column for column in review_columns),
+                ', '.join('businesses.' + column for column in business_columns),
+            )
+        )
+        split = len(review_columns)
+        with self.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(stmt, parameters={'user_id': user_id})
+            for rows in result.partitions(chunk_size):
+                chunk = []
+                for row in rows:
+                    review = dict(zip(review_columns, row[:split]))
+                    review['business'] = None if row[split] is None else dict(zip(business_columns, row[split:]))
+                    chunk.append(review)
+                yield chunk
+
+    def list_changes(self, after, limit):
+        stmt = sqlalchemy.text(SELECT_CHANGES + 'WHERE id > :after ORDER BY id LIMIT :limit')
+        with self.connect() as conn:
+            return as_dicts(conn.execute(stmt, parameters={'after': after, 'limit': limit}))
+
+    def latest_change(self):
+        # The log is empty when every entry was pruned
+        with self.connect() as conn:
+            latest = conn.execute(sqlalchemy.text('SELECT MAX(id) FROM changes')).scalar()
+            if latest is None:
+                latest = conn.execute(sqlalchemy.text('SELECT horizon FROM changes_horizon WHERE id = 1')).scalar()
+        return latest or 0
+
+    def change_horizon(self):
+        with self.connect() as conn:
+            return conn.execute(sqlalchemy.text('SELECT horizon FROM changes_horizon WHERE id = 1')).scalar() or 0
+
+    def prune_changes(self, before):
+        # The newest expired entry is found on the changed_at index and the
+        # entries up to it are deleted by primary key range
+        with self.connect() as conn:
+            horizon = conn.execute(
+                sqlalchemy.text('SELECT MAX(id) FROM changes WHERE changed_at < :before'), parameters={'before': before}
+            ).scalar()
+            if horizon is None:
+                return 0
+            result = conn.execute(sqlalchemy.text('DELETE FROM changes WHERE id <= :horizon'), parameters={'horizon': horizon})
+            conn.execute(
+                sqlalchemy.text('UPDATE changes_horizon SET horizon = :horizon WHERE id = 1 AND horizon < :horizon'),
+                parameters={'horizon': horizon}
+            )
+            conn.commit()
+        return result.rowcount